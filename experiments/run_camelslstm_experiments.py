@@ -12,6 +12,7 @@ import os
 
 from torchhydro import SETTING
 from torchhydro.configs.config import cmd, default_config_file, update_cfg
+from torchhydro.trainers.train_utils import time_to_metric_target
 from torchhydro.trainers.trainer import train_and_evaluate
 
 VAR_C_CHOSEN_FROM_CAMELS_US = [
@@ -53,6 +54,8 @@ def run_normal_dl(
     train_period=None,
     valid_period=None,
     test_period=None,
+    sampler="KuaiSampler",
+    train_epoch=20,
 ):
     if train_period is None:
         train_period = ["1985-10-01", "1995-10-01"]
@@ -77,7 +80,7 @@ def run_normal_dl(
             "n_hidden_states": 256,
         },
         loss_func="RMSESum",
-        sampler="KuaiSampler",
+        sampler=sampler,
         dataset="StreamflowDataset",
         scaler="DapengScaler",
         batch_size=512,
@@ -91,11 +94,11 @@ def run_normal_dl(
         test_period=test_period,
         opt="Adadelta",
         rs=1234,
-        train_epoch=20,
+        train_epoch=train_epoch,
         save_epoch=1,
         model_loader={
             "load_way": "specified",
-            "test_epoch": 20,
+            "test_epoch": train_epoch,
         },
         gage_id_file=gage_id_file,
         which_first_tensor="sequence",
@@ -103,6 +106,33 @@ def run_normal_dl(
     update_cfg(config_data, args)
     train_and_evaluate(config_data)
     print("All processes are finished!")
+    return config_data["data_cfgs"]["test_path"]
+
+
+def compare_samplers_to_nse_target(
+    project_name,
+    gage_id_file,
+    nse_target=0.6,
+    samplers=("KuaiSampler", "LossAwareSampler"),
+    train_epoch=20,
+):
+    """Train the same LSTM with each sampler and report the wall-clock time until
+    the median validation NSE reaches nse_target"""
+    for sampler in samplers:
+        test_path = run_normal_dl(
+            os.path.join(project_name, sampler),
+            gage_id_file,
+            sampler=sampler,
+            train_epoch=train_epoch,
+        )
+        reached = time_to_metric_target(test_path, nse_target)
+        if reached is None:
+            print(f"{sampler}: NSE {nse_target} is not reached in {train_epoch} epochs")
+        else:
+            epoch, seconds = reached
+            print(
+                f"{sampler}: NSE {nse_target} is reached at epoch {epoch} in {seconds:.1f}s"
+            )
 
 
 # the gage_id.txt file is set by the user, it must be the format like:
@@ -112,3 +142,4 @@ def run_normal_dl(
 # ......
 # Then it can be read by pd.read_csv(gage_id_file, dtype={0: str}).iloc[:, 0].values to get the gage_id list
 run_normal_dl(os.path.join("ndl", "explstm"), "xxx/xxx/gage_id.txt")
+# compare_samplers_to_nse_target(os.path.join("ndl", "expsampler"), "xxx/xxx/gage_id.txt")
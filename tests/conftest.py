@@ -547,3 +547,45 @@ def seq2seq_config():
     update_cfg(config_data, args)
 
     return config_data
+
+
+@pytest.fixture()
+def mock_data_cfgs(tmp_path):
+    """Make data configs for the mock data sources in test_data_sets,
+    keyword arguments update the default ones"""
+    test_path = tmp_path / "test_datasets"
+    os.makedirs(test_path, exist_ok=True)
+
+    def make_data_cfgs(source_name="slicingmockdatasource", **kwargs):
+        data_cfgs = {
+            "source_cfgs": {
+                "source_name": source_name,
+                "source_path": str(test_path),
+            },
+            "test_path": str(test_path),
+            "object_ids": ["01013500", "01013501"],
+            "t_range_train": ["2001-01-01", "2002-01-01"],
+            "t_range_test": ["2002-01-01", "2003-01-01"],
+            "relevant_cols": ["prcp", "pet"],
+            "target_cols": ["streamflow", "surface_sm"],
+            "constant_cols": ["geol_1st_class", "geol_2nd_class"],
+            "forecast_history": 7,
+            "warmup_length": 14,
+            "forecast_length": 3,
+            "min_time_unit": "D",
+            "min_time_interval": 1,
+            "target_rm_nan": True,
+            "relevant_rm_nan": True,
+            "constant_rm_nan": True,
+            "scaler": "DapengScaler",
+            "scaler_params": {
+                "prcp_norm_cols": [],
+                "gamma_norm_cols": ["prcp"],
+                "pbm_norm": False,
+            },
+            "stat_dict_file": None,
+        }
+        data_cfgs.update(kwargs)
+        return data_cfgs
+
+    return make_data_cfgs
@@ -11,7 +11,8 @@ Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 import torch
 import pytest
 from torchhydro.models.cudnnlstm import CudnnLstmModel
-from torchhydro.models.cudnnlstm import CudnnLstmModel, CudnnLstm
+from torchhydro.models.cudnnlstm import CudnnLstmModel, CudnnLstm, CpuLstmModel
+from torchhydro.models.simple_lstm import SimpleLSTM
 
 
 def test_mc_dropout_eval():
@@ -195,3 +196,23 @@ def test_forward_with_initial_states():
     assert output.shape == (20, 5, 20), "Output shape mismatch"
     assert hy.shape == (1, 5, 20), "Hidden state shape mismatch"
     assert cy.shape == (1, 5, 20), "Cell state shape mismatch"
+
+
+def test_static_side_channel_same_as_tiled():
+    # attributes given as a side channel (batch, attribute) are same as those tiled along time
+    torch.manual_seed(0)
+    x = torch.randn(20, 5, 3)  # [seq_len, batch_size, input_size]
+    c = torch.randn(5, 2)  # [batch_size, attribute]
+    xc = torch.cat([x, c.unsqueeze(0).expand(20, -1, -1)], dim=-1)
+    for model in [
+        CpuLstmModel(n_input_features=5, n_output_features=1, n_hidden_states=8),
+        SimpleLSTM(input_size=5, output_size=1, hidden_size=8),
+    ]:
+        model.eval()
+        with torch.no_grad():
+            torch.testing.assert_close(model(x, c=c), model(xc))
+    # flags after x are still positional
+    model = CpuLstmModel(n_input_features=3, n_output_features=1, n_hidden_states=8)
+    model.eval()
+    with torch.no_grad():
+        torch.testing.assert_close(model(x, False), model(x))
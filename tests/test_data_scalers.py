@@ -2,10 +2,21 @@ import tempfile
 import pandas as pd
 import pytest
 import numpy as np
+import torch
 import xarray as xr
 import json
 import os
-from torchhydro.datasets.data_scalers import DapengScaler
+from hydroutils.hydro_stat import cal_stat, cal_stat_gamma
+from torchhydro.datasets.data_scalers import (
+    SCALER_DICT,
+    BasinSideTable,
+    DapengScaler,
+    StoredScaler,
+    StreamingStat,
+    _new_scaler,
+    cal_stat_chunks,
+    save_sklearn_scaler,
+)
 from hydrodatasource.reader.data_source import SelfMadeHydroDataset
 
 
@@ -128,3 +139,202 @@ def test_dapeng_scaler_load_data_and_denorm(sample_data):
             denorm_y.coords[coord].values,
             err_msg=f"{coord} is inconsistent",
         )
+
+
+class CountingSource:
+    """A data source which counts how many times per-basin quantities are read"""
+
+    def __init__(self):
+        self.calls = {"mean_prcp": 0, "area": 0}
+        basins = ["b1", "b2", "b3"]
+        self.p_mean = xr.Dataset(
+            {"p_mean": ("basin", [2.0, 3.0, 4.0])}, coords={"basin": basins}
+        )
+        self.area_ds = xr.Dataset(
+            {"area_gages2": ("basin", [10.0, 20.0, 30.0])}, coords={"basin": basins}
+        )
+        self.area_ds["area_gages2"].attrs["units"] = "km^2"
+
+    def read_mean_prcp(self, basin_ids, unit="mm/d"):
+        self.calls["mean_prcp"] += 1
+        scale = 1.0 if unit == "mm/d" else 1 / 24
+        return self.p_mean.sel(basin=basin_ids) * scale
+
+    def read_area(self, basin_ids):
+        self.calls["area"] += 1
+        return self.area_ds.sel(basin=basin_ids)
+
+
+def test_basin_side_table(tmp_path):
+    """Per-basin quantities should be read from the data source once and then from the saved table"""
+    file = tmp_path / "basin_side_table.nc"
+    source = CountingSource()
+    table = BasinSideTable(str(file), source)
+    np.testing.assert_allclose(table.mean_prcp(["b1", "b2"], "mm/d"), [[2.0], [3.0]])
+    np.testing.assert_allclose(table.mean_prcp(["b2"], "mm/d"), [[3.0]])
+    assert source.calls["mean_prcp"] == 1
+    area = table.area(["b2", "b1"])
+    assert list(area.data_vars) == ["area_gages2"]
+    assert area["area_gages2"].attrs["units"] == "km^2"
+    np.testing.assert_allclose(area["area_gages2"], [20.0, 10.0])
+    assert source.calls["area"] == 1
+    assert file.is_file()
+
+    # e.g. a valid dataset or a resulter reads the saved table without the data source
+    saved = BasinSideTable(str(file))
+    np.testing.assert_allclose(saved.mean_prcp(["b1", "b2"], "mm/d"), [[2.0], [3.0]])
+    xr.testing.assert_identical(saved.area(["b2", "b1"]), area)
+    with pytest.raises(ValueError):
+        saved.mean_prcp(["b3"], "mm/d")
+
+    # new basins and another unit are read and added to the table
+    table = BasinSideTable(str(file), source)
+    np.testing.assert_allclose(table.mean_prcp(["b3"], "mm/d"), [[4.0]])
+    np.testing.assert_allclose(table.mean_prcp(["b1"], "mm/h"), [[2.0 / 24]])
+    assert source.calls["mean_prcp"] == 3
+    np.testing.assert_allclose(
+        BasinSideTable(str(file)).mean_prcp(["b1"], "mm/h"), [[2.0 / 24]]
+    )
+
+
+def test_basin_side_table_source(tmp_path):
+    """A table of another data source or other statistics should be rebuilt rather than used"""
+    file = str(tmp_path / "basin_side_table.nc")
+    source = CountingSource()
+    source_cfgs = {"source_name": "camels_us", "source_path": "/data/camels"}
+    BasinSideTable(file, source, source_cfgs).mean_prcp(["b1"], "mm/d")
+    BasinSideTable(file, source, source_cfgs).mean_prcp(["b1"], "mm/d")
+    assert source.calls["mean_prcp"] == 1
+    other_cfgs = {**source_cfgs, "source_path": "/data/camels_v2"}
+    table = BasinSideTable(file, source, other_cfgs)
+    table.mean_prcp(["b1"], "mm/d")
+    assert source.calls["mean_prcp"] == 2
+    assert table.table.attrs["source_path"] == "/data/camels_v2"
+    # statistics being calculated start a new table, while the saved one is still there
+    stat_file = tmp_path / "dapengscaler_stat.json"
+    stat_file.write_text('{"prcp": [1.0, 2.0, 1.5, 0.5]}')
+    table = BasinSideTable(file, source, other_cfgs, str(stat_file))
+    table.rebuild()
+    assert os.path.isfile(file)
+    table.mean_prcp(["b1"], "mm/d")
+    assert source.calls["mean_prcp"] == 3
+    table.save_with_stat()
+    BasinSideTable(file, source, other_cfgs, str(stat_file)).mean_prcp(["b1"], "mm/d")
+    assert source.calls["mean_prcp"] == 3
+    stat_file.write_text('{"prcp": [1.0, 2.5, 1.5, 0.5]}')
+    BasinSideTable(file, source, other_cfgs, str(stat_file)).mean_prcp(["b1"], "mm/d")
+    assert source.calls["mean_prcp"] == 4
+    # only whole tables are saved, no temporary files are left
+    assert sorted(os.listdir(tmp_path)) == [
+        "basin_side_table.nc",
+        "dapengscaler_stat.json",
+    ]
+
+
+STREAM_DATA = np.random.default_rng(0).gamma(2.0, size=(3, 400, 2))
+STREAM_DATA[0, :50, 1] = np.nan
+
+
+def _year_stat(year):
+    """StreamingStat of a block of 100 time steps of STREAM_DATA"""
+    stat = StreamingStat(["prcp", "temp"], gamma_cols=["prcp"], seed=year)
+    return [stat.update(STREAM_DATA[:, year * 100 : (year + 1) * 100])]
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_streaming_stat(tmp_path, num_workers):
+    """Statistics merged from chunks should be same as those of the whole data"""
+    (stat,) = cal_stat_chunks(_year_stat, range(3), num_workers=num_workers)
+    stat_dict = stat.stat_dict()
+    old_years = STREAM_DATA[:, :300]
+    np.testing.assert_allclose(stat_dict["prcp"], cal_stat_gamma(old_years[..., 0]))
+    np.testing.assert_allclose(stat_dict["temp"], cal_stat(old_years[..., 1]))
+    # a new year of data is added to the saved state without reading old years again
+    stat.save(tmp_path / "stat.npz")
+    stat = StreamingStat.load(tmp_path / "stat.npz").merge(_year_stat(3)[0])
+    stat_dict = stat.stat_dict()
+    np.testing.assert_allclose(stat_dict["prcp"], cal_stat_gamma(STREAM_DATA[..., 0]))
+    np.testing.assert_allclose(stat_dict["temp"], cal_stat(STREAM_DATA[..., 1]))
+    # with a small sample, only percentiles are approximate
+    small = StreamingStat(["temp"], sample_size=500).update(STREAM_DATA[..., 1:])
+    p10, p90, mean, std = small.stat_dict()["temp"]
+    np.testing.assert_allclose([mean, std], cal_stat(STREAM_DATA[..., 1])[2:])
+    assert small._samples[0].size == 500
+    assert (
+        np.nanpercentile(STREAM_DATA[..., 1], 5)
+        < p10
+        < np.nanpercentile(STREAM_DATA[..., 1], 15)
+    )
+
+
+def denorm_scaler(tmp_path):
+    """A DapengScaler of 3 basins with known statistics and mean precipitation"""
+    target_cols = ["streamflow", "sm", "temp"]
+    data_cfgs = {
+        "scaler": "DapengScaler",
+        "test_path": str(tmp_path),
+        "stat_dict_file": None,
+        "target_cols": target_cols,
+        "object_ids": ["b1", "b2", "b3"],
+        "t_range_train": ["2001-01-01", "2001-01-05"],
+        "t_range_test": ["2001-01-01", "2001-01-05"],
+    }
+    data_target = xr.DataArray(
+        np.full((3, 3, 4), np.nan, dtype=np.float32),
+        dims=["variable", "basin", "time"],
+        coords={
+            "variable": target_cols,
+            "basin": ["b1", "b2", "b3"],
+            "time": pd.date_range("2001-01-01", periods=4),
+        },
+        attrs={"units": {"streamflow": "mm/d", "sm": "-", "temp": "C"}},
+    )
+    return DapengScaler(
+        data_target,
+        None,
+        None,
+        data_cfgs,
+        "train",
+        prcp_norm_cols=["streamflow"],
+        gamma_norm_cols=["sm"],
+        data_source=CountingSource(),
+        stat_dict={
+            "streamflow": [0.0, 1.0, -0.2, 0.3],
+            "sm": [0.0, 1.0, 0.1, 0.5],
+            "temp": [0.0, 1.0, 10.0, 4.0],
+        },
+    )
+
+
+def test_inverse_transform_batch(tmp_path):
+    """Denormalizing a tensor should be same as inverse_transform with xarray"""
+    scaler = denorm_scaler(tmp_path)
+    y = np.random.default_rng(0).standard_normal((3, 4, 3)).astype(np.float32)
+    expected = scaler.inverse_transform(
+        xr.DataArray(
+            y.transpose(2, 0, 1),
+            dims=["variable", "basin", "time"],
+            coords={"variable": scaler.data_cfgs["target_cols"]},
+        )
+    )
+    actual = scaler.inverse_transform_batch(torch.from_numpy(y), torch.arange(3))
+    for i, var in enumerate(scaler.data_cfgs["target_cols"]):
+        np.testing.assert_allclose(actual[..., i], expected[var], rtol=1e-5)
+    # basins of samples are taken into account for mean precipitation
+    sample = scaler.inverse_transform_batch(torch.from_numpy(y[2:]), [2])
+    torch.testing.assert_close(sample, actual[2:])
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("scaler_name", list(SCALER_DICT))
+def test_stored_scaler(tmp_path, scaler_name, dtype):
+    """A scaler saved without pickle should transform data exactly as the sklearn one"""
+    data = STREAM_DATA.reshape(-1, 2).astype(dtype)
+    scaler = _new_scaler(scaler_name).fit(data)
+    file = str(tmp_path / "scaler.npz")
+    save_sklearn_scaler(scaler, file)
+    stored = StoredScaler(file)
+    np.testing.assert_array_equal(stored.transform(data), scaler.transform(data))
+    np.testing.assert_array_equal(
+        stored.inverse_transform(data), scaler.inverse_transform(data)
+    )
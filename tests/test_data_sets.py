@@ -8,6 +8,9 @@ FilePath: \torchhydro\tests\test_data_sets.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
+import gc
+import io
+import json
 import pytest
 import os
 import numpy as np
@@ -15,9 +18,40 @@ import pandas as pd
 import torch
 import xarray as xr
 import pickle
+import weakref
+from collections.abc import Mapping
+from multiprocessing.reduction import ForkingPickler
 from sklearn.preprocessing import StandardScaler
-from torchhydro.datasets.data_sets import BaseDataset, Seq2SeqDataset
-from torchhydro.datasets.data_sources import data_sources_dict
+from torch.utils.data import DataLoader
+from torch.utils.data._utils.collate import default_collate
+from torchhydro.datasets.data_sets import (
+    BaseDataset,
+    DeviceBatchLoader,
+    DplDataset,
+    get_collate_fn,
+    MultiFreqDataset,
+    OutOfCoreDataset,
+    RaggedDataset,
+    Seq2SeqDataset,
+    SharedPeriodRead,
+)
+from torchhydro.datasets.data_scalers import DapengScaler
+from torchhydro.datasets.data_sources import (
+    clear_data_sources,
+    data_sources_dict,
+    get_data_source,
+)
+from torchhydro.datasets.sampler import (
+    BasinBatchSampler,
+    BasinDistributedSampler,
+    LossAwareSampler,
+    PrefetchBatchSampler,
+    PrefetchSampler,
+    RandomWindowSampler,
+    balance_basins,
+)
+from torchhydro.models.simple_lstm import MultiFreqLSTM
+from torchhydro.trainers.train_utils import _loss_aware_sampler
 
 
 class MockDatasource:
@@ -127,7 +161,7 @@ def test_create_lookup_table(tmp_path):
     is_tra_val_te = "train"
     dataset = BaseDataset(data_cfgs, is_tra_val_te)
     lookup_table = dataset.lookup_table
-    assert isinstance(lookup_table, dict)
+    assert isinstance(lookup_table, Mapping)
     assert len(lookup_table) > 0
     assert all(
         isinstance(key, int) and isinstance(value, tuple)
@@ -143,9 +177,994 @@ def test_create_lookup_table(tmp_path):
         pickle.dump(scaler, file)
     dataset = BaseDataset(data_cfgs, is_tra_val_te)
     lookup_table = dataset.lookup_table
-    assert isinstance(lookup_table, dict)
+    assert isinstance(lookup_table, Mapping)
     assert len(lookup_table) > 0
     assert all(
         isinstance(key, int) and isinstance(value, tuple)
         for key, value in lookup_table.items()
     )
+
+
+def test_lookup_table_same_as_loop(mock_data_cfgs):
+    """The vectorized lookup table should be same as the one built by a python loop"""
+    data_sources_dict.update({"mockdatasource": MockDatasource})
+    data_cfgs = mock_data_cfgs(
+        source_name="mockdatasource", target_rm_nan=False, scaler="StandardScaler"
+    )
+    dataset = BaseDataset(data_cfgs, "train")
+    # make some windows all NaN
+    dataset.y[0, 100:130, :] = np.nan
+    dataset.y[1, 200:203, 0] = np.nan
+    dataset._create_lookup_table()
+    rho, warmup, horizon = dataset.rho, dataset.warmup_length, dataset.horizon
+    expected = []
+    for basin in range(dataset.ngrid):
+        nan_array = np.isnan(dataset.y[basin, :, :])
+        expected.extend(
+            (basin, f)
+            for f in range(warmup, dataset.nt - rho - horizon + 1)
+            if not np.all(nan_array[f + rho : f + rho + horizon])
+        )
+    assert list(dataset.lookup_table.values()) == expected
+    assert dataset.num_samples == len(expected)
+    assert dataset.lookup_table[len(expected) - 1] == expected[-1]
+    with pytest.raises(KeyError):
+        dataset.lookup_table[len(expected)]
+
+
+def _flatten(batch):
+    if isinstance(batch, torch.Tensor):
+        return [batch]
+    return [t for item in batch for t in _flatten(item)]
+
+
+@pytest.mark.parametrize("seq_first", [False, True])
+@pytest.mark.parametrize("dataset_cls", [BaseDataset, DplDataset])
+def test_getitems_same_as_getitem(mock_data_cfgs, dataset_cls, seq_first):
+    """A mini-batch from __getitems__ should be same as the collated __getitem__ results"""
+    data_sources_dict.update({"mockdatasource": MockDatasource})
+    data_cfgs = mock_data_cfgs(
+        source_name="mockdatasource",
+        target_as_input=False,
+        constant_only=False,
+        scaler="StandardScaler",
+    )
+    dataset = dataset_cls(data_cfgs, "train")
+    dataset.seq_first = seq_first
+    indices = [5, 0, 42, len(dataset) - 1, 42]
+    expected = default_collate([dataset[i] for i in indices])
+    batch = dataset.__getitems__(indices)
+    # same nested structure as default_collate gives
+    assert type(batch[0]) is type(expected[0])
+    for actual, target in zip(_flatten(batch), _flatten(expected)):
+        assert actual.shape == target.shape
+        assert torch.allclose(actual, target, equal_nan=True)
+
+
+@pytest.mark.parametrize("scaler", ["DapengScaler", "StandardScaler"])
+def test_dataset_cache(tmp_path, mock_data_cfgs, scaler, monkeypatch):
+    """The second dataset with same configs should be loaded from the cache without reading data"""
+    data_sources_dict.update({"mockdatasource": MockDatasource})
+    data_cfgs = mock_data_cfgs(
+        source_name="mockdatasource",
+        scaler=scaler,
+        cache_dataset=True,
+        cache_dir=str(tmp_path / "cache"),
+    )
+    exp_path = data_cfgs["test_path"]
+    dataset = BaseDataset(data_cfgs, "train")
+    assert len(os.listdir(tmp_path / "cache")) == 1
+    test_dataset = BaseDataset(data_cfgs, "test")
+    assert len(os.listdir(tmp_path / "cache")) == 2
+
+    def no_read(*args, **kwargs):
+        raise AssertionError("data should be loaded from cache")
+
+    monkeypatch.setattr(MockDatasource, "read_ts_xrdataset", no_read)
+    # the test_path of another experiment
+    data_cfgs["test_path"] = str(tmp_path / "another_exp")
+    os.makedirs(data_cfgs["test_path"])
+    cached_dataset = BaseDataset(data_cfgs, "train")
+    for name in ["x", "y", "c", "x_origin", "y_origin"]:
+        np.testing.assert_array_equal(
+            getattr(cached_dataset, name), getattr(dataset, name)
+        )
+    assert list(cached_dataset.lookup_table.items()) == list(
+        dataset.lookup_table.items()
+    )
+    # read-only memmaps, while their samples are still writable tensors
+    assert not cached_dataset.x.flags.writeable
+    cached_x, cached_y = cached_dataset[0]
+    assert cached_x.numpy().flags.writeable and cached_y.numpy().flags.writeable
+    x, y = dataset[0]
+    assert torch.equal(cached_x, x) and torch.equal(cached_y, y)
+    # scaler statistics are also there for valid/test
+    assert sorted(os.listdir(data_cfgs["test_path"])) == sorted(os.listdir(exp_path))
+    cached_test_dataset = BaseDataset(data_cfgs, "test")
+    np.testing.assert_array_equal(cached_test_dataset.x, test_dataset.x)
+    if scaler == "DapengScaler":
+        assert cached_dataset.target_scaler.stat_dict == dataset.target_scaler.stat_dict
+        xr.testing.assert_equal(
+            cached_test_dataset.target_scaler.data_target,
+            test_dataset.target_scaler.data_target,
+        )
+
+
+@pytest.mark.parametrize("scaler", ["DapengScaler", "StandardScaler"])
+def test_scaler_store(tmp_path, mock_data_cfgs, scaler, monkeypatch):
+    """Runs with the same training data should reuse statistics in the scaler store"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(
+        test_path=str(tmp_path / "member_0"),
+        scaler=scaler,
+        batch_size=4,
+        scaler_store=True,
+        cache_dir=str(tmp_path / "cache"),
+    )
+    os.makedirs(data_cfgs["test_path"])
+    dataset = BaseDataset(data_cfgs, "train")
+    store_dir = tmp_path / "cache" / "scaler_store"
+    assert len(os.listdir(store_dir)) == 1
+    # only non-pickle files are in the store and in test_path
+    (store_path,) = store_dir.iterdir()
+    for path in [store_path, data_cfgs["test_path"]]:
+        assert all(not file.endswith(".pkl") for file in os.listdir(path))
+
+    def no_stat(*args, **kwargs):
+        raise AssertionError("statistics should be loaded from the store")
+
+    monkeypatch.setattr(DapengScaler, "cal_stat_all", no_stat)
+    # stored statistics are applied without sklearn
+    monkeypatch.setattr(StandardScaler, "fit_transform", no_stat)
+    monkeypatch.setattr(StandardScaler, "transform", no_stat)
+    # another member of an ensemble
+    member_cfgs = {
+        **data_cfgs,
+        "test_path": str(tmp_path / "member_1"),
+        "batch_size": 8,
+        "t_range_test": ["2002-01-01", "2002-06-01"],
+    }
+    os.makedirs(member_cfgs["test_path"])
+    member_dataset = BaseDataset(member_cfgs, "train")
+    np.testing.assert_array_equal(member_dataset.x, dataset.x)
+    np.testing.assert_array_equal(member_dataset.y, dataset.y)
+    assert all(
+        not file.endswith(".pkl") for file in os.listdir(member_cfgs["test_path"])
+    )
+    # valid/test datasets read the statistics in test_path as usual
+    BaseDataset(member_cfgs, "test")
+    assert len(os.listdir(store_dir)) == 1
+    monkeypatch.undo()
+    # another training period, dtype or gap filling has its own statistics
+    BaseDataset({**member_cfgs, "t_range_train": ["2001-01-01", "2001-09-01"]}, "train")
+    BaseDataset({**member_cfgs, "dtype": "float64"}, "train")
+    BaseDataset({**member_cfgs, "nan_max_gap": 5}, "train")
+    assert len(os.listdir(store_dir)) == 4
+
+
+def test_float32_dataset_same_as_float64(mock_data_cfgs):
+    """Data of a float32 dataset should be close to that of a float64 one"""
+    data_sources_dict.update({"mockdatasource": MockDatasource})
+    data_cfgs = mock_data_cfgs(source_name="mockdatasource")
+    datasets = {}
+    for dtype in ["float64", "float32"]:
+        # same random data for both datasets
+        np.random.seed(0)
+        data_cfgs["dtype"] = dtype
+        datasets[dtype] = BaseDataset(data_cfgs, "train")
+    for name in ["x", "y", "c", "x_origin", "y_origin"]:
+        arr32 = getattr(datasets["float32"], name)
+        assert arr32.dtype == np.float32
+        np.testing.assert_allclose(
+            arr32, getattr(datasets["float64"], name), rtol=1e-5, atol=1e-5
+        )
+    stat32 = datasets["float32"].target_scaler.stat_dict
+    stat64 = datasets["float64"].target_scaler.stat_dict
+    for var in stat64:
+        np.testing.assert_allclose(stat32[var], stat64[var], rtol=1e-5)
+    xc, y = datasets["float32"][0]
+    assert xc.dtype == torch.float32 and y.dtype == torch.float32
+
+
+@pytest.mark.parametrize("seq_first", [False, True])
+def test_device_batch_loader(mock_data_cfgs, seq_first):
+    """Batches from a device-resident dataset should be same as those from __getitems__"""
+    data_sources_dict.update({"mockdatasource": MockDatasource})
+    data_cfgs = mock_data_cfgs(source_name="mockdatasource", scaler="StandardScaler")
+    dataset = BaseDataset(data_cfgs, "train")
+    dataset.seq_first = seq_first
+    batch_size = 100
+    sampler = torch.utils.data.RandomSampler(dataset, num_samples=250)
+    torch.manual_seed(0)
+    indices = list(iter(sampler))
+    loader = DeviceBatchLoader(
+        dataset, batch_size, torch.device("cpu"), sampler=sampler
+    )
+    assert len(loader) == 3
+    torch.manual_seed(0)
+    batches = list(loader)
+    assert len(batches) == 3
+    for i, batch in enumerate(batches):
+        expected = dataset.__getitems__(indices[i * batch_size : (i + 1) * batch_size])
+        for actual, target in zip(_flatten(batch), _flatten(expected)):
+            assert actual.shape == target.shape
+            assert torch.equal(actual, target)
+    # without sampler, all samples are iterated once
+    loader = DeviceBatchLoader(dataset, batch_size, torch.device("cpu"))
+    assert sum(xc.shape[0] for xc, _ in loader) == len(dataset)
+
+
+class SlicingMockDatasource(MockDatasource):
+    """A mock data source with fixed data, which returns the basins and period asked for"""
+
+    def __init__(self, source_cfgs, time_unit="1D"):
+        super().__init__(source_cfgs, time_unit)
+        rng = np.random.default_rng(0)
+        times = pd.date_range("2001-01-01", "2003-01-01", freq="D")
+        basins = [f"{i:08d}" for i in range(1013500, 1013500 + self.ngrid)]
+        self.ts = xr.Dataset(
+            {
+                var: (["basin", "time"], rng.random((self.ngrid, len(times))))
+                for var in ["prcp", "pet", "streamflow", "surface_sm"]
+            },
+            coords={"basin": basins, "time": times},
+        )
+        for var in ["prcp", "streamflow"]:
+            self.ts[var].attrs["units"] = "mm/day"
+        self.attr = xr.Dataset(
+            {
+                var: (["basin"], rng.random(self.ngrid))
+                for var in ["geol_1st_class", "geol_2nd_class"]
+            },
+            coords={"basin": basins},
+        )
+
+    def read_ts_xrdataset(self, basin_id, t_range, var_lst):
+        return self.ts[var_lst].sel(basin=basin_id, time=slice(*t_range))
+
+    def read_attr_xrdataset(self, basin_id, var_lst, all_number=True):
+        return self.attr[var_lst].sel(basin=basin_id)
+
+
+@pytest.mark.parametrize("is_tra_val_te", ["train", "test"])
+def test_out_of_core_dataset(mock_data_cfgs, is_tra_val_te):
+    """Items of OutOfCoreDataset should be same as those of BaseDataset"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(
+        out_of_core_params={
+            "chunk_length": 50,
+            "chunk_basins": 1,
+            "cache_chunks": 3,
+            "prefetch_batches": 1,
+        }
+    )
+    # the training dataset computes the statistics
+    BaseDataset(data_cfgs, "train")
+    dataset = BaseDataset(data_cfgs, is_tra_val_te)
+    ooc_dataset = OutOfCoreDataset(data_cfgs, is_tra_val_te)
+    assert ooc_dataset.x is None and len(ooc_dataset) == len(dataset)
+    assert list(ooc_dataset.lookup_table.items()) == list(dataset.lookup_table.items())
+    sampler = PrefetchSampler(
+        torch.utils.data.RandomSampler(ooc_dataset, num_samples=20),
+        ooc_dataset,
+        lookahead=4,
+    )
+    for i in list(iter(sampler)) + [0, len(dataset) - 1]:
+        for actual, target in zip(ooc_dataset[i], dataset[i]):
+            assert actual.shape == target.shape
+            torch.testing.assert_close(actual, target)
+    assert len(ooc_dataset._chunks) <= 3
+
+
+class GappyMockDatasource(SlicingMockDatasource):
+    """SlicingMockDatasource with NaN gaps at the start of the series and across chunk boundaries"""
+
+    def __init__(self, source_cfgs, time_unit="1D"):
+        super().__init__(source_cfgs, time_unit)
+        for var in ["prcp", "streamflow"]:
+            values = self.ts[var].values
+            # the last one is longer than nan_max_gap and is not filled
+            for start, stop in [(0, 3), (40, 52), (95, 103), (140, 160)]:
+                values[:, start:stop] = np.nan
+
+
+def test_out_of_core_dataset_gaps(mock_data_cfgs):
+    """NaN gaps across chunk boundaries should be filled as in BaseDataset when nan_max_gap is given"""
+    data_sources_dict.update({"gappymockdatasource": GappyMockDatasource})
+    data_cfgs = mock_data_cfgs(
+        "gappymockdatasource",
+        warmup_length=0,
+        nan_max_gap=12,
+        out_of_core_params={"chunk_length": 50, "chunk_basins": 1},
+    )
+    BaseDataset(data_cfgs, "train")
+    dataset = BaseDataset(data_cfgs, "train")
+    ooc_dataset = OutOfCoreDataset(data_cfgs, "train")
+    assert ooc_dataset.gap_overlap == 13
+    assert list(ooc_dataset.lookup_table.items()) == list(dataset.lookup_table.items())
+    for i in range(len(dataset)):
+        for actual, target in zip(ooc_dataset[i], dataset[i]):
+            torch.testing.assert_close(actual, target, equal_nan=True)
+    with pytest.warns(UserWarning, match="nan_max_gap"):
+        OutOfCoreDataset({**data_cfgs, "nan_max_gap": None}, "train")
+
+
+def test_out_of_core_dataset_stat(tmp_path, mock_data_cfgs, monkeypatch):
+    """Without saved statistics, OutOfCoreDataset computes them chunk by chunk,
+    together with the non-NaN counts for its lookup table
+    """
+    data_sources_dict.update({"gappymockdatasource": GappyMockDatasource})
+    data_cfgs = mock_data_cfgs(
+        "gappymockdatasource",
+        warmup_length=0,
+        nan_max_gap=12,
+        scaler_params={
+            "prcp_norm_cols": [],
+            "gamma_norm_cols": ["prcp", "surface_sm"],
+            "pbm_norm": False,
+        },
+        out_of_core_params={"chunk_length": 50, "chunk_basins": 1},
+    )
+    read_keys = []
+    read_chunk = OutOfCoreDataset._read_chunk
+
+    def counted_read_chunk(self, key, overlap=0):
+        read_keys.append(key)
+        return read_chunk(self, key, overlap)
+
+    monkeypatch.setattr(OutOfCoreDataset, "_read_chunk", counted_read_chunk)
+    stat_dicts = []
+    datasets = []
+    for name, dataset_cls in [("base", BaseDataset), ("ooc", OutOfCoreDataset)]:
+        test_path = tmp_path / name
+        os.makedirs(test_path)
+        datasets.append(
+            dataset_cls({**data_cfgs, "test_path": str(test_path)}, "train")
+        )
+        with open(test_path / "dapengscaler_stat.json", "r") as fp:
+            stat_dicts.append(json.load(fp))
+    assert list(datasets[1].lookup_table.items()) == list(
+        datasets[0].lookup_table.items()
+    )
+    # the first chunk is read before the statistics, then each chunk only once
+    # for both the statistics and the lookup table
+    assert len(read_keys) == len(set(read_keys)) + 1
+    assert stat_dicts[0].keys() == stat_dicts[1].keys()
+    for var, stat in stat_dicts[0].items():
+        np.testing.assert_allclose(stat_dicts[1][var], stat, err_msg=var)
+
+
+@pytest.mark.parametrize("dataset_cls", [BaseDataset, Seq2SeqDataset])
+def test_shared_period_read(mock_data_cfgs, dataset_cls, monkeypatch):
+    """Datasets sharing one reading of the union period should be same as those reading their own data"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(
+        t_range_train=["2001-01-01", "2001-10-01"],
+        t_range_valid=["2001-10-01", "2002-03-01"],
+        t_range_test=["2002-03-01", "2002-12-31"],
+        warmup_length=0,
+    )
+    modes = ["train", "valid", "test"]
+    datasets = {mode: dataset_cls(data_cfgs, mode) for mode in modes}
+    read_ranges = []
+    read_ts = SlicingMockDatasource.read_ts_xrdataset
+
+    def counted_read(self, basin_id, t_range, var_lst):
+        read_ranges.append(tuple(t_range))
+        return read_ts(self, basin_id, t_range, var_lst)
+
+    monkeypatch.setattr(SlicingMockDatasource, "read_ts_xrdataset", counted_read)
+    shared_read = SharedPeriodRead(data_cfgs)
+    for mode in modes:
+        shared_dataset = dataset_cls(data_cfgs, mode, shared_read=shared_read)
+        for name in ["x", "y", "c", "x_origin", "y_origin"]:
+            np.testing.assert_array_equal(
+                getattr(shared_dataset, name), getattr(datasets[mode], name)
+            )
+        assert list(shared_dataset.lookup_table.items()) == list(
+            datasets[mode].lookup_table.items()
+        )
+    # x and y of the union period are read only once
+    assert len(set(read_ranges)) == 1 and len(read_ranges) == 2
+
+
+def test_shared_data_source_instance(tmp_path):
+    """Datasets with the same source configs should share one data source instance"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    source_cfgs = {
+        "source_name": "slicingmockdatasource",
+        "source_path": str(tmp_path),
+    }
+    dataset = BaseDataset.__new__(BaseDataset)
+    dataset.data_cfgs = {"source_cfgs": source_cfgs}
+    data_source = dataset.data_source
+    assert dataset.data_source is data_source
+    assert get_data_source("slicingmockdatasource", str(tmp_path)) is data_source
+    assert (
+        get_data_source("slicingmockdatasource", str(tmp_path), time_unit="1h")
+        is not data_source
+    )
+    clear_data_sources("slicingmockdatasource")
+    assert dataset.data_source is not data_source
+
+
+@pytest.mark.parametrize(
+    "t_range_train",
+    [
+        ["2001-01-01", "2002-01-01"],
+        [["2001-01-01", "2002-01-01"], ["2001-06-01", "2002-12-31"]],
+    ],
+)
+def test_ragged_dataset(mock_data_cfgs, t_range_train):
+    """RaggedDataset should only store each basin's own period and be same as BaseDataset for a unified one"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(t_range_train=t_range_train)
+    dataset = RaggedDataset(data_cfgs, "train")
+    source = SlicingMockDatasource(None)
+    for i, (start, end) in enumerate(dataset.basin_t_ranges):
+        raw = source.ts[data_cfgs["relevant_cols"]].sel(
+            basin=dataset.basins[i], time=slice(start, end)
+        )
+        np.testing.assert_allclose(
+            dataset.x_origin[dataset.offsets[i] : dataset.offsets[i + 1]],
+            raw.to_array().to_numpy().T,
+            rtol=1e-6,
+        )
+    assert dataset.x.shape == (dataset.offsets[-1], 2)
+    for basin, time in dataset.lookup_table.values():
+        assert dataset.warmup_length <= time
+        assert dataset.offsets[basin] + time + 10 <= dataset.offsets[basin + 1]
+    indices = list(range(0, len(dataset), 7))
+    batch = dataset.__getitems__(indices)
+    expected = default_collate([dataset[i] for i in indices])
+    for actual, target in zip(batch, expected):
+        torch.testing.assert_close(actual, target)
+    test_dataset = RaggedDataset(data_cfgs, "test")
+    assert len(test_dataset) == 2
+    if isinstance(t_range_train[0], str):
+        base_dataset = BaseDataset(data_cfgs, "train")
+        np.testing.assert_allclose(
+            dataset.x, base_dataset.x.reshape(-1, 2), rtol=1e-5, atol=1e-6
+        )
+        np.testing.assert_allclose(
+            dataset.y, base_dataset.y.reshape(-1, 2), rtol=1e-5, atol=1e-6
+        )
+        assert list(dataset.lookup_table.items()) == list(
+            base_dataset.lookup_table.items()
+        )
+
+
+@pytest.mark.parametrize("dataset_cls", [BaseDataset, Seq2SeqDataset])
+def test_static_side_channel(mock_data_cfgs, dataset_cls):
+    """Attributes from the side channel should be same as those tiled along the time dim"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(warmup_length=0, scaler="StandardScaler")
+    tiled_dataset = dataset_cls(data_cfgs, "train")
+    side_dataset = dataset_cls({**data_cfgs, "static_side_channel": True}, "train")
+    indices = [5, 0, 42, len(side_dataset) - 1]
+    xs, y = side_dataset.__getitems__(indices)
+    tiled_xs, tiled_y = tiled_dataset.__getitems__(indices)
+    torch.testing.assert_close(y, tiled_y)
+    if dataset_cls is BaseDataset:
+        xs, tiled_xs = [*xs], [tiled_xs]
+    # attributes are the last input
+    *xs, c = xs
+    assert c.shape == (len(indices), 2)
+    for x, tiled_x in zip(xs, tiled_xs):
+        if x.shape == tiled_x.shape:
+            # targets as inputs of seq2seq
+            torch.testing.assert_close(x, tiled_x)
+            continue
+        c_ = c.unsqueeze(1).expand(-1, x.shape[1], -1)
+        torch.testing.assert_close(torch.cat([x, c_], dim=-1), tiled_x)
+    # same as collated __getitem__ results
+    expected = default_collate([side_dataset[i] for i in indices])
+    for actual, target in zip(
+        _flatten(side_dataset.__getitems__(indices)), _flatten(expected)
+    ):
+        torch.testing.assert_close(actual, target)
+
+
+@pytest.mark.parametrize("is_tra_val_te", ["train", "test"])
+@pytest.mark.parametrize("seq_first", [False, True])
+def test_normalize_on_batch(mock_data_cfgs, is_tra_val_te, seq_first, monkeypatch):
+    """Mini-batches normalized when they are gathered should be same as those from normalized data"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+
+    def read_mean_prcp(self, basin_id, unit="mm/d"):
+        return self.ts[["prcp"]].sel(basin=basin_id).mean("time")
+
+    monkeypatch.setattr(
+        SlicingMockDatasource, "read_mean_prcp", read_mean_prcp, raising=False
+    )
+    data_cfgs = mock_data_cfgs(
+        scaler_params={
+            "prcp_norm_cols": ["streamflow"],
+            "gamma_norm_cols": ["prcp"],
+            "pbm_norm": False,
+        }
+    )
+    if is_tra_val_te == "test":
+        BaseDataset(data_cfgs, "train")
+    expected_dataset = BaseDataset(data_cfgs, is_tra_val_te)
+    dataset = BaseDataset({**data_cfgs, "normalize_on_batch": True}, is_tra_val_te)
+    # only one copy of the time series
+    assert dataset.x is dataset.x_origin and dataset.y is dataset.y_origin
+    np.testing.assert_allclose(dataset.x, expected_dataset.x_origin, rtol=1e-6)
+    for ds in [dataset, expected_dataset]:
+        ds.seq_first = seq_first
+    indices = [0, 1] if is_tra_val_te == "test" else [5, 0, 42, len(dataset) - 1]
+    batch = dataset.__getitems__(indices)
+    expected = expected_dataset.__getitems__(indices)
+    for actual, target in zip(batch, expected):
+        torch.testing.assert_close(actual, target, rtol=1e-5, atol=1e-5)
+    for actual, target in zip(
+        _flatten(default_collate([dataset[i] for i in indices])), _flatten(expected)
+    ):
+        torch.testing.assert_close(actual, target, rtol=1e-5, atol=1e-5)
+
+
+def test_side_table_rebuilt_with_stat(mock_data_cfgs, monkeypatch):
+    """Mean precipitation saved in the side table should be read again when the statistics are"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    scale = {"value": 1.0}
+
+    def read_mean_prcp(self, basin_id, unit="mm/d"):
+        return self.ts[["prcp"]].sel(basin=basin_id).mean("time") * scale["value"]
+
+    monkeypatch.setattr(
+        SlicingMockDatasource, "read_mean_prcp", read_mean_prcp, raising=False
+    )
+    data_cfgs = mock_data_cfgs(
+        scaler_params={
+            "prcp_norm_cols": ["streamflow"],
+            "gamma_norm_cols": ["prcp"],
+            "pbm_norm": False,
+        }
+    )
+    mean_prcp = BaseDataset(data_cfgs, "train").target_scaler.mean_prcp
+    # the source data are updated
+    scale["value"] = 2.0
+    dataset = BaseDataset(data_cfgs, "train")
+    np.testing.assert_allclose(dataset.target_scaler.mean_prcp, 2 * mean_prcp)
+    np.testing.assert_allclose(
+        BaseDataset(data_cfgs, "test").target_scaler.mean_prcp, 2 * mean_prcp
+    )
+
+
+def test_dpl_dataset_borrows_train_dataset(mock_data_cfgs, monkeypatch):
+    """A test DplDataset with target_as_input should use the given training dataset
+    and build one only when it is needed if none is given"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(
+        warmup_length=0,
+        target_as_input=True,
+        constant_only=False,
+        scaler="StandardScaler",
+    )
+    train_dataset = DplDataset(data_cfgs, "train")
+    built = []
+    load_data = DplDataset._load_data
+
+    def counted_load_data(self):
+        built.append(self.is_tra_val_te)
+        load_data(self)
+
+    monkeypatch.setattr(DplDataset, "_load_data", counted_load_data)
+    dataset = DplDataset(data_cfgs, "test", train_dataset=train_dataset)
+    assert dataset.train_dataset is train_dataset
+    lazy_dataset = DplDataset(data_cfgs, "test")
+    assert built == ["test", "test"]
+    indices = [0, 1]
+    expected = lazy_dataset.__getitems__(indices)
+    assert built == ["test", "test", "train"]
+    for actual, target in zip(
+        _flatten(dataset.__getitems__(indices)), _flatten(expected)
+    ):
+        torch.testing.assert_close(actual, target)
+
+
+def test_kill_nan_report(tmp_path):
+    """Gaps should be filled as xarray's interpolate_na/fillna do, and NaN fractions are reported"""
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2001-01-01", periods=50)
+    x = xr.DataArray(
+        rng.random((2, 3, 50)),
+        dims=["variable", "basin", "time"],
+        coords={"variable": ["prcp", "pet"], "time": times},
+    )
+    x.values[rng.random(x.shape) < 0.3] = np.nan
+    y = x.isel(variable=[0]) * 2
+    c = xr.DataArray(
+        [[1.0, np.nan], [np.nan, np.nan], [3.0, np.nan]], dims=["basin", "variable"]
+    )
+    expected_x = xr.concat(
+        [x[i].interpolate_na(dim="time", fill_value="extrapolate") for i in range(2)],
+        dim="variable",
+    )
+    expected_fraction = np.isnan(x).mean("time").transpose("basin", "variable")
+    dataset = BaseDataset.__new__(BaseDataset)
+    dataset.data_cfgs = {
+        "relevant_rm_nan": True,
+        "target_rm_nan": False,
+        "constant_rm_nan": True,
+    }
+    with pytest.warns(UserWarning):
+        # the second attribute only has NaN values
+        dataset._kill_nan(x, y, c)
+    np.testing.assert_allclose(x, expected_x)
+    np.testing.assert_allclose(c, [[1.0, -1.0], [2.0, -1.0], [3.0, -1.0]])
+    # y is not filled
+    assert np.isnan(y).any()
+    np.testing.assert_allclose(dataset.nan_report["x"], expected_fraction)
+    np.testing.assert_allclose(dataset.nan_report["c"], [[0, 1], [1, 1], [0, 1]])
+
+
+class MultiFreqMockDatasource(SlicingMockDatasource):
+    """A mock data source with daily and 3-hourly data, which returns a dict keyed by time unit"""
+
+    def __init__(self, source_cfgs, time_unit="1D"):
+        super().__init__(source_cfgs, time_unit)
+        rng = np.random.default_rng(1)
+        times = pd.date_range("2001-01-01", "2001-03-01", freq="3h")
+        self.ts_3h = xr.Dataset(
+            {
+                var: (["basin", "time"], rng.random((self.ngrid, len(times))))
+                for var in ["prcp", "streamflow"]
+            },
+            coords={"basin": self.ts["basin"].values, "time": times},
+        )
+        for var in ["prcp", "streamflow"]:
+            self.ts_3h[var].attrs["units"] = "mm/3h"
+
+    def read_ts_xrdataset(self, basin_id, t_range, var_lst, time_units=("1D",)):
+        ts = {"1D": self.ts, "3h": self.ts_3h}
+        return {
+            unit: ts[unit][var_lst].sel(basin=basin_id, time=slice(*t_range))
+            for unit in time_units
+        }
+
+
+def _multi_freq_cfgs(mock_data_cfgs, **kwargs):
+    data_sources_dict.update({"multifreqmockdatasource": MultiFreqMockDatasource})
+    return mock_data_cfgs(
+        source_name="multifreqmockdatasource",
+        t_range_train=["2001-01-01", "2001-02-01"],
+        t_range_test=["2001-02-01", "2001-03-01"],
+        relevant_cols=["prcp", "pet", "surface_sm"],
+        target_cols=["streamflow"],
+        forecast_history=16,
+        warmup_length=0,
+        forecast_length=4,
+        min_time_unit="h",
+        min_time_interval=3,
+        scaler_params={
+            "prcp_norm_cols": [],
+            "gamma_norm_cols": ["prcp", "pet"],
+            "pbm_norm": False,
+        },
+        multi_freq_params={
+            "low_freq_unit": "1D",
+            "low_freq_cols": ["pet", "surface_sm"],
+            "low_freq_history": 5,
+        },
+        **kwargs,
+    )
+
+
+def test_multi_freq_dataset(mock_data_cfgs):
+    """Low-frequency windows should end with the last day ended by the end of the high-frequency window"""
+    data_cfgs = _multi_freq_cfgs(mock_data_cfgs)
+    MultiFreqDataset(data_cfgs, "train")
+    dataset = MultiFreqDataset(data_cfgs, "test")
+    high_times = dataset.times
+    low_times = pd.date_range("2001-02-01", "2001-03-01", freq="D")
+    assert dataset.x.shape == (2, len(high_times), 1)
+    assert dataset.x_low.shape == (2, len(low_times), 2)
+    for item in range(0, len(dataset), 17):
+        (x_low, x), y = dataset[item]
+        basin, time = dataset.lookup_table[item]
+        assert x.shape == (20, 3) and y.shape == (20, 1)
+        window_end = high_times[time + 19] + pd.Timedelta("3h")
+        low_end = np.count_nonzero(low_times + pd.Timedelta("1D") <= window_end)
+        np.testing.assert_array_equal(
+            x_low, dataset.x_low[basin, low_end - 5 : low_end]
+        )
+    # the first samples don't have 5 days before them
+    assert dataset.lookup_table.time.min() == 5 * 8 - 20
+    indices = list(range(0, len(dataset), 7))
+    batch = dataset.__getitems__(indices)
+    expected = default_collate([dataset[i] for i in indices])
+    for actual, target in zip(_flatten(batch), _flatten(expected)):
+        torch.testing.assert_close(actual, target)
+    (x_low, x), _ = batch
+    model = MultiFreqLSTM(2, 3, 1, 8)
+    out = model(x_low.transpose(0, 1), x.transpose(0, 1))
+    assert out.shape == (20, len(indices), 1)
+
+
+def test_multi_freq_scaler_store(tmp_path, mock_data_cfgs, monkeypatch):
+    """Statistics in the scaler store should have those of low-frequency inputs"""
+    data_cfgs = _multi_freq_cfgs(
+        mock_data_cfgs,
+        test_path=str(tmp_path / "member_0"),
+        scaler_store=True,
+        cache_dir=str(tmp_path / "cache"),
+    )
+    os.makedirs(data_cfgs["test_path"])
+    dataset = MultiFreqDataset(data_cfgs, "train")
+    (store_path,) = (tmp_path / "cache" / "scaler_store").iterdir()
+    with open(store_path / "dapengscaler_stat.json", "r") as fp:
+        assert {"pet", "surface_sm"} <= set(json.load(fp))
+
+    def no_stat(*args, **kwargs):
+        raise AssertionError("statistics should be loaded from the store")
+
+    monkeypatch.setattr(DapengScaler, "cal_stat_all", no_stat)
+    member_cfgs = {**data_cfgs, "test_path": str(tmp_path / "member_1")}
+    os.makedirs(member_cfgs["test_path"])
+    member_dataset = MultiFreqDataset(member_cfgs, "train")
+    for name in ["x", "y", "x_low"]:
+        np.testing.assert_array_equal(
+            getattr(member_dataset, name), getattr(dataset, name)
+        )
+    MultiFreqDataset(member_cfgs, "test")
+
+
+def test_share_memory(mock_data_cfgs):
+    """Arrays in shared memory should be attached by unpickled datasets and give same batches"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs()
+    dataset = BaseDataset(data_cfgs, "train")
+    expected = [dataset[i] for i in range(len(dataset))]
+    dataset.share_memory()
+    assert dataset._shared_tensors["x"].is_shared()
+    assert dataset.lookup_table._shared_tensors["basin"].is_shared()
+    buffer = io.BytesIO()
+    ForkingPickler(buffer).dump(dataset)
+    loaded = pickle.loads(buffer.getvalue())
+    for name in ["x", "y", "c"]:
+        assert isinstance(getattr(loaded, name), np.ndarray)
+    # the unpickled dataset sees writes to the shared memory
+    dataset.x[0, 0, 0] = 42.0
+    assert loaded.x[0, 0, 0] == 42.0
+    dataset.x[0, 0, 0] = expected[0][0][0, 0]
+    loader = DataLoader(
+        dataset,
+        batch_size=64,
+        num_workers=2,
+        collate_fn=get_collate_fn(dataset),
+    )
+    batches = [_flatten(batch) for batch in loader]
+    for i, batch in enumerate(batches):
+        target = _flatten(default_collate(expected[i * 64 : (i + 1) * 64]))
+        for actual, target_ in zip(batch, target):
+            torch.testing.assert_close(actual, target_)
+
+
+def test_load_profile(mock_data_cfgs):
+    """Each stage of loading a dataset should be recorded in its load_profile"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs()
+    dataset = BaseDataset(data_cfgs, "train")
+    profile = dataset.load_profile
+    assert set(profile) == {
+        "total",
+        "read_ts_xrdataset",
+        "check_ts_xrds_unit",
+        "read_attr_xrdataset",
+        "to_dataarray",
+        "normalize",
+        "kill_nan",
+        "trans2nparr",
+    }
+    # 2 basins, 366 days, 4 float64 variables
+    assert profile["read_ts_xrdataset"]["nbytes"] >= 2 * 366 * 4 * 8
+    for record in profile.values():
+        assert record["calls"] == 1
+        assert record["peak_rss_delta"] >= 0
+    stages_time = sum(
+        record["wall_time"] for stage, record in profile.items() if stage != "total"
+    )
+    assert stages_time <= profile["total"]["wall_time"]
+    # the lookup table is built when it is used at first
+    assert len(dataset) > 0
+    assert profile["create_lookup_table"]["calls"] == 1
+
+
+@pytest.mark.parametrize("dataset_cls", [BaseDataset, RaggedDataset])
+def test_random_window_sampler(mock_data_cfgs, dataset_cls):
+    """Windows drawn without the lookup table should be samples in it and gathered in the same way"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(target_rm_nan=False)
+    dataset = dataset_cls(data_cfgs, "train")
+    # targets of most windows starting in the first 100 days of the first basin are all NaN
+    if dataset_cls is BaseDataset:
+        dataset.y[0, :110] = np.nan
+    else:
+        dataset.y[:110] = np.nan
+    sampler = RandomWindowSampler(dataset, batch_size=32, num_batches=20)
+    loader = DataLoader(
+        dataset, batch_sampler=sampler, collate_fn=get_collate_fn(dataset)
+    )
+    batches = list(loader)
+    assert len(batches) == 20
+    assert batches[0][0].shape == (32, 24, 4)
+    # the lookup table is never built for drawing or gathering
+    assert dataset._lookup_table is None
+    windows = list(iter(sampler))
+    table = dataset.lookup_table
+    index = {window: i for i, window in table.items()}
+    for batch in windows[:5]:
+        indices = [index[window] for window in batch.values()]
+        for actual, target in zip(
+            _flatten(dataset.__getitems__(batch)),
+            _flatten(dataset.__getitems__(indices)),
+        ):
+            torch.testing.assert_close(actual, target, equal_nan=True)
+    drawn = {window for batch in windows for window in batch.values()}
+    assert drawn <= set(index)
+    assert len(drawn) > 100
+    device_loader = DeviceBatchLoader(dataset, 32, torch.device("cpu"), sampler=sampler)
+    assert len(device_loader) == 20
+    assert sum(xc.shape[0] for xc, _ in device_loader) == 20 * 32
+
+
+def test_basin_distributed_sampler(mock_data_cfgs):
+    """Ranks should get disjoint basins, iterate equally long and keep only their own basins"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(target_rm_nan=False)
+    assert [g.tolist() for g in balance_basins([5, 9, 4, 0, 3], 2)] == [[1, 4], [0, 2]]
+    full = BaseDataset(data_cfgs, "train")
+    # the first basin has fewer samples as its targets of the first 100 days are all NaN
+    full.y[0, :110] = np.nan
+    counts = np.bincount(full.lookup_table.basin, minlength=2)
+    assert counts[0] < counts[1]
+    samplers = [
+        BasinDistributedSampler(full, num_replicas=2, rank=rank) for rank in range(2)
+    ]
+    assert {int(s.basin_indices[0]) for s in samplers} == {0, 1}
+    assert len(samplers[0]) == len(samplers[1]) == counts.max()
+    for sampler in samplers:
+        basins = set(full.lookup_table.basin[list(sampler)].tolist())
+        assert basins == set(sampler.basin_indices.tolist())
+    sampler = samplers[0]
+    sampler.set_epoch(1)
+    epoch1 = list(sampler)
+    assert epoch1 == list(sampler)
+    sampler.set_epoch(2)
+    assert epoch1 != list(sampler)
+
+    sharded = BaseDataset(data_cfgs, "train")
+    sharded.y[0, :110] = np.nan
+    sampler = BasinDistributedSampler(
+        sharded, num_replicas=2, rank=0, shuffle=False, shard_dataset=True
+    )
+    basin = int(sampler.basin_indices[0])
+    assert sharded.ngrid == 1 and sharded.x.shape[0] == 1
+    assert sharded.basins == [data_cfgs["object_ids"][basin]]
+    assert len(sharded) == counts[basin]
+    full_indices = np.flatnonzero(full.lookup_table.basin == basin)[:8]
+    for actual, target in zip(
+        _flatten(sharded.__getitems__(list(sampler)[:8])),
+        _flatten(full.__getitems__(full_indices)),
+    ):
+        torch.testing.assert_close(actual, target, equal_nan=True)
+
+
+@pytest.mark.parametrize("normalize_on_batch", [False, True])
+def test_shard_releases_shared_read(mock_data_cfgs, normalize_on_batch):
+    """After sharding, raw data of the other basins read for all datasets should be released"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(
+        t_range_valid=["2002-01-01", "2002-06-01"],
+        t_range_test=["2002-06-01", "2003-01-01"],
+        normalize_on_batch=normalize_on_batch,
+    )
+    shared_read = SharedPeriodRead(data_cfgs)
+    dataset = BaseDataset(data_cfgs, "train", shared_read=shared_read)
+    raw_refs = [weakref.ref(data.values) for data in shared_read.data[:2]]
+    del shared_read
+    sampler = BasinDistributedSampler(
+        dataset, num_replicas=2, rank=1, shard_dataset=True
+    )
+    gc.collect()
+    assert dataset.shared_read is None
+    assert all(ref() is None for ref in raw_refs)
+    assert dataset.target_scaler.data_target.sizes["basin"] == 1
+    assert len(list(sampler)) == len(sampler)
+    dataset.__getitems__(list(sampler)[:4])
+
+
+@pytest.mark.parametrize("consecutive", [False, True])
+def test_basin_batch_sampler(mock_data_cfgs, consecutive):
+    """Each batch should come from one basin and all samples should be drawn once in an epoch"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(target_rm_nan=False, batch_size=32)
+    dataset = BaseDataset(data_cfgs, "train")
+    sampler = BasinBatchSampler(
+        dataset, consecutive=consecutive, generator=torch.Generator().manual_seed(0)
+    )
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(idx for batch in batches for idx in batch) == list(
+        range(len(dataset))
+    )
+    table = dataset.lookup_table
+    basin_order = []
+    for batch in batches:
+        assert 0 < len(batch) <= 32
+        basins = set(table.basin[batch].tolist())
+        assert len(basins) == 1
+        if not basin_order or basin_order[-1] != basins.pop():
+            basin_order.append(int(table.basin[batch[0]]))
+        if consecutive:
+            assert batch == list(range(batch[0], batch[0] + len(batch)))
+    # all batches of a basin are drawn before the next basin
+    assert sorted(basin_order) == [0, 1]
+    loader = DataLoader(
+        dataset, batch_sampler=sampler, collate_fn=get_collate_fn(dataset)
+    )
+    assert sum(xc.shape[0] for xc, _ in loader) == len(dataset)
+    ordered = BasinBatchSampler(dataset, consecutive=consecutive, shuffle=False)
+    assert [idx for batch in ordered for idx in batch] == list(range(len(dataset)))
+
+
+def test_loss_aware_sampler(mock_data_cfgs):
+    """Basins with larger losses should be drawn more often, with weights keeping losses unbiased"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(target_rm_nan=False)
+    dataset = BaseDataset(data_cfgs, "train")
+    sampler = LossAwareSampler(
+        dataset, batch_size=16, num_batches=400, temperature=1.0, uniform_mix=0.2
+    )
+    table = dataset.lookup_table
+    counts = np.bincount(table.basin, minlength=2)
+    uniform = counts / counts.sum()
+    # no loss is known in the first epoch, so it is uniform sampling
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 400
+    np.testing.assert_allclose(sampler.importance_weights(), 1.0)
+    for batch in batches:
+        assert len(batch) == 16
+        assert len(set(table.basin[batch].tolist())) == 1
+        basin, weight = sampler.pop_batch()
+        assert table.basin[batch[0]] == basin
+        sampler.update_loss(basin, 9.0 if basin == 0 else 1.0)
+    np.testing.assert_allclose(sampler.basin_loss, [9.0, 1.0])
+    batches = list(sampler)
+    probs = sampler.probabilities()
+    expected = 0.8 * counts * [9.0, 1.0] / np.sum(counts * [9.0, 1.0]) + 0.2 * uniform
+    np.testing.assert_allclose(probs, expected)
+    drawn = np.array([table.basin[batch[0]] for batch in batches])
+    assert abs(np.mean(drawn == 0) - probs[0]) < 0.1
+    # the expected weighted loss is the same as that of uniform sampling
+    weights = sampler.importance_weights()
+    losses = np.array([9.0, 1.0])
+    np.testing.assert_allclose(
+        np.sum(probs * weights * losses), np.sum(uniform * losses)
+    )
+    assert [sampler.pop_batch()[0] for _ in batches] == drawn.tolist()
+
+
+def test_loss_aware_sampler_out_of_core(mock_data_cfgs):
+    """LossAwareSampler wrapped for prefetching chunks of OutOfCoreDataset should still learn from losses"""
+    data_sources_dict.update({"slicingmockdatasource": SlicingMockDatasource})
+    data_cfgs = mock_data_cfgs(
+        out_of_core_params={"chunk_length": 50, "chunk_basins": 1}
+    )
+    dataset = OutOfCoreDataset(data_cfgs, "train")
+    sampler = LossAwareSampler(dataset, batch_size=8, num_batches=20)
+    loader = DataLoader(
+        dataset,
+        batch_sampler=PrefetchBatchSampler(sampler, dataset, lookahead=16),
+        collate_fn=get_collate_fn(dataset),
+    )
+    assert _loss_aware_sampler(loader) is sampler
+    table = dataset.lookup_table
+    for xc, _ in loader:
+        assert xc.shape[0] == 8
+        basin, _ = sampler.pop_batch()
+        sampler.update_loss(basin, 9.0 if basin == 0 else 1.0)
+    assert not np.isnan(sampler.basin_loss).any()
+    assert sampler.probabilities()[0] > np.bincount(table.basin)[0] / len(table)
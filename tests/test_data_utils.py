@@ -7,11 +7,18 @@ Description: Test the data utilities
 FilePath: \torchhydro\tests\test_data_utils.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
+
 import numpy as np
+import pandas as pd
 import pytest
 import xarray as xr
 
-from torchhydro.datasets.data_utils import warn_if_nan
+from torchhydro.datasets.data_utils import (
+    _prcp_norm_vars,
+    _trans_norm,
+    interpolate_nan,
+    warn_if_nan,
+)
 
 
 def test_warn_if_nan_no_nan_values():
@@ -52,3 +59,82 @@ def test_warn_if_nan_max_display():
         match=r"The dataarray contains 3 NaN values! Here are the indices of the first 2 NaNs:",
     ):
         warn_if_nan(da, max_display=2)
+
+
+def test_interpolate_nan_same_as_xarray():
+    # gaps inside and at both ends, series with one value and with no value
+    rng = np.random.default_rng(0)
+    data = rng.random((20, 100))
+    data[rng.random(data.shape) < 0.4] = np.nan
+    data[0, :] = np.nan
+    data[1, :] = np.nan
+    data[1, 50] = 1.0
+    da = xr.DataArray(
+        data.copy(),
+        dims=["basin", "time"],
+        coords={"time": pd.date_range("2001-01-01", periods=100)},
+    )
+    expected = np.stack(
+        [da[i].interpolate_na(dim="time", fill_value="extrapolate") for i in range(20)]
+    )
+    np.testing.assert_allclose(interpolate_nan(data), expected)
+
+
+def test_interpolate_nan_max_gap():
+    data = np.array([[np.nan, 1, np.nan, np.nan, 4, np.nan, np.nan, np.nan, 8, 9]])
+    nan_mask = np.isnan(data)
+    interpolate_nan(data, max_gap=2, nan_mask=nan_mask)
+    np.testing.assert_allclose(
+        data, [[0, 1, 2, 3, 4, np.nan, np.nan, np.nan, 8, 9]], equal_nan=True
+    )
+    # the mask marks NaN values left
+    assert nan_mask.sum() == 3
+
+
+@pytest.mark.parametrize(
+    "dims", [("basin", "time", "variable"), ("variable", "basin", "time")]
+)
+def test_trans_norm_same_as_per_variable(dims):
+    """The vectorized normalization should give the same values as normalizing variables one by one"""
+    rng = np.random.default_rng(0)
+    shape = [{"basin": 4, "time": 9, "variable": 3}[dim] for dim in dims]
+    x = xr.DataArray(
+        rng.gamma(2.0, 3.0, size=shape).astype(np.float32),
+        dims=dims,
+        coords={"variable": ["prcp", "pet", "streamflow"]},
+    )
+    stat_dict = {
+        "prcp": [0.0, 1.0, 0.3, 1.7],
+        "pet": [0.0, 1.0, 2.1, 0.9],
+        "streamflow": [0.0, 1.0, -1.2, 3.3],
+    }
+    log_norm_cols = ["prcp"]
+    norm = _trans_norm(x, ["prcp", "pet"], stat_dict, log_norm_cols=log_norm_cols)
+    assert norm.dims == x.dims and norm.dtype == np.float32
+    prcp = x.sel(variable="prcp")
+    np.testing.assert_array_equal(
+        norm.sel(variable="prcp"),
+        (np.log10(np.sqrt(np.abs(prcp)) + 0.1) - 0.3) / 1.7,
+    )
+    np.testing.assert_array_equal(
+        norm.sel(variable="pet"), (x.sel(variable="pet") - 2.1) / 0.9
+    )
+    # variables not in var_lst are NaN
+    assert norm.sel(variable="streamflow").isnull().all()
+    denorm = _trans_norm(
+        norm, ["prcp", "pet"], stat_dict, log_norm_cols=log_norm_cols, to_norm=False
+    )
+    np.testing.assert_allclose(
+        denorm.sel(variable=["prcp", "pet"]), x.sel(variable=["prcp", "pet"]), rtol=1e-4
+    )
+
+    mean_prcp = rng.gamma(2.0, 1.0, size=(4, 1))
+    prcp_normed = _prcp_norm_vars(x, ["streamflow"], mean_prcp, to_norm=True)
+    np.testing.assert_allclose(
+        prcp_normed.sel(variable="streamflow").transpose("basin", "time"),
+        x.sel(variable="streamflow").transpose("basin", "time") / mean_prcp,
+        rtol=1e-6,
+    )
+    np.testing.assert_array_equal(
+        prcp_normed.sel(variable="pet"), x.sel(variable="pet")
+    )
@@ -228,3 +228,13 @@ def test_get_sampler_invalid_sampler(deep_hydro, dummy_train_cfgs):
         NotImplementedError, match="Sampler InvalidSampler not implemented yet"
     ):
         deep_hydro._get_sampler(dummy_train_cfgs["data_cfgs"], deep_hydro.traindataset)
+
+
+def test_static_side_channel_model_check(dummy_train_cfgs):
+    datasets_dict["MockDataset"] = MockDataset
+    dummy_train_cfgs["data_cfgs"]["static_side_channel"] = True
+    # CpuLSTM takes the static attributes as its argument c
+    DeepHydro(dummy_train_cfgs)
+    dummy_train_cfgs["model_cfgs"]["model_name"] = "KuaiLSTMMultiOut"
+    with pytest.raises(NotImplementedError, match="static_side_channel"):
+        DeepHydro(dummy_train_cfgs)
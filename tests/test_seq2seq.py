@@ -59,3 +59,14 @@ def test_forward_with_teacher_forcing(model):
     trgs = torch.randn(3, 15, 2)
     outputs = model(src1, src2, trgs)
     assert outputs.shape == (3, 6, 2)
+
+
+def test_forward_static_side_channel(model):
+    # the last 2-d input is the static attributes, same as tiling them in both inputs
+    model.eval()
+    src1 = torch.randn(3, 10, 1)
+    src2 = torch.randn(3, 5, 0)
+    c = torch.randn(3, 1)
+    tiled1 = torch.cat([src1, c.unsqueeze(1).expand(-1, 10, -1)], dim=-1)
+    tiled2 = torch.cat([src2, c.unsqueeze(1).expand(-1, 5, -1)], dim=-1)
+    torch.testing.assert_close(model(src1, src2, c=c), model(tiled1, tiled2))
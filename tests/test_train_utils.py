@@ -1,6 +1,17 @@
+import json
 import os
+from types import SimpleNamespace
+import numpy as np
 import pytest
-from torchhydro.trainers.train_utils import read_pth_from_model_loader
+import torch
+from tests.test_data_scalers import denorm_scaler
+from torchhydro.models.cudnnlstm import CpuLstmModel
+from torchhydro.trainers.train_utils import (
+    evaluate_validation,
+    model_infer,
+    read_pth_from_model_loader,
+    time_to_metric_target,
+)
 
 
 def test_read_pth_from_model_loader_specified():
@@ -41,3 +52,61 @@ def test_read_pth_from_model_loader_invalid():
     model_pth_dir = "/path/to/models"
     with pytest.raises(ValueError, match="Invalid load_way"):
         read_pth_from_model_loader(model_loader, model_pth_dir)
+
+
+def test_time_to_metric_target(tmp_path):
+    logs = {
+        "data_cfgs": {"target_cols": ["streamflow"]},
+        "run": [
+            {
+                "epoch": epoch,
+                "train_seconds": 10.0,
+                "validation_metric": {"NSE of streamflow": nse},
+            }
+            for epoch, nse in [(1, [0.2, 0.4, 0.3]), (2, [0.5, 0.7, 0.6]), (3, [0.8])]
+        ],
+    }
+    with open(tmp_path / "log.json", "w") as f:
+        json.dump(logs, f)
+    assert time_to_metric_target(tmp_path, 0.6) == (2, 20.0)
+    assert time_to_metric_target(tmp_path, 0.3, stat="mean") == (1, 10.0)
+    assert time_to_metric_target(tmp_path, 0.9) is None
+
+
+def test_evaluate_validation_tensor(tmp_path):
+    """Metrics of tensors denormalized with torch ops should be same as those with xarray"""
+    scaler = denorm_scaler(tmp_path)
+    loader = SimpleNamespace(
+        dataset=SimpleNamespace(target_scaler=scaler, warmup_length=0), batch_size=3
+    )
+    rng = np.random.default_rng(0)
+    output = rng.standard_normal((3, 4, 3)).astype(np.float32)
+    labels = rng.standard_normal((3, 4, 3)).astype(np.float32)
+    evaluation_cfgs = {"fill_nan": "no", "metrics": ["NSE", "RMSE"], "rolling": False}
+    target_cols = scaler.data_cfgs["target_cols"]
+    expected = evaluate_validation(loader, output, labels, evaluation_cfgs, target_cols)
+    actual = evaluate_validation(
+        loader,
+        torch.from_numpy(output),
+        torch.from_numpy(labels),
+        evaluation_cfgs,
+        target_cols,
+    )
+    assert actual.keys() == expected.keys()
+    for key, value in expected.items():
+        np.testing.assert_allclose(actual[key], value, rtol=1e-4, err_msg=key)
+
+
+def test_model_infer_static_side_channel():
+    """Attributes of the side channel should be given to the model as its argument c"""
+    torch.manual_seed(0)
+    model = CpuLstmModel(n_input_features=5, n_output_features=1, n_hidden_states=8)
+    model.eval()
+    x = torch.randn(4, 10, 3)
+    c = torch.randn(4, 2)
+    y = torch.randn(4, 10, 1)
+    xc = torch.cat([x, c.unsqueeze(1).expand(-1, 10, -1)], dim=-1)
+    with torch.no_grad():
+        _, output = model_infer(True, "cpu", model, [x, c], y, True)
+        _, tiled_output = model_infer(True, "cpu", model, xc, y)
+    torch.testing.assert_close(output, tiled_output)
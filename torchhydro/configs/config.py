@@ -211,6 +211,50 @@ def default_config_file():
             "dataset": "StreamflowDataset",
             # sampler for pytorch dataloader, here we mainly use it for Kuai Fang's sampler in all his DL papers
             "sampler": None,
+            # other hyperparameters of the sampler, e.g. {"consecutive": True} for BasinBatchSampler
+            "sampler_hyperparam": {},
+            # if true, the preprocessed arrays of datasets are cached on disk and memory-mapped in later runs
+            "cache_dataset": False,
+            # directory of the dataset cache, if None, we use dataset_cache in CACHE_DIR
+            "cache_dir": None,
+            # if true, statistics of the training data are saved in a store keyed by basins, period,
+            # variables and scaler params (in cache_dir or CACHE_DIR) and reused by runs with the same
+            # training data, e.g. ensemble members and k-folds with different seeds or batch sizes
+            "scaler_store": False,
+            # dtype of the arrays in datasets; data is cast to it when read, statistics are still in float64
+            "dtype": "float32",
+            # if True, DeepHydro reads data of the union period of train/valid/test once
+            # and the datasets share time slices of it; the union period of all basins is
+            # then kept in memory for the whole run
+            "share_period_read": False,
+            # if True, constant (static) attributes are given to models as a separate input
+            # with shape (batch, attribute) instead of being tiled along the time dim;
+            # only for models whose forward takes it as the keyword argument c
+            # (KuaiLSTM, CpuLSTM, SimpleLSTMForecast, MultiFreqLSTM and Seq2Seq)
+            "static_side_channel": False,
+            # if True, only not normalized x and y are kept in memory and mini-batches are
+            # normalized with DapengScaler's statistics when they are gathered
+            "normalize_on_batch": False,
+            # the maximum number of consecutive NaN values filled by interpolation
+            # when relevant_rm_nan/target_rm_nan is True; None means all gaps are filled
+            "nan_max_gap": None,
+            # only for OutOfCoreDataset: time steps and basins in a chunk, number of chunks in the cache,
+            # number of upcoming batches whose chunks are prefetched and number of processes
+            # computing statistics chunk by chunk when there are no saved statistics
+            "out_of_core_params": {
+                "chunk_length": 8760,
+                "chunk_basins": 100,
+                "cache_chunks": 32,
+                "prefetch_batches": 2,
+                "stat_workers": 0,
+            },
+            # only for MultiFreqDataset: time unit, variables in relevant_cols and
+            # window length (in low-frequency periods) of the low-frequency inputs
+            "multi_freq_params": {
+                "low_freq_unit": "1D",
+                "low_freq_cols": [],
+                "low_freq_history": 30,
+            },
         },
         "training_cfgs": {
             "master_addr": "localhost",
@@ -254,6 +298,12 @@ def default_config_file():
             "device": [0, 1, 2],
             "multi_targets": 1,
             "num_workers": 0,
+            # if true, the train/valid datasets are held as tensors on device and
+            # batches are gathered by index tensors without a torch DataLoader
+            "device_dataset": False,
+            # if true and num_workers > 0, arrays of the train/valid datasets are moved into
+            # shared memory, so DataLoader workers don't hold their own copies
+            "share_memory": False,
             "which_first_tensor": "sequence",
             # for ensemble exp:
             # basically we set kfold/seeds/hyper_params for trianing such as batch_sizes
@@ -366,6 +416,19 @@ def cmd(
     patience=None,
     min_time_unit=None,
     min_time_interval=None,
+    cache_dataset=None,
+    cache_dir=None,
+    scaler_store=None,
+    dtype=None,
+    device_dataset=None,
+    share_memory=None,
+    out_of_core_params=None,
+    multi_freq_params=None,
+    sampler_hyperparam=None,
+    share_period_read=None,
+    static_side_channel=None,
+    normalize_on_batch=None,
+    nan_max_gap=None,
 ):
     """input args from cmd"""
     parser = argparse.ArgumentParser(
@@ -405,7 +468,7 @@ def cmd(
     parser.add_argument(
         "--sampler",
         dest="sampler",
-        help="None or KuaiSampler",
+        help="None, KuaiSampler, BasinBatchSampler, RandomWindowSampler, LossAwareSampler or DistSampler (for DDP_MTL)",
         default=sampler,
         type=str,
     )
@@ -831,6 +894,97 @@ def cmd(
         default=min_time_interval,
         type=int,
     )
+    parser.add_argument(
+        "--cache_dataset",
+        dest="cache_dataset",
+        help="if 1, cache the preprocessed data of datasets on disk and memory-map them in later runs",
+        default=cache_dataset,
+        type=int,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        dest="cache_dir",
+        help="The directory of the dataset cache",
+        default=cache_dir,
+        type=str,
+    )
+    parser.add_argument(
+        "--scaler_store",
+        dest="scaler_store",
+        help="if 1, reuse statistics of the same training data saved in the scaler store",
+        default=scaler_store,
+        type=int,
+    )
+    parser.add_argument(
+        "--dtype",
+        dest="dtype",
+        help="The dtype of data in datasets, such as float32 or float64",
+        default=dtype,
+        type=str,
+    )
+    parser.add_argument(
+        "--share_period_read",
+        dest="share_period_read",
+        help="If 1, read data of the union period of train/valid/test once and share it",
+        default=share_period_read,
+        type=int,
+    )
+    parser.add_argument(
+        "--static_side_channel",
+        dest="static_side_channel",
+        help="If 1, give constant attributes to models as a separate input instead of tiling them",
+        default=static_side_channel,
+        type=int,
+    )
+    parser.add_argument(
+        "--normalize_on_batch",
+        dest="normalize_on_batch",
+        help="If 1, keep only not normalized data in datasets and normalize each mini-batch",
+        default=normalize_on_batch,
+        type=int,
+    )
+    parser.add_argument(
+        "--nan_max_gap",
+        dest="nan_max_gap",
+        help="The maximum number of consecutive NaN values filled by interpolation",
+        default=nan_max_gap,
+        type=int,
+    )
+    parser.add_argument(
+        "--out_of_core_params",
+        dest="out_of_core_params",
+        help="Chunk and cache parameters of OutOfCoreDataset",
+        default=out_of_core_params,
+        type=json.loads,
+    )
+    parser.add_argument(
+        "--sampler_hyperparam",
+        dest="sampler_hyperparam",
+        help="Other hyperparameters of the sampler, such as consecutive of BasinBatchSampler",
+        default=sampler_hyperparam,
+        type=json.loads,
+    )
+    parser.add_argument(
+        "--multi_freq_params",
+        dest="multi_freq_params",
+        help="Low-frequency inputs of MultiFreqDataset",
+        default=multi_freq_params,
+        type=json.loads,
+    )
+    parser.add_argument(
+        "--device_dataset",
+        dest="device_dataset",
+        help="if 1, hold the whole train/valid datasets on device and gather batches there",
+        default=device_dataset,
+        type=int,
+    )
+    parser.add_argument(
+        "--share_memory",
+        dest="share_memory",
+        help="if 1, move arrays of the train/valid datasets into shared memory for DataLoader workers",
+        default=share_memory,
+        type=int,
+    )
     # To make pytest work in PyCharm, here we use the following code instead of "args = parser.parse_args()":
     # https://blog.csdn.net/u014742995/article/details/100119905
     args, unknown = parser.parse_known_args()
@@ -1035,6 +1189,38 @@ def update_cfg(cfg_file, new_args):
         cfg_file["data_cfgs"]["min_time_unit"] = new_args.min_time_unit
     if new_args.min_time_interval is not None:
         cfg_file["data_cfgs"]["min_time_interval"] = new_args.min_time_interval
+    if new_args.cache_dataset is not None:
+        cfg_file["data_cfgs"]["cache_dataset"] = bool(new_args.cache_dataset != 0)
+    if new_args.cache_dir is not None:
+        cfg_file["data_cfgs"]["cache_dir"] = new_args.cache_dir
+    if new_args.scaler_store is not None:
+        cfg_file["data_cfgs"]["scaler_store"] = bool(new_args.scaler_store != 0)
+    if new_args.dtype is not None:
+        cfg_file["data_cfgs"]["dtype"] = new_args.dtype
+    if new_args.share_period_read is not None:
+        cfg_file["data_cfgs"]["share_period_read"] = bool(
+            new_args.share_period_read != 0
+        )
+    if new_args.static_side_channel is not None:
+        cfg_file["data_cfgs"]["static_side_channel"] = bool(
+            new_args.static_side_channel != 0
+        )
+    if new_args.normalize_on_batch is not None:
+        cfg_file["data_cfgs"]["normalize_on_batch"] = bool(
+            new_args.normalize_on_batch != 0
+        )
+    if new_args.nan_max_gap is not None:
+        cfg_file["data_cfgs"]["nan_max_gap"] = new_args.nan_max_gap
+    if new_args.out_of_core_params is not None:
+        cfg_file["data_cfgs"]["out_of_core_params"] = new_args.out_of_core_params
+    if new_args.sampler_hyperparam is not None:
+        cfg_file["data_cfgs"]["sampler_hyperparam"] = new_args.sampler_hyperparam
+    if new_args.multi_freq_params is not None:
+        cfg_file["data_cfgs"]["multi_freq_params"] = new_args.multi_freq_params
+    if new_args.device_dataset is not None:
+        cfg_file["training_cfgs"]["device_dataset"] = bool(new_args.device_dataset != 0)
+    if new_args.share_memory is not None:
+        cfg_file["training_cfgs"]["share_memory"] = bool(new_args.share_memory != 0)
     if new_args.metrics is not None:
         cfg_file["evaluation_cfgs"]["metrics"] = new_args.metrics
     if new_args.fill_nan is not None:
@@ -0,0 +1,284 @@
+"""
+Author: Wenyu Ouyang
+Date: 2024-11-12 10:02:31
+LastEditTime: 2024-11-12 10:02:31
+LastEditors: Wenyu Ouyang
+Description: An on-disk cache of preprocessed dataset arrays which are opened as memmaps
+FilePath: \torchhydro\torchhydro\datasets\data_cache.py
+Copyright (c) 2024-2024 Wenyu Ouyang. All rights reserved.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# these keys don't change the arrays of a dataset, so they are not in the fingerprint;
+# the time ranges are replaced with the final time range of the dataset's own mode
+NOT_FINGERPRINT_KEYS = {
+    "test_path",
+    "batch_size",
+    "sampler",
+    "sampler_hyperparam",
+    "cache_dataset",
+    "cache_dir",
+    "scaler_store",
+    "stat_dict_file",
+    "t_range_train",
+    "t_range_valid",
+    "t_range_test",
+}
+META_FILE = "meta.json"
+SCALER_DIR = "scaler"
+# per-basin quantities of the data source (mean precipitation, area), see BasinSideTable
+SIDE_TABLE_FILE = "basin_side_table.nc"
+# besides NOT_FINGERPRINT_KEYS, these keys only change what is done after the statistics
+# of the training data are calculated, so they are not in the fingerprint of the scaler store;
+# any other key, including ones added later, is in it
+NOT_SCALER_FINGERPRINT_KEYS = {
+    "validation_path",
+    "static_side_channel",
+    "normalize_on_batch",
+    "share_period_read",
+    "target_rm_nan",
+    "relevant_rm_nan",
+    "constant_rm_nan",
+}
+
+
+def scaler_stat_files(data_cfgs: dict) -> list:
+    """The files where ScalerHub saves statistics of the training period
+
+    Parameters
+    ----------
+    data_cfgs
+        configs for reading data
+
+    Returns
+    -------
+    list
+        paths of the files in test_path
+    """
+    if data_cfgs["scaler"] == "DapengScaler":
+        names = ["dapengscaler_stat.json"]
+    else:
+        # with scaler_store, scalers are saved in .npz files instead of .pkl ones
+        names = [
+            f"{key}_scaler.{ext}"
+            for ext in ["pkl", "npz"]
+            for key in ["target_vars", "relevant_vars", "constant_vars"]
+        ]
+    return [os.path.join(data_cfgs["test_path"], name) for name in names]
+
+
+def side_table_file(data_cfgs: dict) -> str:
+    """The file where BasinSideTable saves per-basin quantities next to the scaler statistics
+
+    It is saved with the dataset cache but not in the fingerprint, as it only depends on
+    the data source and basins, which are already in the configs.
+    """
+    return os.path.join(data_cfgs["test_path"], SIDE_TABLE_FILE)
+
+
+def dataset_fingerprint(
+    data_cfgs: dict, is_tra_val_te: str, t_s_dict: dict, dataset_name: str
+) -> str:
+    """A hash of everything in the configs that decides the arrays of a dataset
+
+    For valid/test (or when stat_dict_file is given), the data is normalized
+    with statistics read from files, so the content of these files is hashed, too.
+
+    Parameters
+    ----------
+    data_cfgs
+        configs for reading data
+    is_tra_val_te
+        train, valid or test
+    t_s_dict
+        basins and final time range of the dataset
+    dataset_name
+        name of the dataset class, as different datasets read data differently
+
+    Returns
+    -------
+    str
+        the fingerprint
+    """
+    cfgs = {k: v for k, v in data_cfgs.items() if k not in NOT_FINGERPRINT_KEYS}
+    cfgs["dataset_class"] = dataset_name
+    cfgs["is_tra_val_te"] = is_tra_val_te
+    cfgs["t_s_dict"] = dict(t_s_dict)
+    sha = hashlib.sha1(json.dumps(cfgs, sort_keys=True, default=str).encode())
+    if is_tra_val_te != "train" or data_cfgs["stat_dict_file"] is not None:
+        stat_files = (
+            [data_cfgs["stat_dict_file"]]
+            if data_cfgs["stat_dict_file"] is not None
+            else scaler_stat_files(data_cfgs)
+        )
+        for stat_file in stat_files:
+            if os.path.isfile(stat_file):
+                with open(stat_file, "rb") as fp:
+                    sha.update(fp.read())
+    return sha.hexdigest()
+
+
+def scaler_fingerprint(data_cfgs: dict, t_s_dict: dict, dataset_name: str) -> str:
+    """A hash of everything in the configs that may change the statistics of the training data,
+    i.e. all keys but NOT_FINGERPRINT_KEYS and NOT_SCALER_FINGERPRINT_KEYS, so basins, period,
+    variables, scaler params, dtype and nan_max_gap are in it, but not the seeds or batch sizes
+    which ensemble members and k-folds differ in
+
+    Parameters
+    ----------
+    data_cfgs
+        configs for reading data
+    t_s_dict
+        basins and final time range of the training dataset
+    dataset_name
+        name of the dataset class, as different datasets read data differently
+
+    Returns
+    -------
+    str
+        the fingerprint
+    """
+    cfgs = {
+        k: v
+        for k, v in data_cfgs.items()
+        if k not in NOT_FINGERPRINT_KEYS | NOT_SCALER_FINGERPRINT_KEYS
+    }
+    cfgs["dataset_class"] = dataset_name
+    cfgs["t_s_dict"] = dict(t_s_dict)
+    return hashlib.sha1(
+        json.dumps(cfgs, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def save_scaler_store(store_path, files: list):
+    """Save files of scaler statistics in the scaler store
+
+    The store only keeps non-pickle files (json, npz and netCDF), so they are safe
+    to be loaded by any process; like save_dataset_cache, the files are written in a
+    temporary directory which is renamed at last, and the first saved one wins.
+
+    Parameters
+    ----------
+    store_path
+        directory of the statistics in the store, see scaler_fingerprint
+    files
+        files of scaler statistics; those not existing are skipped
+    """
+    store_path = str(store_path)
+    if os.path.isdir(store_path):
+        return
+    tmp_path = f"{store_path}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_path)
+    try:
+        for file in files:
+            if os.path.isfile(file):
+                shutil.copy(file, tmp_path)
+        os.rename(tmp_path, store_path)
+    except OSError as e:
+        # e.g. another process has saved the same statistics
+        LOGGER.warning(f"Scaler statistics are not saved in {store_path}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_scaler_store(store_path, test_path) -> bool:
+    """Copy statistics saved by save_scaler_store to test_path, where scalers read them
+
+    Parameters
+    ----------
+    store_path
+        directory of the statistics in the store
+    test_path
+        where the scaler statistics are needed
+
+    Returns
+    -------
+    bool
+        False if there are no statistics in the store
+    """
+    if not os.path.isdir(store_path):
+        return False
+    for file in os.listdir(store_path):
+        shutil.copy(os.path.join(store_path, file), test_path)
+    LOGGER.info(f"Load scaler statistics from {store_path}")
+    return True
+
+
+def save_dataset_cache(cache_path, arrays: dict, meta: dict, stat_files: list):
+    """Save arrays of a dataset as .npy files in cache_path
+
+    The files are written in a temporary directory which is renamed at last,
+    so a half-written cache is never read by other processes.
+
+    Parameters
+    ----------
+    cache_path
+        directory of the cache
+    arrays
+        name -> np.ndarray
+    meta
+        other json-serializable information of the dataset
+    stat_files
+        files of scaler statistics to be saved together with the arrays
+    """
+    cache_path = str(cache_path)
+    tmp_path = f"{cache_path}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(os.path.join(tmp_path, SCALER_DIR))
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), arr, allow_pickle=False)
+        for stat_file in stat_files:
+            if os.path.isfile(stat_file):
+                shutil.copy(stat_file, os.path.join(tmp_path, SCALER_DIR))
+        meta = {**meta, "arrays": list(arrays.keys())}
+        with open(os.path.join(tmp_path, META_FILE), "w") as fp:
+            json.dump(meta, fp)
+        os.rename(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError) as e:
+        # e.g. another process has written the same cache, or some arrays are not numeric
+        LOGGER.warning(f"Dataset cache is not saved in {cache_path}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_dataset_cache(cache_path, test_path):
+    """Open arrays of a dataset cached by save_dataset_cache
+
+    The arrays are memory-mapped read-only, so they are read lazily and shared by
+    processes through the page cache; they are final arrays, e.g. gaps are filled
+    before they are saved, so a dataset never modifies them.
+    Saved scaler statistics are copied to test_path just like ScalerHub does.
+
+    Parameters
+    ----------
+    cache_path
+        directory of the cache
+    test_path
+        where the scaler statistics are needed
+
+    Returns
+    -------
+    tuple[dict, dict] or None
+        arrays and meta; None if there is no cache
+    """
+    meta_file = os.path.join(cache_path, META_FILE)
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file, "r") as fp:
+        meta = json.load(fp)
+    arrays = {
+        name: np.load(os.path.join(cache_path, f"{name}.npy"), mmap_mode="r")
+        for name in meta["arrays"]
+    }
+    scaler_dir = os.path.join(cache_path, SCALER_DIR)
+    for stat_file in os.listdir(scaler_dir):
+        shutil.copy(os.path.join(scaler_dir, stat_file), test_path)
+    return arrays, meta
@@ -13,11 +13,13 @@ from torchhydro.datasets.data_sets import (
     BasinSingleFlowDataset,
     DplDataset,
     FlexibleDataset,
+    MultiFreqDataset,
+    OutOfCoreDataset,
+    RaggedDataset,
     Seq2SeqDataset,
     TransformerDataset,
 )
 
-
 datasets_dict = {
     "StreamflowDataset": BaseDataset,
     "SingleflowDataset": BasinSingleFlowDataset,
@@ -25,4 +27,7 @@ datasets_dict = {
     "FlexDataset": FlexibleDataset,
     "Seq2SeqDataset": Seq2SeqDataset,
     "TransformerDataset": TransformerDataset,
+    "OutOfCoreDataset": OutOfCoreDataset,
+    "RaggedDataset": RaggedDataset,
+    "MultiFreqDataset": MultiFreqDataset,
 }
@@ -9,21 +9,22 @@ Copyright (c) 2024-2024 Wenyu Ouyang. All rights reserved.
 """
 
 import copy
+import functools
+import hashlib
+import importlib
 import json
+import logging
 import os
 import pickle as pkl
 import shutil
+import uuid
 from typing import Optional
 import pint_xarray  # noqa: F401
+import torch
 import xarray as xr
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from shutil import SameFileError
-from sklearn.preprocessing import (
-    StandardScaler,
-    RobustScaler,
-    MinMaxScaler,
-    MaxAbsScaler,
-)
 
 from hydroutils.hydro_stat import (
     cal_stat_prcp_norm,
@@ -32,21 +33,566 @@ from hydroutils.hydro_stat import (
     cal_4_stat_inds,
 )
 
+from torchhydro.datasets.data_cache import (
+    load_scaler_store,
+    save_scaler_store,
+    side_table_file,
+)
 from torchhydro.datasets.data_utils import (
     _trans_norm,
-    _prcp_norm,
+    _prcp_norm_vars,
     wrap_t_s_dict,
     unify_streamflow_unit,
 )
 
+LOGGER = logging.getLogger(__name__)
+
+# name -> module of scalers; sklearn is only imported when a scaler is fitted (see _new_scaler),
+# so statistics saved in the scaler store are applied without it (see StoredScaler)
 SCALER_DICT = {
-    "StandardScaler": StandardScaler,
-    "RobustScaler": RobustScaler,
-    "MinMaxScaler": MinMaxScaler,
-    "MaxAbsScaler": MaxAbsScaler,
+    "StandardScaler": "sklearn.preprocessing",
+    "RobustScaler": "sklearn.preprocessing",
+    "MinMaxScaler": "sklearn.preprocessing",
+    "MaxAbsScaler": "sklearn.preprocessing",
 }
 
 
+def _new_scaler(name):
+    """A new scaler in SCALER_DICT"""
+    return getattr(importlib.import_module(SCALER_DICT[name]), name)()
+
+
+def _source_attrs(source_cfgs):
+    """source_name and source_path in source configs as attrs of a netCDF file"""
+    if source_cfgs is None:
+        return {}
+    attrs = {}
+    for key in ["source_name", "source_path"]:
+        value = source_cfgs.get(key)
+        attrs[key] = (
+            value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+        )
+    return attrs
+
+
+def _stat_attrs(stat_file):
+    """sha1 of the scaler statistics as an attr of a netCDF file; empty if there are none"""
+    if stat_file is None or not os.path.isfile(stat_file):
+        return {}
+    with open(stat_file, "rb") as fp:
+        return {"stat_sha1": hashlib.sha1(fp.read()).hexdigest()}
+
+
+class BasinSideTable(object):
+    """
+    Per-basin quantities read from a data source, i.e. mean precipitation and area,
+    read once and saved in a small netCDF file next to the scaler statistics
+
+    DapengScaler needs mean precipitation for normalizing and denormalizing targets,
+    and areas are used to convert units of streamflow; valid/test datasets and the denormalization
+    in every validation epoch then read them from the table rather than the data source.
+    Basins or units not in the table are read from the data source and added to it.
+    The table is keyed on source_name and source_path of its data source and on the sha1
+    of the statistics it is saved with; a table with other keys is not used but rebuilt.
+    When the statistics of the training data are calculated, DapengScaler starts a new table
+    (see rebuild), so updated source data are read again. The file is only ever replaced
+    atomically, so processes sharing a test_path always read a whole table.
+    """
+
+    def __init__(self, file, data_source=None, source_cfgs=None, stat_file=None):
+        """
+        Parameters
+        ----------
+        file
+            path of the netCDF file, see data_cache.side_table_file
+        data_source
+            data source to read quantities which are not in the table yet
+        source_cfgs
+            configs of the data source; if given, a table of another data source is not used
+        stat_file
+            file of the scaler statistics, see data_cache.scaler_stat_files;
+            if it exists, a table saved with other statistics is not used
+        """
+        self.file = file
+        self.data_source = data_source
+        self.source_attrs = _source_attrs(source_cfgs)
+        self.stat_file = stat_file
+        # True while the statistics of a rebuilt table are being calculated
+        self._stat_pending = False
+        self._table = None
+
+    def _key_attrs(self):
+        """attrs which the saved table must have to be used"""
+        if self._stat_pending:
+            return dict(self.source_attrs)
+        return {**self.source_attrs, **_stat_attrs(self.stat_file)}
+
+    @property
+    def table(self) -> xr.Dataset:
+        if self._table is None:
+            if os.path.isfile(self.file):
+                with xr.open_dataset(self.file) as ds:
+                    self._table = ds.load()
+                if any(
+                    self._table.attrs.get(key) != value
+                    for key, value in self._key_attrs().items()
+                ):
+                    LOGGER.info(
+                        f"The basin side table {self.file} is of another data source "
+                        "or other statistics, it is rebuilt"
+                    )
+                    self._table = None
+            if self._table is None:
+                self._table = xr.Dataset(coords={"basin": []})
+        return self._table
+
+    def rebuild(self):
+        """Start a new table for statistics which are being calculated, so quantities are read
+        from the data source again; the saved table is replaced when the new one is saved,
+        so other processes still could read it until then. Call save_with_stat after
+        the statistics are saved.
+        """
+        self._table = xr.Dataset(coords={"basin": []})
+        self._stat_pending = True
+
+    def save_with_stat(self):
+        """Key the table on the statistics in stat_file, which are saved now, and save it"""
+        self._stat_pending = False
+        if self._table is not None and self._table.data_vars:
+            self._save(self._table)
+
+    def _lookup(self, name, basin_ids, units=None):
+        """values of a quantity for basins from the table; None if any of them is missing"""
+        table = self.table
+        if name not in table or not set(basin_ids) <= set(table["basin"].values):
+            return None
+        da = table[name]
+        if units is not None and da.attrs.get("units") != units:
+            return None
+        da = da.sel(basin=basin_ids)
+        return None if da.isnull().any() else da
+
+    def _add(self, da: xr.DataArray):
+        """Add a quantity of some basins to the table and save the table"""
+        table = self.table
+        if da.name in table and table[da.name].attrs.get("units") != da.attrs.get(
+            "units"
+        ):
+            # values in another unit are replaced
+            table = table.drop_vars(da.name)
+        if table.data_vars:
+            table = da.to_dataset().combine_first(table)
+        else:
+            table = da.to_dataset()
+        table[da.name].attrs = da.attrs
+        self._save(table)
+
+    def _save(self, table: xr.Dataset):
+        """Save the table in a temporary file which atomically replaces the saved one"""
+        attrs = {k: v for k, v in table.attrs.items() if k != "stat_sha1"}
+        table.attrs = {**attrs, **self._key_attrs()}
+        self._table = table
+        os.makedirs(os.path.dirname(os.path.abspath(self.file)), exist_ok=True)
+        tmp_file = f"{self.file}.tmp-{uuid.uuid4().hex}"
+        try:
+            table.to_netcdf(tmp_file)
+            os.replace(tmp_file, self.file)
+        except (OSError, ValueError) as e:
+            # the table is still kept in memory
+            LOGGER.warning(f"The basin side table is not saved in {self.file}: {e}")
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    def _source(self, name):
+        if self.data_source is None:
+            raise ValueError(
+                f"{name} of some basins are not in {self.file} and there is no data source to read them"
+            )
+        return self.data_source
+
+    def mean_prcp(self, basin_ids, unit) -> np.ndarray:
+        """Mean precipitation of basins in unit, see DapengScaler.mean_prcp
+
+        Returns
+        -------
+        np.ndarray
+            mean_prcp with shape (basin, 1)
+        """
+        basin_ids = list(basin_ids)
+        da = self._lookup("mean_prcp", basin_ids, units=unit)
+        if da is None:
+            mean_prcp = self._source("mean_prcp").read_mean_prcp(basin_ids, unit=unit)
+            values = mean_prcp.to_array().transpose("basin", "variable").to_numpy()
+            da = xr.DataArray(
+                values[:, 0],
+                dims=["basin"],
+                coords={"basin": basin_ids},
+                name="mean_prcp",
+                attrs={"units": unit},
+            )
+            self._add(da)
+        return da.to_numpy()[:, None]
+
+    def area(self, basin_ids) -> xr.Dataset:
+        """Areas of basins in the same format as read_area of the data source
+
+        Returns
+        -------
+        xr.Dataset
+            the area variable with its units
+        """
+        basin_ids = list(basin_ids)
+        da = self._lookup("area", basin_ids)
+        if da is None:
+            area = self._source("area").read_area(basin_ids)
+            area_name = list(area.data_vars)[0]
+            da = area[area_name].rename("area")
+            da.attrs = {**area[area_name].attrs, "variable_name": area_name}
+            self._add(da)
+        attrs = dict(da.attrs)
+        area = da.rename(attrs.pop("variable_name"))
+        area.attrs = attrs
+        return area.to_dataset()
+
+
+class StreamingStat(object):
+    """
+    Mergeable statistics of variables in DapengScaler's format, updated chunk by chunk
+
+    Means and standard deviations are accumulated with Welford/Chan's parallel algorithm,
+    so statistics of chunks (blocks of basins or time steps) computed in different processes,
+    or of new years of data, could be merged without reading the data again.
+    p10 and p90 are computed from a uniform random sample of at most sample_size values
+    (a bottom-k sample with random keys, which is mergeable too),
+    so they are exact only if there are not more values than sample_size.
+    """
+
+    def __init__(self, variables, gamma_cols=None, sample_size=100000, seed=0):
+        """
+        Parameters
+        ----------
+        variables
+            names of variables, which are the last dim of data in update
+        gamma_cols
+            variables whose statistics are computed after log10(sqrt(x) + 0.1),
+            like cal_stat_gamma
+        sample_size
+            the max number of values of each variable kept for percentiles
+        seed
+            seed of random keys of values; give chunks different seeds
+        """
+        self.variables = list(variables)
+        self.gamma = np.isin(self.variables, gamma_cols or [])
+        self.sample_size = sample_size
+        self._rng = np.random.default_rng(seed)
+        nvar = len(self.variables)
+        self.count = np.zeros(nvar, dtype=np.int64)
+        self.mean = np.zeros(nvar)
+        self.m2 = np.zeros(nvar)
+        self._keys = [np.empty(0) for _ in range(nvar)]
+        self._samples = [np.empty(0) for _ in range(nvar)]
+
+    def update(self, data):
+        """Add values of a chunk; NaN values are skipped
+
+        Parameters
+        ----------
+        data
+            np.ndarray whose last dim is variables
+        """
+        values = np.asarray(data, dtype=np.float64).reshape(-1, len(self.variables))
+        if self.gamma.any():
+            values = values.copy()
+            values[:, self.gamma] = np.log10(np.sqrt(values[:, self.gamma]) + 0.1)
+        notnan = ~np.isnan(values)
+        count = notnan.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, np.nansum(values, axis=0) / count, 0.0)
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+        self._merge_moments(count, mean, m2)
+        for i in range(len(self.variables)):
+            sample = values[notnan[:, i], i]
+            self._merge_sample(i, self._rng.random(sample.size), sample)
+        return self
+
+    def merge(self, other: "StreamingStat"):
+        """Merge statistics of another part of the data into this one
+
+        Returns
+        -------
+        StreamingStat
+            self
+        """
+        if other.variables != self.variables or (other.gamma != self.gamma).any():
+            raise ValueError("Only statistics of the same variables could be merged")
+        self._merge_moments(other.count, other.mean, other.m2)
+        for i in range(len(self.variables)):
+            self._merge_sample(i, other._keys[i], other._samples[i])
+        return self
+
+    def _merge_moments(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratio = np.where(total > 0, count / total, 0.0)
+        self.mean = self.mean + delta * ratio
+        self.m2 = self.m2 + m2 + delta**2 * self.count * ratio
+        self.count = total
+
+    def _merge_sample(self, i, keys, sample):
+        keys = np.concatenate([self._keys[i], keys])
+        sample = np.concatenate([self._samples[i], sample])
+        if keys.size > self.sample_size:
+            kept = np.argpartition(keys, self.sample_size)[: self.sample_size]
+            keys, sample = keys[kept], sample[kept]
+        self._keys[i], self._samples[i] = keys, sample
+
+    def stat_dict(self) -> dict:
+        """
+        Statistics in the same format as DapengScaler.stat_dict
+
+        Returns
+        -------
+        dict
+            variable -> [p10, p90, mean, std]
+        """
+        stat_dict = {}
+        for i, var in enumerate(self.variables):
+            if self.count[i] == 0:
+                # same as cal_stat for all-NaN data
+                stat_dict[var] = cal_4_stat_inds(np.array([0.0]))
+                continue
+            p10, p90 = np.percentile(self._samples[i], [10, 90])
+            std = float(np.sqrt(self.m2[i] / self.count[i]))
+            if std < 0.001:
+                std = 1
+            stat_dict[var] = [float(p10), float(p90), float(self.mean[i]), std]
+        return stat_dict
+
+    def save(self, file):
+        """Save the state to a .npz file, so that statistics could be updated with new data later"""
+        np.savez(
+            file,
+            variables=np.array(self.variables, dtype=str),
+            gamma=self.gamma,
+            sample_size=self.sample_size,
+            count=self.count,
+            mean=self.mean,
+            m2=self.m2,
+            sample_lengths=[sample.size for sample in self._samples],
+            keys=np.concatenate(self._keys),
+            samples=np.concatenate(self._samples),
+        )
+
+    @classmethod
+    def load(cls, file, seed=0):
+        """Load a state saved by save; seed is for keys of values added later"""
+        with np.load(file) as state:
+            variables = state["variables"].tolist()
+            stat = cls(
+                variables,
+                gamma_cols=[v for v, g in zip(variables, state["gamma"]) if g],
+                sample_size=int(state["sample_size"]),
+                seed=seed,
+            )
+            stat.count, stat.mean, stat.m2 = state["count"], state["mean"], state["m2"]
+            splits = np.cumsum(state["sample_lengths"])[:-1]
+            stat._keys = np.split(state["keys"], splits)
+            stat._samples = np.split(state["samples"], splits)
+        return stat
+
+
+class ChunkCounts(object):
+    """Per-chunk arrays, e.g. counts of non-NaN values, returned by a chunk_stat of
+    cal_stat_chunks beside StreamingStat and merged in the same way
+    """
+
+    def __init__(self, counts: Optional[dict] = None):
+        """
+        Parameters
+        ----------
+        counts
+            key of a chunk -> its array
+        """
+        self.counts = {} if counts is None else counts
+
+    def merge(self, other: "ChunkCounts"):
+        """Add arrays of other chunks into this one
+
+        Returns
+        -------
+        ChunkCounts
+            self
+        """
+        self.counts.update(other.counts)
+        return self
+
+
+def _stat_of_chunks(chunk_stat, keys):
+    stats = None
+    for key in keys:
+        chunk = chunk_stat(key)
+        stats = chunk if stats is None else merge_stats(stats, chunk)
+    return stats
+
+
+def merge_stats(stats, others):
+    """Merge two lists of StreamingStat element by element"""
+    return [stat.merge(other) for stat, other in zip(stats, others)]
+
+
+def cal_stat_chunks(chunk_stat, keys, num_workers=0):
+    """
+    Statistics of all chunks, computed in worker processes and merged
+
+    Parameters
+    ----------
+    chunk_stat
+        a picklable callable which reads a chunk by its key and
+        returns a list of StreamingStat of it, e.g. one for targets and one for inputs,
+        and possibly ChunkCounts of it
+    keys
+        keys of all chunks
+    num_workers
+        the number of worker processes; 0 means the chunks are read in this process
+
+    Returns
+    -------
+    list
+        merged StreamingStat (and ChunkCounts), in the same order as those of chunk_stat
+    """
+    keys = list(keys)
+    if num_workers <= 0 or len(keys) < 2:
+        return _stat_of_chunks(chunk_stat, keys)
+    num_workers = min(num_workers, len(keys))
+    groups = [keys[i::num_workers] for i in range(num_workers)]
+    with ProcessPoolExecutor(num_workers) as pool:
+        partials = list(pool.map(_stat_of_chunks, [chunk_stat] * num_workers, groups))
+    return functools.reduce(merge_stats, partials)
+
+
+def save_sklearn_scaler(scaler, file):
+    """Save the fitted attributes of a scaler in SCALER_DICT to a .npz file without pickle
+
+    Parameters
+    ----------
+    scaler
+        a fitted scaler, e.g. StandardScaler
+    file
+        path of the .npz file
+    """
+    name = type(scaler).__name__
+    fitted = {k: np.asarray(v) for k, v in vars(scaler).items() if k.endswith("_")}
+    np.savez(file, scaler_name=name, **fitted)
+
+
+class StoredScaler(object):
+    """A scaler in SCALER_DICT applied with the fitted attributes saved by save_sklearn_scaler,
+    so statistics in the scaler store are used without sklearn or pickle
+    """
+
+    def __init__(self, file):
+        """
+        Parameters
+        ----------
+        file
+            path of the .npz file
+        """
+        with np.load(file, allow_pickle=False) as fitted:
+            self.scaler_name = str(fitted["scaler_name"])
+            self.fitted = {k: fitted[k] for k in fitted.files if k != "scaler_name"}
+        # ScalerHub creates the scalers with default parameters, so all of them are
+        # fitted with scale_ and StandardScaler/RobustScaler are centered, too
+        self.center = {"StandardScaler": "mean_", "RobustScaler": "center_"}.get(
+            self.scaler_name
+        )
+
+    @staticmethod
+    def _copy(x):
+        # float32 data are kept in float32 as sklearn does
+        x = np.asarray(x)
+        return np.array(x, dtype=x.dtype if x.dtype.kind == "f" else np.float64)
+
+    def _param(self, name, x):
+        # StandardScaler casts its float64 parameters to the dtype of data
+        value = self.fitted[name]
+        return value.astype(x.dtype) if self.scaler_name == "StandardScaler" else value
+
+    def transform(self, x):
+        # the same operations as transform of the sklearn scaler, so results are identical
+        x = self._copy(x)
+        if self.scaler_name == "MinMaxScaler":
+            x *= self._param("scale_", x)
+            x += self._param("min_", x)
+            return x
+        if self.center is not None:
+            x -= self._param(self.center, x)
+        x /= self._param("scale_", x)
+        return x
+
+    def inverse_transform(self, x):
+        x = self._copy(x)
+        if self.scaler_name == "MinMaxScaler":
+            x -= self._param("min_", x)
+            x /= self._param("scale_", x)
+            return x
+        x *= self._param("scale_", x)
+        if self.center is not None:
+            x += self._param(self.center, x)
+        return x
+
+
+def load_fitted_scaler(save_file):
+    """Load a scaler of ScalerHub saved in test_path
+
+    Parameters
+    ----------
+    save_file
+        path of the .pkl file of the scaler; a .npz file with the same name, which is written
+        instead of the .pkl file with a scaler store, is read instead if it exists
+
+    Returns
+    -------
+    object
+        the fitted scaler, or a StoredScaler
+    """
+    npz_file = save_file.replace(".pkl", ".npz")
+    if os.path.isfile(npz_file):
+        return StoredScaler(npz_file)
+    with open(save_file, "rb") as infile:
+        return pkl.load(infile)
+
+
+def _save_fitted_scaler(scaler, save_file, without_pickle):
+    """Save a scaler of ScalerHub in test_path, see load_fitted_scaler
+
+    Parameters
+    ----------
+    scaler
+        the fitted scaler
+    save_file
+        path of the .pkl file of the scaler
+    without_pickle
+        if True, e.g. with a scaler store, the scaler is saved in a .npz file
+        by save_sklearn_scaler instead of the .pkl file
+    """
+    npz_file = save_file.replace(".pkl", ".npz")
+    if without_pickle:
+        save_sklearn_scaler(scaler, npz_file)
+        stale_file = save_file
+    else:
+        with open(save_file, "wb") as outfile:
+            pkl.dump(scaler, outfile)
+        stale_file = npz_file
+    # a file of another fit is not read instead of the new one
+    _remove_file(stale_file)
+
+
+def _remove_file(file):
+    if os.path.isfile(file):
+        os.remove(file)
+
+
 class ScalerHub(object):
     """
     A class for Scaler
@@ -60,6 +606,7 @@ class ScalerHub(object):
         data_cfgs: Optional[dict] = None,
         is_tra_val_te: Optional[str] = None,
         data_source: object = None,
+        scaler_store: Optional[str] = None,
         **kwargs,
     ):
         """
@@ -79,6 +626,12 @@ class ScalerHub(object):
             configs for reading data
         is_tra_val_te
             train, valid or test
+        data_source
+            data source to read mean_prcp for DapengScaler
+        scaler_store
+            directory in the scaler store for statistics of the same training data;
+            if given, statistics are loaded from it rather than calculated when it exists
+            and saved in it after they are calculated
         kwargs
             other optional parameters for ScalerHub
         """
@@ -86,6 +639,7 @@ class ScalerHub(object):
         norm_keys = ["target_vars", "relevant_vars", "constant_vars"]
         norm_dict = {}
         scaler_type = data_cfgs["scaler"]
+        fit = is_tra_val_te == "train" and data_cfgs["stat_dict_file"] is None
         if scaler_type == "DapengScaler":
             gamma_norm_cols = data_cfgs["scaler_params"]["gamma_norm_cols"]
             prcp_norm_cols = data_cfgs["scaler_params"]["prcp_norm_cols"]
@@ -100,16 +654,25 @@ class ScalerHub(object):
                 gamma_norm_cols=gamma_norm_cols,
                 pbm_norm=pbm_norm,
                 data_source=data_source,
+                scaler_store=scaler_store,
             )
             x, y, c = scaler.load_data()
             self.target_scaler = scaler
 
         elif scaler_type in SCALER_DICT.keys():
             # TODO: not fully tested, espacially for pbm models
+            test_path = data_cfgs["test_path"]
+            if (
+                fit
+                and scaler_store is not None
+                and load_scaler_store(scaler_store, test_path)
+            ):
+                # scalers fitted with the same training data, saved without pickle,
+                # are read by load_fitted_scaler from the .npz files copied to test_path
+                fit = False
             all_vars = [target_vars, relevant_vars, constant_vars]
             for i in range(len(all_vars)):
                 data_tmp = all_vars[i]
-                scaler = SCALER_DICT[scaler_type]()
                 if data_tmp.ndim == 3:
                     # for forcings and outputs
                     num_instances, num_time_steps, num_features = data_tmp.transpose(
@@ -119,21 +682,17 @@ class ScalerHub(object):
                     save_file = os.path.join(
                         data_cfgs["test_path"], f"{norm_keys[i]}_scaler.pkl"
                     )
-                    if is_tra_val_te == "train" and data_cfgs["stat_dict_file"] is None:
+                    if fit:
+                        scaler = _new_scaler(scaler_type)
                         data_norm = scaler.fit_transform(data_tmp)
                         # Save scaler in test_path for valid/test
-                        with open(save_file, "wb") as outfile:
-                            pkl.dump(scaler, outfile)
+                        _save_fitted_scaler(scaler, save_file, scaler_store is not None)
                     else:
                         if data_cfgs["stat_dict_file"] is not None:
                             shutil.copy(data_cfgs["stat_dict_file"], save_file)
-                        if not os.path.isfile(save_file):
-                            raise FileNotFoundError(
-                                "Please genereate xx_scaler.pkl file"
-                            )
-                        with open(save_file, "rb") as infile:
-                            scaler = pkl.load(infile)
-                            data_norm = scaler.transform(data_tmp)
+                            _remove_file(save_file.replace(".pkl", ".npz"))
+                        scaler = load_fitted_scaler(save_file)
+                        data_norm = scaler.transform(data_tmp)
                     data_norm = data_norm.reshape(
                         num_instances, num_time_steps, num_features
                     )
@@ -142,21 +701,25 @@ class ScalerHub(object):
                     save_file = os.path.join(
                         data_cfgs["test_path"], f"{norm_keys[i]}_scaler.pkl"
                     )
-                    if is_tra_val_te == "train" and data_cfgs["stat_dict_file"] is None:
+                    if fit:
+                        scaler = _new_scaler(scaler_type)
                         data_norm = scaler.fit_transform(data_tmp)
                         # Save scaler in test_path for valid/test
-                        with open(save_file, "wb") as outfile:
-                            pkl.dump(scaler, outfile)
+                        _save_fitted_scaler(scaler, save_file, scaler_store is not None)
                     else:
                         if data_cfgs["stat_dict_file"] is not None:
                             shutil.copy(data_cfgs["stat_dict_file"], save_file)
-                        assert os.path.isfile(save_file)
-                        with open(save_file, "rb") as infile:
-                            scaler = pkl.load(infile)
-                            data_norm = scaler.transform(data_tmp)
+                            _remove_file(save_file.replace(".pkl", ".npz"))
+                        scaler = load_fitted_scaler(save_file)
+                        data_norm = scaler.transform(data_tmp)
                 norm_dict[norm_keys[i]] = data_norm
                 if i == 0:
                     self.target_scaler = scaler
+            if fit and scaler_store is not None:
+                save_scaler_store(
+                    scaler_store,
+                    [os.path.join(test_path, f"{key}_scaler.npz") for key in norm_keys],
+                )
             x_ = norm_dict["relevant_vars"]
             y_ = norm_dict["target_vars"]
             c_ = norm_dict["constant_vars"]
@@ -197,6 +760,58 @@ class ScalerHub(object):
         self.c = c
 
 
+def load_target_scaler(
+    data_cfgs: dict,
+    is_tra_val_te: str,
+    data_target: Optional[xr.DataArray] = None,
+    data_source: object = None,
+):
+    """
+    Rebuild the target scaler of ScalerHub from statistics saved in test_path,
+    without normalizing any data again
+
+    Parameters
+    ----------
+    data_cfgs
+        configs for reading data
+    is_tra_val_te
+        train, valid or test
+    data_target
+        not normalized output variables; DapengScaler needs it for denormalization
+    data_source
+        data source to read mean_prcp for DapengScaler
+
+    Returns
+    -------
+    object
+        the target scaler
+    """
+    scaler_type = data_cfgs["scaler"]
+    if scaler_type == "DapengScaler":
+        stat_file = os.path.join(data_cfgs["test_path"], "dapengscaler_stat.json")
+        with open(stat_file, "r") as fp:
+            stat_dict = json.load(fp)
+        return DapengScaler(
+            data_target,
+            None,
+            None,
+            data_cfgs,
+            is_tra_val_te,
+            prcp_norm_cols=data_cfgs["scaler_params"]["prcp_norm_cols"],
+            gamma_norm_cols=data_cfgs["scaler_params"]["gamma_norm_cols"],
+            pbm_norm=data_cfgs["scaler_params"]["pbm_norm"],
+            data_source=data_source,
+            stat_dict=stat_dict,
+        )
+    if scaler_type in SCALER_DICT.keys():
+        return load_fitted_scaler(
+            os.path.join(data_cfgs["test_path"], "target_vars_scaler.pkl")
+        )
+    raise NotImplementedError(
+        "We don't provide this Scaler now!!! Please choose another one: DapengScaler or key in SCALER_DICT"
+    )
+
+
 class DapengScaler(object):
     def __init__(
         self,
@@ -210,6 +825,8 @@ class DapengScaler(object):
         gamma_norm_cols=None,
         pbm_norm=False,
         data_source: object = None,
+        stat_dict: Optional[dict] = None,
+        scaler_store: Optional[str] = None,
     ):
         """
         The normalization and denormalization methods from Dapeng's 1st WRR paper.
@@ -235,6 +852,12 @@ class DapengScaler(object):
             data items which use log(\sqrt(x)+.1) method to normalize
         pbm_norm
             if true, use pbm_norm method to normalize; the output of pbms is not normalized data, so its inverse is different.
+        data_source
+            data source to read mean_prcp
+        stat_dict
+            statistics already known, if given, we don't calculate or load them again
+        scaler_store
+            directory in the scaler store for statistics of the same training data, see ScalerHub
         """
         if prcp_norm_cols is None:
             prcp_norm_cols = [
@@ -263,13 +886,37 @@ class DapengScaler(object):
         self.log_norm_cols = gamma_norm_cols + prcp_norm_cols
         self.pbm_norm = pbm_norm
         self.data_source = data_source
+        # parameter tensors of targets for inverse_transform_batch, by device
+        self._target_batch_params = {}
+        # mean_prcp is read from the data source once and saved next to the statistics
         # save stat_dict of training period in test_path for valid/test
         stat_file = os.path.join(data_cfgs["test_path"], "dapengscaler_stat.json")
+        self.side_table = BasinSideTable(
+            side_table_file(data_cfgs),
+            data_source,
+            data_cfgs.get("source_cfgs"),
+            stat_file,
+        )
         # for testing sometimes such as pub cases, we need stat_dict_file from trained dataset
-        if is_tra_val_te == "train" and data_cfgs["stat_dict_file"] is None:
+        if stat_dict is not None:
+            self.stat_dict = stat_dict
+        elif (
+            is_tra_val_te == "train"
+            and data_cfgs["stat_dict_file"] is None
+            and not (
+                scaler_store is not None
+                and load_scaler_store(scaler_store, data_cfgs["test_path"])
+            )
+        ):
+            # per-basin quantities are read again with the new statistics
+            self.side_table.rebuild()
             self.stat_dict = self.cal_stat_all()
             with open(stat_file, "w") as fp:
                 json.dump(self.stat_dict, fp)
+            self.side_table.save_with_stat()
+            if scaler_store is not None:
+                # mean_prcp in the side table is shared, too
+                save_scaler_store(scaler_store, [stat_file, side_table_file(data_cfgs)])
         else:
             # for valid/test, we need to load stat_dict from train
             if data_cfgs["stat_dict_file"] is not None:
@@ -298,10 +945,15 @@ class DapengScaler(object):
             mean_prcp with the same unit as streamflow
         """
         final_unit = self.data_target.attrs["units"]["streamflow"]
-        mean_prcp = self.data_source.read_mean_prcp(
-            self.t_s_dict["sites_id"], unit=final_unit
-        )
-        return mean_prcp.to_array().transpose("basin", "variable").to_numpy()
+        return self.side_table.mean_prcp(self.t_s_dict["sites_id"], final_unit)
+
+    def _mean_prcp_of(self, var_lst):
+        """mean_prcp if any variable of var_lst is in prcp_norm_cols, else None,
+        so mean precipitation is only read when it is needed
+        """
+        if np.isin(var_lst, self.prcp_norm_cols).any():
+            return self.mean_prcp
+        return None
 
     def inverse_transform(self, target_values):
         """
@@ -330,20 +982,104 @@ class DapengScaler(object):
                 log_norm_cols=self.log_norm_cols,
                 to_norm=False,
             )
-            for i in range(len(self.data_cfgs["target_cols"])):
-                var = self.data_cfgs["target_cols"][i]
-                if var in self.prcp_norm_cols:
-                    pred.loc[dict(variable=var)] = _prcp_norm(
-                        pred.sel(variable=var).to_numpy(),
-                        self.mean_prcp,
-                        to_norm=False,
-                    )
-                else:
-                    pred.loc[dict(variable=var)] = pred.sel(variable=var)
+            pred = _prcp_norm_vars(
+                pred, self.prcp_norm_cols, self._mean_prcp_of(target_cols), False
+            )
         # add attrs for units
         pred.attrs.update(self.data_target.attrs)
         return pred.to_dataset(dim="variable")
 
+    def inverse_transform_batch(self, target_values, basins=None, batch_dim=0):
+        """
+        Denormalization for output variables in a torch.Tensor with vectorized torch ops,
+        on the device of target_values; the same as inverse_transform but without xarray
+
+        Parameters
+        ----------
+        target_values
+            normalized output variables; the last dim is target_cols
+        basins
+            basin index of each sample, only needed for variables in prcp_norm_cols
+        batch_dim
+            the dim of samples in target_values
+
+        Returns
+        -------
+        torch.Tensor
+            denormalized output variables
+        """
+        if self.pbm_norm:
+            return target_values
+        device = target_values.device
+        if device not in self._target_batch_params:
+            # parameters are only computed and copied to the device once
+            params = self.batch_norm_params(
+                self.data_cfgs["target_cols"], is_target=True
+            )
+            self._target_batch_params[device] = {
+                key: value.to(device) for key, value in params.items()
+            }
+        return denormalize_batch(
+            target_values, self._target_batch_params[device], basins, batch_dim
+        )
+
+    def select_basins(self, basin_indices):
+        """Keep only the data of some basins, see BaseDataset.select_basins
+
+        Parameters
+        ----------
+        basin_indices
+            indices of the basins to keep
+        """
+        for name in ["data_target", "data_forcing", "data_attr", "data_other"]:
+            data = getattr(self, name, None)
+            if isinstance(data, xr.DataArray) and "basin" in data.dims:
+                setattr(self, name, data.isel(basin=basin_indices).copy())
+        self.t_s_dict = dict(self.t_s_dict)
+        self.t_s_dict["sites_id"] = [
+            self.t_s_dict["sites_id"][i] for i in basin_indices
+        ]
+        self._target_batch_params = {}
+
+    def __getstate__(self):
+        # tensors on GPUs are not sent to DataLoader workers
+        state = self.__dict__.copy()
+        state["_target_batch_params"] = {}
+        return state
+
+    def batch_norm_params(self, var_lst, is_target=False, dtype=np.float32):
+        """
+        Compact parameters to normalize not normalized mini-batches with normalize_batch
+
+        Parameters
+        ----------
+        var_lst
+            variables in the order of the last dim of the data
+        is_target
+            if true, variables in prcp_norm_cols are divided by mean precipitation
+            of their basins before the normalization, just like get_data_obs
+        dtype
+            dtype of the parameters, same as the data
+
+        Returns
+        -------
+        dict
+            mean, std, log_norm of each variable, and prcp_norm, mean_prcp (per basin)
+            if any variable needs _prcp_norm; all are torch.Tensor
+        """
+        stat = np.array([self.stat_dict[var] for var in var_lst], dtype=dtype)
+        stat = stat.reshape(-1, 4)
+        params = {
+            "mean": torch.from_numpy(np.ascontiguousarray(stat[:, 2])),
+            "std": torch.from_numpy(np.ascontiguousarray(stat[:, 3])),
+            "log_norm": torch.from_numpy(np.isin(var_lst, self.log_norm_cols)),
+        }
+        prcp_norm = np.isin(var_lst, self.prcp_norm_cols) & is_target
+        if prcp_norm.any():
+            params["prcp_norm"] = torch.from_numpy(prcp_norm)
+            params["mean_prcp"] = torch.from_numpy(self.mean_prcp[:, 0].astype(dtype))
+        return params
+
     def cal_stat_all(self):
         """
         Calculate statistics of outputs(streamflow etc), and inputs(forcing and attributes)
@@ -353,6 +1089,7 @@ class DapengScaler(object):
         dict
             a dict with statistic values
         """
+        # statistics are calculated in float64 even if data is stored in float32
         # streamflow, et, ssm, etc
         target_cols = self.data_cfgs["target_cols"]
         stat_dict = {}
@@ -360,15 +1097,17 @@ class DapengScaler(object):
             var = target_cols[i]
             if var in self.prcp_norm_cols:
                 stat_dict[var] = cal_stat_prcp_norm(
-                    self.data_target.sel(variable=var).to_numpy(),
+                    self.data_target.sel(variable=var).to_numpy().astype(np.float64),
                     self.mean_prcp,
                 )
             elif var in self.gamma_norm_cols:
                 stat_dict[var] = cal_stat_gamma(
-                    self.data_target.sel(variable=var).to_numpy()
+                    self.data_target.sel(variable=var).to_numpy().astype(np.float64)
                 )
             else:
-                stat_dict[var] = cal_stat(self.data_target.sel(variable=var).to_numpy())
+                stat_dict[var] = cal_stat(
+                    self.data_target.sel(variable=var).to_numpy().astype(np.float64)
+                )
 
         # forcing
         forcing_lst = self.data_cfgs["relevant_cols"]
@@ -376,16 +1115,22 @@ class DapengScaler(object):
         for k in range(len(forcing_lst)):
             var = forcing_lst[k]
             if var in self.gamma_norm_cols:
-                stat_dict[var] = cal_stat_gamma(x.sel(variable=var).to_numpy())
+                stat_dict[var] = cal_stat_gamma(
+                    x.sel(variable=var).to_numpy().astype(np.float64)
+                )
             else:
-                stat_dict[var] = cal_stat(x.sel(variable=var).to_numpy())
+                stat_dict[var] = cal_stat(
+                    x.sel(variable=var).to_numpy().astype(np.float64)
+                )
 
         # const attribute
         attr_data = self.data_attr
         attr_lst = self.data_cfgs["constant_cols"]
         for k in range(len(attr_lst)):
             var = attr_lst[k]
-            stat_dict[var] = cal_stat(attr_data.sel(variable=var).to_numpy())
+            stat_dict[var] = cal_stat(
+                attr_data.sel(variable=var).to_numpy().astype(np.float64)
+            )
 
         return stat_dict
 
@@ -407,23 +1152,16 @@ class DapengScaler(object):
         """
         stat_dict = self.stat_dict
         data = self.data_target
-        out = xr.full_like(data, np.nan)
+        target_cols = self.data_cfgs["target_cols"]
+        out = _prcp_norm_vars(
+            data, self.prcp_norm_cols, self._mean_prcp_of(target_cols), True
+        )
         # if we don't set a copy() here, the attrs of data will be changed, which is not our wish
         out.attrs = copy.deepcopy(data.attrs)
-        target_cols = self.data_cfgs["target_cols"]
         if "units" not in out.attrs:
             Warning("The attrs of output data does not contain units")
             out.attrs["units"] = {}
-        for i in range(len(target_cols)):
-            var = target_cols[i]
-            if var in self.prcp_norm_cols:
-                out.loc[dict(variable=var)] = _prcp_norm(
-                    data.sel(variable=var).to_numpy(),
-                    self.mean_prcp,
-                    to_norm=True,
-                )
-            else:
-                out.loc[dict(variable=var)] = data.sel(variable=var).to_numpy()
+        for var in target_cols:
             out.attrs["units"][var] = "dimensionless"
         out = _trans_norm(
             out,
@@ -495,3 +1233,67 @@ class DapengScaler(object):
         y = self.get_data_obs()
         c = self.get_data_const()
         return x, y, c
+
+
+def normalize_batch(data, params, basins=None, batch_dim=0):
+    """
+    Normalize a not normalized mini-batch with vectorized torch ops,
+    in the same way as DapengScaler normalizes the whole data
+
+    Parameters
+    ----------
+    data
+        torch.Tensor whose last dim is variables
+    params
+        parameters from DapengScaler.batch_norm_params, on the same device as data
+    basins
+        basin index of each sample in the mini-batch, only needed for _prcp_norm
+    batch_dim
+        the dim of samples in data
+
+    Returns
+    -------
+    torch.Tensor
+        normalized data
+    """
+    if "mean_prcp" in params:
+        shape = [1] * data.ndim
+        shape[batch_dim] = -1
+        basins = torch.as_tensor(basins, device=data.device)
+        mean_prcp = params["mean_prcp"][basins].reshape(shape)
+        data = torch.where(params["prcp_norm"], data / mean_prcp, data)
+    data = torch.where(
+        params["log_norm"], torch.log10(torch.sqrt(torch.abs(data)) + 0.1), data
+    )
+    return (data - params["mean"]) / params["std"]
+
+
+def denormalize_batch(data, params, basins=None, batch_dim=0):
+    """
+    The inverse of normalize_batch, in the same way as DapengScaler.inverse_transform
+
+    Parameters
+    ----------
+    data
+        normalized torch.Tensor whose last dim is variables
+    params
+        parameters from DapengScaler.batch_norm_params, on the same device as data
+    basins
+        basin index of each sample in the mini-batch, only needed for _prcp_norm
+    batch_dim
+        the dim of samples in data
+
+    Returns
+    -------
+    torch.Tensor
+        denormalized data
+    """
+    data = data * params["std"] + params["mean"]
+    data = torch.where(params["log_norm"], (10**data - 0.1) ** 2, data)
+    if "mean_prcp" in params:
+        shape = [1] * data.ndim
+        shape[batch_dim] = -1
+        basins = torch.as_tensor(basins, device=data.device)
+        mean_prcp = params["mean_prcp"][basins].reshape(shape)
+        data = torch.where(params["prcp_norm"], data * mean_prcp, data)
+    return data
@@ -8,39 +8,86 @@ FilePath: \torchhydro\torchhydro\datasets\data_sets.py
 Copyright (c) 2024-2024 Wenyu Ouyang. All rights reserved.
 """
 
+import copy
+import json
 import logging
+import math
+import os
+import queue
 import re
+import shutil
 import sys
+import threading
+import time
+import warnings
 import torch
 import xarray as xr
 import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Optional
-from torch.utils.data import Dataset
-from tqdm import tqdm
+from torch.utils.data import BatchSampler, Dataset
+from torch.utils.data._utils.collate import default_collate
 from hydrodatasource.utils.utils import streamflow_unit_conv
+from hydroutils.hydro_stat import cal_stat, cal_stat_gamma
 
+from torchhydro import CACHE_DIR
 from torchhydro.configs.config import DATE_FORMATS
-from torchhydro.datasets.data_scalers import ScalerHub
-from torchhydro.datasets.data_sources import data_sources_dict
+from torchhydro.datasets.data_cache import (
+    dataset_fingerprint,
+    load_dataset_cache,
+    load_scaler_store,
+    save_dataset_cache,
+    save_scaler_store,
+    scaler_fingerprint,
+    scaler_stat_files,
+    side_table_file,
+)
+from torchhydro.datasets.data_scalers import (
+    BasinSideTable,
+    ChunkCounts,
+    DapengScaler,
+    ScalerHub,
+    StreamingStat,
+    cal_stat_chunks,
+    load_target_scaler,
+    normalize_batch,
+)
+from torchhydro.datasets.data_sources import get_data_source
 
 from torchhydro.datasets.data_utils import (
-    warn_if_nan,
+    _prcp_norm_vars,
+    _trans_norm,
+    interpolate_nan,
     wrap_t_s_dict,
 )
 from hydrodatasource.reader.data_source import SelfMadeHydroDataset
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 LOGGER = logging.getLogger(__name__)
 
 
-def _fill_gaps_da(da: xr.DataArray, fill_nan: Optional[str] = None) -> xr.DataArray:
-    """Fill gaps in a DataArray"""
+def _fill_gaps_da(
+    da: xr.DataArray, fill_nan: Optional[str] = None, max_gap: Optional[int] = None
+) -> xr.DataArray:
+    """Fill gaps in a DataArray in place
+
+    max_gap is the maximum number of consecutive NaN values filled by "interpolate"
+    """
     if fill_nan is None or da is None:
         return da
     assert isinstance(da, xr.DataArray), "Expect da to be DataArray (not dataset)"
     # fill gaps
-    if fill_nan == "et_ssm_ignore":
+    if fill_nan in ["mean", "interpolate"]:
+        _fill_gaps_report(da, fill_nan, max_gap)
+    elif fill_nan == "et_ssm_ignore":
         all_non_nan_idx = []
         for i in range(da.shape[0]):
             non_nan_idx_tmp = np.where(~np.isnan(da[i].values))
@@ -52,31 +99,80 @@ def _fill_gaps_da(da: xr.DataArray, fill_nan: Optional[str] = None) -> xr.DataAr
             da[i][non_nan_idx] = targ_i.interpolate_na(
                 dim="time", fill_value="extrapolate"
             )
-    elif fill_nan == "mean":
-        # fill with mean
-        for var in da["variable"].values:
-            var_data = da.sel(variable=var)  # select the data for the current variable
-            mean_val = var_data.mean(
-                dim="basin"
-            )  # calculate the mean across all basins
-            if warn_if_nan(mean_val):
-                # when all value are NaN, mean_val will be NaN, we set mean_val to -1
-                mean_val = -1
-            filled_data = var_data.fillna(
-                mean_val
-            )  # fill NaN values with the calculated mean
-            da.loc[dict(variable=var)] = (
-                filled_data  # update the original dataarray with the filled data
-            )
-    elif fill_nan == "interpolate":
-        # fill interpolation
-        for i in range(da.shape[0]):
-            da[i] = da[i].interpolate_na(dim="time", fill_value="extrapolate")
     else:
         raise NotImplementedError(f"fill_nan {fill_nan} not implemented")
     return da
 
 
+def _fill_gaps_report(
+    da: xr.DataArray, fill_nan: Optional[str] = None, max_gap: Optional[int] = None
+):
+    """Fill gaps in a DataArray in place with vectorized numpy ops
+    and count its NaN values in the same pass
+
+    "interpolate" linearly interpolates along time for all basins and variables at once;
+    "mean" fills NaN values of each variable with its mean of all basins (-1 if all are NaN)
+
+    Parameters
+    ----------
+    da
+        a numpy-backed DataArray
+    fill_nan
+        "interpolate", "mean" or None (only count NaN values)
+    max_gap
+        the maximum number of consecutive NaN values filled by "interpolate"; None means no limit
+
+    Returns
+    -------
+    tuple[xr.DataArray, xr.DataArray]
+        fraction of NaN values along time before filling and number of NaN values left
+        after filling, both for each basin and variable (all dims of da except time)
+    """
+    arr = da.values
+    dims = [dim for dim in da.dims if dim != "time"]
+    if "time" in da.dims:
+        series = np.moveaxis(arr, da.dims.index("time"), -1)
+    else:
+        series = arr[..., None]
+    nan_mask = np.ascontiguousarray(np.isnan(series))
+    nan_fraction = nan_mask.mean(axis=-1)
+    if fill_nan == "interpolate":
+        data = series.reshape(-1, series.shape[-1])
+        interpolate_nan(data, max_gap, nan_mask.reshape(data.shape))
+        if not np.shares_memory(data, arr):
+            np.copyto(series, data.reshape(series.shape))
+    elif fill_nan == "mean":
+        other_axes = tuple(i for i, dim in enumerate(dims) if dim != "variable")
+        with warnings.catch_warnings():
+            # all values of a variable could be NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            mean_val = np.nanmean(series, axis=other_axes + (-1,), keepdims=True)
+        if np.isnan(mean_val).any():
+            warnings.warn(
+                "Some variables only have NaN values, which are filled with -1"
+            )
+            # when all value are NaN, mean_val will be NaN, we set mean_val to -1
+            mean_val = np.where(np.isnan(mean_val), -1, mean_val)
+        np.copyto(series, np.broadcast_to(mean_val, series.shape), where=nan_mask)
+        nan_mask[...] = False
+    elif fill_nan is not None:
+        raise NotImplementedError(f"fill_nan {fill_nan} not implemented")
+    coords = {dim: da[dim] for dim in dims if dim in da.coords}
+    return (
+        xr.DataArray(nan_fraction, dims=dims, coords=coords),
+        xr.DataArray(nan_mask.sum(axis=-1), dims=dims, coords=coords),
+    )
+
+
+def _peak_rss():
+    """Peak resident set size of this process in bytes; 0 if it is unknown on this platform"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux but bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
 def detect_date_format(date_str):
     for date_format in DATE_FORMATS:
         try:
@@ -87,10 +183,363 @@ def detect_date_format(date_str):
     raise ValueError(f"Unknown date format: {date_str}")
 
 
+def _gather_windows(data, basins, starts, length, seq_first=False):
+    """Gather windows data[basin, start : start + length] of a batch with one fancy-indexing call
+
+    Parameters
+    ----------
+    data
+        np.ndarray or torch.Tensor with shape (basin, time, variable)
+    basins
+        basin index of each sample in the batch
+    starts
+        start time index of each sample in the batch
+    length
+        length of the windows
+    seq_first
+        if True, the result is (time, batch, variable), else (batch, time, variable)
+
+    Returns
+    -------
+    np.ndarray or torch.Tensor
+        a new contiguous array of the windows
+    """
+    if isinstance(data, torch.Tensor):
+        steps = torch.arange(length, device=data.device)
+    else:
+        steps = np.arange(length)
+    if seq_first:
+        return data[basins[None, :], starts[None, :] + steps[:, None]]
+    return data[basins[:, None], starts[:, None] + steps[None, :]]
+
+
+def _broadcast_const(c, length, seq_first=False):
+    """Broadcast attributes with shape (batch, variable) along a time axis without copying"""
+    if seq_first:
+        c_, shape = c[None, :, :], (length,) + tuple(c.shape)
+    else:
+        c_, shape = c[:, None, :], (c.shape[0], length, c.shape[1])
+    if isinstance(c, torch.Tensor):
+        return c_.expand(shape)
+    return np.broadcast_to(c_, shape)
+
+
+def _concat(arrays, axis=-1):
+    """Concatenate np.ndarrays or torch.Tensors"""
+    if isinstance(arrays[0], torch.Tensor):
+        return torch.cat(arrays, dim=axis)
+    return np.concatenate(arrays, axis=axis)
+
+
+def _batch_tensor(arr, seq_first=False):
+    """Turn a gathered batch to a float tensor whose shape is always batch-first;
+    for a sequence-first array, the tensor is a transposed view of it,
+    so that it is contiguous again after model_infer permutes it to sequence-first
+    """
+    if isinstance(arr, list):
+        return [_batch_tensor(arr_, seq_first) for arr_ in arr]
+    if isinstance(arr, torch.Tensor):
+        tensor = arr.contiguous().float()
+    else:
+        tensor = torch.from_numpy(np.ascontiguousarray(arr)).float()
+    if seq_first and tensor.ndim == 3:
+        return tensor.transpose(0, 1)
+    return tensor
+
+
+def _sample_tensor(arr):
+    """A float tensor of a sample sliced from arrays of a dataset; a read-only sample,
+    e.g. one of the memmaps of a dataset cache, is copied so the tensor is writable
+    """
+    if not arr.flags.writeable:
+        arr = np.array(arr)
+    return torch.from_numpy(arr).float()
+
+
+def batch_collate_fn(batch):
+    """Collate function for datasets whose ``__getitems__`` already returns a whole mini-batch"""
+    return batch
+
+
+def get_collate_fn(dataset):
+    """Choose the collate function of a DataLoader for a dataset
+
+    torch's DataLoader calls ``dataset.__getitems__`` with all indices of a mini-batch
+    when the dataset has it, so the result is already collated.
+    """
+    return batch_collate_fn if hasattr(dataset, "__getitems__") else None
+
+
+class DeviceBatchLoader(object):
+    """Iterate over mini-batches of a dataset held entirely as torch tensors on a device
+
+    Each mini-batch is gathered by one advanced-indexing call with an index tensor,
+    so there is no worker process, collate function or numpy-to-torch conversion per sample,
+    and no host-to-device copy per batch.
+    The order of samples comes from the sampler if given (so KuaiSampler is kept),
+    else from a random permutation or a plain range.
+    A batch sampler, such as RandomWindowSampler or BasinBatchSampler, gives the mini-batches directly.
+    """
+
+    def __init__(self, dataset, batch_size, device, sampler=None, shuffle=True):
+        """
+        Parameters
+        ----------
+        dataset
+            a dataset which has a vectorized _gather_batch, such as BaseDataset
+        batch_size
+            size of each mini-batch
+        device
+            torch device where the dataset is held
+        sampler
+            sampler of the indices of samples, by default None
+        shuffle
+            if True and there is no sampler, shuffle samples in each epoch
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.sampler = sampler
+        self.shuffle = shuffle
+        self.device_dataset = dataset.to_device(device)
+
+    def __len__(self):
+        if isinstance(self.sampler, BatchSampler):
+            return len(self.sampler)
+        num_samples = (
+            len(self.sampler) if self.sampler is not None else len(self.dataset)
+        )
+        return math.ceil(num_samples / self.batch_size)
+
+    def _indices(self):
+        if self.sampler is not None:
+            indices = torch.as_tensor(list(iter(self.sampler)), dtype=torch.long)
+            return indices.to(self.device)
+        if self.shuffle:
+            return torch.randperm(len(self.dataset)).to(self.device)
+        return torch.arange(len(self.dataset), device=self.device)
+
+    def __iter__(self):
+        if isinstance(self.sampler, BatchSampler):
+            for batch in self.sampler:
+                if isinstance(batch, LookupTable):
+                    batch = batch.to_device(self.device)
+                else:
+                    batch = torch.as_tensor(batch, dtype=torch.long).to(self.device)
+                yield self.device_dataset._gather_batch(batch)
+            return
+        for batch_indices in torch.split(self._indices(), self.batch_size):
+            yield self.device_dataset._gather_batch(batch_indices)
+
+
+def _share_arrays(obj, names):
+    """Move numpy arrays obj.<name> into shared memory, keeping numpy views of them as attributes
+
+    Arrays memory-mapped from files are already shared by the page cache, so they are kept.
+
+    Returns
+    -------
+    dict
+        name -> the torch tensor which owns the shared memory of the array
+    """
+    tensors = {}
+    shared = {}
+    for name in names:
+        arr = getattr(obj, name, None)
+        if not isinstance(arr, np.ndarray) or isinstance(arr, np.memmap):
+            continue
+        # some arrays are the same object, e.g. x and x_origin when normalize_on_batch is True
+        if id(arr) not in shared:
+            shared[id(arr)] = torch.from_numpy(np.array(arr)).share_memory_()
+        tensors[name] = shared[id(arr)]
+        setattr(obj, name, tensors[name].numpy())
+    return tensors
+
+
+def _state_with_shared_arrays(obj):
+    """State for pickling in which shared arrays are replaced by their tensors;
+    torch's reductions for multiprocessing send them as handles of the shared memory
+    """
+    state = obj.__dict__.copy()
+    state.update(state.get("_shared_tensors", {}))
+    return state
+
+
+def _restore_shared_arrays(obj, state):
+    """Reverse of _state_with_shared_arrays: attach numpy views to the shared tensors"""
+    state = dict(state)
+    for name, tensor in state.get("_shared_tensors", {}).items():
+        state[name] = tensor.numpy()
+    obj.__dict__.update(state)
+
+
+class LookupTable(Mapping):
+    """Index of all samples in a dataset, backed by two int32 arrays
+
+    The i-th sample is the window of basin ``basin[i]`` starting at time ``time[i]``.
+    It can still be used as the old ``dict(enumerate(list_of_tuples))`` lookup table,
+    i.e. ``lookup_table[i]`` returns a ``(basin, time)`` tuple, but no Python tuple
+    is created until an item is read.
+    """
+
+    def __init__(self, basin: np.ndarray, time: np.ndarray):
+        """
+        Parameters
+        ----------
+        basin
+            index of the basin of each sample
+        time
+            index of the start time (after warmup) of each sample
+        """
+        if len(basin) != len(time):
+            raise ValueError("basin and time of a lookup table must have same length")
+        self.basin = np.ascontiguousarray(basin, dtype=np.int32)
+        self.time = np.ascontiguousarray(time, dtype=np.int32)
+
+    def __len__(self):
+        return self.basin.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (bool, np.bool_)) or not isinstance(
+            item, (int, np.integer)
+        ):
+            raise KeyError(item)
+        if item < 0 or item >= len(self):
+            raise KeyError(item)
+        return int(self.basin[item]), int(self.time[item])
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __contains__(self, item):
+        try:
+            self[item]
+        except KeyError:
+            return False
+        return True
+
+    def to_device(self, device):
+        """A copy of this table whose arrays are int64 torch tensors on device,
+        so that they can index device-resident data directly"""
+        table = copy.copy(self)
+        table.basin = torch.from_numpy(self.basin).long().to(device)
+        table.time = torch.from_numpy(self.time).long().to(device)
+        return table
+
+    def share_memory(self):
+        """Move basin and time arrays into shared memory, see BaseDataset.share_memory"""
+        self._shared_tensors = _share_arrays(self, ["basin", "time"])
+        return self
+
+    def __getstate__(self):
+        return _state_with_shared_arrays(self)
+
+    def __setstate__(self, state):
+        _restore_shared_arrays(self, state)
+
+
+def _parse_date(date_str):
+    return datetime.strptime(date_str, detect_date_format(date_str))
+
+
+class SharedPeriodRead(object):
+    """x, y, c data of the union period of train/valid/test, read once and shared by datasets
+
+    The first dataset which needs data reads the whole union period from the data source;
+    then each dataset gets time slices (views) of the shared data rather than reading it again.
+    The union period is padded like the first reading, e.g. one more step at the end
+    for Seq2SeqDataset. Per-basin time ranges are not supported, and such datasets read their own data.
+    """
+
+    def __init__(self, data_cfgs: dict):
+        """
+        Parameters
+        ----------
+        data_cfgs
+            configs for reading source data
+        """
+        self.data_cfgs = data_cfgs
+        # x, y, c DataArrays of the union period
+        self.data = None
+
+    def read(self, dataset, start_date, end_date):
+        """x, y, c data of [start_date, end_date] sliced from the shared data
+
+        Parameters
+        ----------
+        dataset
+            the dataset which needs data; it reads the union period at first
+        start_date : str
+            start time
+        end_date : str
+            end time
+
+        Returns
+        -------
+        tuple[xr.DataArray, xr.DataArray, xr.DataArray] or None
+            x, y, c data; None if the period can't be sliced from the shared data
+        """
+        if self.data is None:
+            union_range = self._union_range(dataset, start_date, end_date)
+            if union_range is None:
+                return None
+            self.data = dataset._read_xyc_data(*union_range)
+            LOGGER.info(f"Read data of the union period {union_range}")
+        x, y, c = self.data
+        start, end = _parse_date(start_date), _parse_date(end_date)
+        times = x.indexes["time"]
+        if start < times[0] or end > times[-1]:
+            return None
+        period = slice(start, end)
+        return x.sel(time=period), y.sel(time=period), c
+
+    def _union_range(self, dataset, start_date, end_date):
+        t_ranges = [
+            self.data_cfgs.get(f"t_range_{mode}") for mode in ["train", "valid", "test"]
+        ]
+        t_ranges = [t_range for t_range in t_ranges if t_range is not None]
+        own_range = dataset.t_s_dict["t_final_range"]
+        if any(
+            isinstance(t_range[0], (tuple, list)) for t_range in t_ranges + [own_range]
+        ):
+            return None
+        # some datasets read a bit more than their own period
+        pad_start = max(
+            _parse_date(own_range[0]) - _parse_date(start_date), timedelta(0)
+        )
+        pad_end = max(_parse_date(end_date) - _parse_date(own_range[1]), timedelta(0))
+        union_start = min(_parse_date(t_range[0]) for t_range in t_ranges) - pad_start
+        union_end = max(_parse_date(t_range[1]) for t_range in t_ranges) + pad_end
+        date_format = detect_date_format(start_date)
+        return union_start.strftime(date_format), union_end.strftime(date_format)
+
+
 class BaseDataset(Dataset):
     """Base data set class to load and preprocess data (batch-first) using PyTorch's Dataset"""
 
-    def __init__(self, data_cfgs: dict, is_tra_val_te: str):
+    # if True, mini-batches from __getitems__ are arranged in sequence-first memory layout
+    seq_first = False
+    # if the dataset could return attributes as a side channel, see data_cfgs["static_side_channel"]
+    supports_static_side_channel = True
+    # if the dataset could keep only not normalized data, see data_cfgs["normalize_on_batch"]
+    supports_normalize_on_batch = True
+    # if valid/test datasets use data of the training period, given by DeepHydro as train_dataset
+    uses_train_dataset = False
+    # arrays moved into shared memory by share_memory
+    shared_array_names = ("x", "y", "c", "x_origin", "y_origin", "c_origin")
+    # if __getitems__ could gather a batch of windows given as a LookupTable, see RandomWindowSampler
+    supports_window_batches = True
+    # if select_basins could keep only a part of the basins, see BasinDistributedSampler
+    supports_basin_selection = True
+    # arrays whose first axis is basins, kept for the selected basins by select_basins
+    basin_array_names = ("x", "y", "c", "x_origin", "y_origin", "c_origin")
+
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+    ):
         """
         Parameters
         ----------
@@ -98,9 +547,12 @@ class BaseDataset(Dataset):
             parameters for reading source data
         is_tra_val_te
             train, vaild or test
+        shared_read
+            if not None, data is sliced from the data of the union period shared by datasets
         """
         super(BaseDataset, self).__init__()
         self.data_cfgs = data_cfgs
+        self.shared_read = shared_read
         if is_tra_val_te in {"train", "valid", "test"}:
             self.is_tra_val_te = is_tra_val_te
         else:
@@ -115,7 +567,7 @@ class BaseDataset(Dataset):
         source_name = self.data_cfgs["source_cfgs"]["source_name"]
         source_path = self.data_cfgs["source_cfgs"]["source_path"]
         other_settings = self.data_cfgs["source_cfgs"].get("other_settings", {})
-        return data_sources_dict[source_name](source_path, **other_settings)
+        return get_data_source(source_name, source_path, **other_settings)
 
     @property
     def streamflow_name(self):
@@ -216,6 +668,24 @@ class BaseDataset(Dataset):
             times_ = pd.date_range(start=s_date, end=e_date, freq=time_step)
         return times_
 
+    @property
+    def lookup_table(self):
+        """Index of all samples, which is built when it is used at first,
+        so training with batches of windows drawn by RandomWindowSampler doesn't build it at all
+        """
+        if self._lookup_table is None:
+            with self._profile_stage("create_lookup_table"):
+                self._create_lookup_table()
+        return self._lookup_table
+
+    @lookup_table.setter
+    def lookup_table(self, lookup_table):
+        self._lookup_table = lookup_table
+
+    @property
+    def num_samples(self):
+        return len(self.lookup_table)
+
     def __len__(self):
         return self.num_samples if self.train_mode else self.ngrid
 
@@ -223,38 +693,456 @@ class BaseDataset(Dataset):
         if not self.train_mode:
             x = self.x[item, :, :]
             y = self.y[item, :, :]
-            if self.c is None or self.c.shape[-1] == 0:
-                return torch.from_numpy(x).float(), torch.from_numpy(y).float()
-            c = self.c[item, :]
-            c = np.repeat(c, x.shape[0], axis=0).reshape(c.shape[0], -1).T
-            xc = np.concatenate((x, c), axis=1)
-            return torch.from_numpy(xc).float(), torch.from_numpy(y).float()
+            if self.normalize_on_batch:
+                x, y = self._normalize_sample(x, y, item)
+            return self._item_with_c(x, item), _sample_tensor(y)
         basin, idx = self.lookup_table[item]
         warmup_length = self.warmup_length
         x = self.x[basin, idx - warmup_length : idx + self.rho + self.horizon, :]
         y = self.y[basin, idx : idx + self.rho + self.horizon, :]
+        if self.normalize_on_batch:
+            x, y = self._normalize_sample(x, y, basin)
+        return self._item_with_c(x, basin), _sample_tensor(y)
+
+    def _normalize_sample(self, x, y, basin):
+        """normalize not normalized x and y of one sample, see _normalize_batch"""
+        x, y = self._normalize_batch(x[None], y[None], np.array([basin]))
+        return x[0].numpy(), y[0].numpy()
+
+    def _normalize_batch(self, x, y, basins, batch_dim=0):
+        """normalize gathered windows of not normalized x and y when normalize_on_batch is True
+
+        Returns
+        -------
+        tuple[torch.Tensor, torch.Tensor]
+            normalized x and y
+        """
+        params = self.batch_norm_params
+        x = normalize_batch(torch.as_tensor(x), params["x"], basins, batch_dim)
+        y = normalize_batch(torch.as_tensor(y), params["y"], basins, batch_dim)
+        return x, y
+
+    def _item_with_c(self, x, basin):
+        """x of a sample with attributes of its basin, concatenated to x along variables
+        or as a side channel [x, c] if static_side_channel is True
+        """
         if self.c is None or self.c.shape[-1] == 0:
-            return torch.from_numpy(x).float(), torch.from_numpy(y).float()
+            return _sample_tensor(x)
         c = self.c[basin, :]
+        if self.static_side_channel:
+            return [_sample_tensor(x), _sample_tensor(c)]
         c = np.repeat(c, x.shape[0], axis=0).reshape(c.shape[0], -1).T
         xc = np.concatenate((x, c), axis=1)
-        return torch.from_numpy(xc).float(), torch.from_numpy(y).float()
+        return torch.from_numpy(xc).float()
+
+    def to_device(self, device):
+        """A shallow copy of this dataset whose arrays are torch tensors on device
+
+        Only __getitems__ works for the copy, as __getitem__ needs numpy arrays.
+
+        Parameters
+        ----------
+        device
+            torch device
+
+        Returns
+        -------
+        BaseDataset
+            the device-resident copy
+        """
+        dataset = copy.copy(self)
+        # x and x_origin are the same array when normalize_on_batch is True, copy it only once
+        tensors = {}
+        for name in ["x", "y", "c", "x_origin", "y_origin"]:
+            arr = getattr(self, name, None)
+            if isinstance(arr, np.ndarray):
+                if id(arr) not in tensors:
+                    tensors[id(arr)] = torch.from_numpy(np.array(arr)).to(device)
+                setattr(dataset, name, tensors[id(arr)])
+        if self.normalize_on_batch:
+            dataset.batch_norm_params = {
+                key: {name: t.to(device) for name, t in params.items()}
+                for key, params in self.batch_norm_params.items()
+            }
+        dataset.lookup_table = self.lookup_table.to_device(device)
+        train_dataset = getattr(self, "train_dataset", None)
+        if isinstance(train_dataset, BaseDataset):
+            dataset.train_dataset = train_dataset.to_device(device)
+        return dataset
+
+    def share_memory(self):
+        """Move large arrays (x, y, c, their origins and the lookup table) into shared memory
+        before DataLoader workers are started
+
+        Forked workers then map the same pages instead of gradually copying the arrays
+        as reference counts and reads touch them, and spawned workers attach to the shared
+        memory when the dataset is unpickled, so memory doesn't grow with num_workers.
+
+        Returns
+        -------
+        BaseDataset
+            this dataset
+        """
+        self._shared_tensors = _share_arrays(self, self.shared_array_names)
+        if self._lookup_table is not None:
+            self._lookup_table.share_memory()
+        train_dataset = getattr(self, "train_dataset", None)
+        if isinstance(train_dataset, BaseDataset):
+            train_dataset.share_memory()
+        return self
+
+    def __getstate__(self):
+        return _state_with_shared_arrays(self)
+
+    def __setstate__(self, state):
+        _restore_shared_arrays(self, state)
+
+    def select_basins(self, basin_indices):
+        """Keep only some basins of this dataset in place and drop arrays of the others
+
+        A rank of distributed training then only holds arrays of its own basins,
+        see BasinDistributedSampler. The lookup table is rebuilt for the kept basins
+        when it is used next time. The shared reading of the union period is released,
+        as it holds data of all basins.
+
+        Parameters
+        ----------
+        basin_indices
+            indices of the basins to keep, in the order of the new basin axis
+
+        Returns
+        -------
+        BaseDataset
+            this dataset
+        """
+        if not self.supports_basin_selection:
+            raise NotImplementedError(
+                f"{type(self).__name__} can't keep only a part of its basins now"
+            )
+        basin_indices = np.asarray(basin_indices, dtype=np.int64)
+        # x and x_origin are the same array when normalize_on_batch is True, select it only once
+        selected = {}
+        for name in self.basin_array_names:
+            arr = getattr(self, name, None)
+            if isinstance(arr, np.ndarray):
+                if id(arr) not in selected:
+                    selected[id(arr)] = np.ascontiguousarray(arr[basin_indices])
+                setattr(self, name, selected[id(arr)])
+        self.nan_report = {
+            name: nan_fraction[basin_indices]
+            for name, nan_fraction in getattr(self, "nan_report", {}).items()
+        }
+        if self.normalize_on_batch:
+            for params in self.batch_norm_params.values():
+                if "mean_prcp" in params:
+                    params["mean_prcp"] = params["mean_prcp"][basin_indices]
+        self.t_s_dict = dict(self.t_s_dict)
+        self.t_s_dict["sites_id"] = [
+            self.t_s_dict["sites_id"][i] for i in basin_indices
+        ]
+        if isinstance(getattr(self, "target_scaler", None), DapengScaler):
+            # its data are views of the data of all basins
+            self.target_scaler.select_basins(basin_indices)
+        self.shared_read = None
+        self._lookup_table = None
+        return self
+
+    def __getitems__(self, indices):
+        """Get a whole mini-batch at once; torch's DataLoader calls it instead of __getitem__
+
+        Parameters
+        ----------
+        indices
+            indices of all samples in a mini-batch
+
+        Returns
+        -------
+        tuple
+            batch-first tensors of the mini-batch
+        """
+        if isinstance(indices, LookupTable):
+            # windows drawn directly, e.g. by RandomWindowSampler
+            return self._gather_batch(indices)
+        return self._gather_batch(np.asarray(indices, dtype=np.int64))
+
+    def _batch_windows(self, indices):
+        """basin indices and start time indices (after warmup) of the windows of a mini-batch
+
+        indices are indices of the lookup table, or a LookupTable of windows drawn directly
+        """
+        if isinstance(indices, LookupTable):
+            return indices.basin, indices.time
+        return self.lookup_table.basin[indices], self.lookup_table.time[indices]
+
+    def _batch_basin_time(self, indices):
+        """basin indices and start time indices (including warmup) of a mini-batch"""
+        if not self.train_mode:
+            # all time series start from 0; indices * 0 works for both numpy and torch
+            return indices, indices * 0
+        basins, times = self._batch_windows(indices)
+        return basins, times - self.warmup_length
+
+    def _gather_xc(self, x, basins, time_starts, length, seq_first=False):
+        """gather windows of x and concatenate attributes to them"""
+        x_ = _gather_windows(x, basins, time_starts, length, seq_first)
+        return self._batch_with_c(x_, basins, length, seq_first)
+
+    def _batch_with_c(self, x, basins, length, seq_first=False):
+        """x of a mini-batch with attributes of its basins, concatenated to x along variables
+        or as a side channel [x, c] if static_side_channel is True
+        """
+        if self.c is None or self.c.shape[-1] == 0:
+            return x
+        c = self.c[basins]
+        if isinstance(x, torch.Tensor) and not isinstance(c, torch.Tensor):
+            # x has been normalized on the mini-batch
+            c = torch.from_numpy(c)
+        if self.static_side_channel:
+            return [x, c]
+        c_ = _broadcast_const(c, length, seq_first)
+        return _concat((x, c_))
+
+    def _gather_batch(self, indices):
+        seq_first = self.seq_first
+        basins, time_starts = self._batch_basin_time(indices)
+        if self.train_mode:
+            x_len = self.warmup_length + self.rho + self.horizon
+            y_starts = time_starts + self.warmup_length
+            y_len = self.rho + self.horizon
+        else:
+            x_len = self.x.shape[1]
+            y_starts = time_starts
+            y_len = self.y.shape[1]
+        x = _gather_windows(self.x, basins, time_starts, x_len, seq_first)
+        y = _gather_windows(self.y, basins, y_starts, y_len, seq_first)
+        if self.normalize_on_batch:
+            x, y = self._normalize_batch(x, y, basins, batch_dim=int(seq_first))
+        xc = self._batch_with_c(x, basins, x_len, seq_first)
+        return _batch_tensor(xc, seq_first), _batch_tensor(y, seq_first)
 
     def _pre_load_data(self):
         self.train_mode = self.is_tra_val_te == "train"
+        # stage -> wall time, bytes read, growth of the peak RSS and calls, see _profile_stage
+        self.load_profile = {}
+        self._lookup_table = None
         self.t_s_dict = wrap_t_s_dict(self.data_cfgs, self.is_tra_val_te)
         self.rho = self.data_cfgs["forecast_history"]
         self.warmup_length = self.data_cfgs["warmup_length"]
         self.horizon = self.data_cfgs["forecast_length"]
+        # dtype of all arrays in the dataset, float32 by default as torch models use it
+        self.dtype = np.dtype(self.data_cfgs.get("dtype", "float32"))
+        # return attributes as a side channel rather than tiling them along time
+        self.static_side_channel = self.data_cfgs.get("static_side_channel", False)
+        if self.static_side_channel and not self.supports_static_side_channel:
+            raise NotImplementedError(
+                f"{type(self).__name__} doesn't support static_side_channel now"
+            )
+        # keep only not normalized x and y, and normalize mini-batches when they are gathered
+        self.normalize_on_batch = self.data_cfgs.get("normalize_on_batch", False)
+        if self.normalize_on_batch and not self.supports_normalize_on_batch:
+            raise NotImplementedError(
+                f"{type(self).__name__} doesn't support normalize_on_batch now"
+            )
 
     def _load_data(self):
         self._pre_load_data()
+        with self._profile_stage("total"):
+            self._load_data_stages()
+        LOGGER.info(
+            f"Load {self.is_tra_val_te} dataset in {self.load_profile['total']['wall_time']:.1f}s, "
+            f"profile of its stages: {self.load_profile}"
+        )
+
+    def _load_data_stages(self):
+        cache_path = self._dataset_cache_path()
+        if cache_path is not None:
+            with self._profile_stage("load_dataset_cache"):
+                loaded = self._load_dataset_cache(cache_path)
+            if loaded:
+                return
         self._read_xyc()
-        # normalization
-        norm_x, norm_y, norm_c = self._normalize()
-        self.x, self.y, self.c = self._kill_nan(norm_x, norm_y, norm_c)
-        self._trans2nparr()
-        self._create_lookup_table()
+        if self.normalize_on_batch:
+            # statistics, filling gaps and transforming to numpy arrays
+            with self._profile_stage("keep_origin_only"):
+                self._keep_origin_only()
+        else:
+            # normalization
+            with self._profile_stage("normalize"):
+                norm_x, norm_y, norm_c = self._normalize()
+            with self._profile_stage("kill_nan"):
+                self.x, self.y, self.c = self._kill_nan(norm_x, norm_y, norm_c)
+            with self._profile_stage("trans2nparr"):
+                self._trans2nparr()
+        if cache_path is not None:
+            with self._profile_stage("save_dataset_cache"):
+                self._save_dataset_cache(cache_path)
+
+    @contextmanager
+    def _profile_stage(self, stage):
+        """Add wall time, growth of the peak RSS and calls of a stage of loading data to load_profile
+
+        A stage reading data adds the bytes it reads to "nbytes" of the yielded record.
+        Stages called more than once, e.g. reading each group of basins, are accumulated.
+        """
+        record = self.load_profile.setdefault(
+            stage, {"wall_time": 0.0, "nbytes": 0, "peak_rss_delta": 0, "calls": 0}
+        )
+        peak_rss = _peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_time"] += time.perf_counter() - start
+            record["peak_rss_delta"] += _peak_rss() - peak_rss
+            record["calls"] += 1
+
+    def _dataset_cache_path(self):
+        """Directory of the on-disk cache of this dataset; None if cache_dataset is off"""
+        if not self.data_cfgs.get("cache_dataset", False):
+            return None
+        cache_dir = self.data_cfgs.get("cache_dir")
+        if cache_dir is None:
+            cache_dir = CACHE_DIR.joinpath("dataset_cache")
+        os.makedirs(cache_dir, exist_ok=True)
+        fingerprint = dataset_fingerprint(
+            self.data_cfgs, self.is_tra_val_te, self.t_s_dict, type(self).__name__
+        )
+        return os.path.join(cache_dir, fingerprint)
+
+    def _scaler_store_path(self):
+        """Directory in the scaler store for statistics of this training data;
+        None if scaler_store is off or statistics are not calculated by this dataset
+        """
+        if (
+            not self.data_cfgs.get("scaler_store", False)
+            or self.is_tra_val_te != "train"
+            or self.data_cfgs["stat_dict_file"] is not None
+        ):
+            return None
+        cache_dir = self.data_cfgs.get("cache_dir")
+        if cache_dir is None:
+            store_dir = CACHE_DIR.joinpath("scaler_store")
+        else:
+            store_dir = os.path.join(cache_dir, "scaler_store")
+        os.makedirs(store_dir, exist_ok=True)
+        fingerprint = scaler_fingerprint(
+            self.data_cfgs, self.t_s_dict, type(self).__name__
+        )
+        return os.path.join(store_dir, fingerprint)
+
+    def _save_dataset_cache(self, cache_path):
+        """Save the final arrays, the lookup table and the scaler statistics of this dataset"""
+        arrays = {
+            name: getattr(self, name)
+            for name in ["x", "y", "c", "x_origin", "y_origin", "c_origin"]
+            if isinstance(getattr(self, name), np.ndarray)
+        }
+        if self.normalize_on_batch:
+            # x_origin and y_origin are x and y themselves
+            del arrays["x_origin"], arrays["y_origin"]
+        for name, nan_fraction in self.nan_report.items():
+            arrays[f"nan_report_{name}"] = nan_fraction
+        arrays["lookup_basin"] = self.lookup_table.basin
+        arrays["lookup_time"] = self.lookup_table.time
+        meta = {}
+        if isinstance(self.target_scaler, DapengScaler):
+            # DapengScaler needs the not normalized target data for denormalization
+            data_target = self.target_scaler.data_target
+            meta["target_dims"] = list(data_target.dims)
+            meta["target_coords"] = {
+                dim: data_target[dim].values.astype(str).tolist()
+                for dim in data_target.dims
+            }
+            meta["target_attrs"] = data_target.attrs
+        save_dataset_cache(
+            cache_path,
+            arrays,
+            meta,
+            scaler_stat_files(self.data_cfgs) + [side_table_file(self.data_cfgs)],
+        )
+
+    def _load_dataset_cache(self, cache_path):
+        """Load this dataset from its on-disk cache
+
+        Returns
+        -------
+        bool
+            False if there is no cache
+        """
+        cached = load_dataset_cache(cache_path, self.data_cfgs["test_path"])
+        if cached is None:
+            return False
+        arrays, meta = cached
+        for name in ["x", "y"]:
+            setattr(self, name, arrays[name])
+            setattr(self, f"{name}_origin", arrays.get(f"{name}_origin", arrays[name]))
+        # no attributes data
+        no_c = np.zeros((self.ngrid, 0))
+        self.c = arrays.get("c", no_c)
+        self.c_origin = arrays.get("c_origin", no_c)
+        data_target = None
+        if "target_dims" in meta:
+            axes = ["basin", "time", "variable"]
+            coords = dict(meta["target_coords"])
+            coords["time"] = pd.to_datetime(coords["time"])
+            data_target = xr.DataArray(
+                self.y_origin.transpose([axes.index(d) for d in meta["target_dims"]]),
+                dims=meta["target_dims"],
+                coords=coords,
+                attrs=meta["target_attrs"],
+            )
+        self.target_scaler = load_target_scaler(
+            self.data_cfgs,
+            self.is_tra_val_te,
+            data_target=data_target,
+            data_source=self._scaler_data_source(),
+        )
+        if self.normalize_on_batch:
+            self._set_batch_norm_params()
+        self.nan_report = {
+            name: arrays[f"nan_report_{name}"]
+            for name in ["x", "y", "c"]
+            if f"nan_report_{name}" in arrays
+        }
+        self.lookup_table = LookupTable(arrays["lookup_basin"], arrays["lookup_time"])
+        LOGGER.info(f"Load {self.is_tra_val_te} dataset from cache {cache_path}")
+        return True
+
+    def _prepare_stat_file(self):
+        """Put saved statistics of the training period into test_path just like DapengScaler,
+        for datasets which normalize data with them rather than ScalerHub
+        """
+        stat_file = scaler_stat_files(self.data_cfgs)[0]
+        stat_dict_file = self.data_cfgs["stat_dict_file"]
+        if stat_dict_file is not None and os.path.abspath(
+            stat_dict_file
+        ) != os.path.abspath(stat_file):
+            shutil.copy(stat_dict_file, stat_file)
+        if not os.path.isfile(stat_file):
+            raise FileNotFoundError(
+                f"{type(self).__name__} needs saved statistics but {stat_file} doesn't exist; "
+                "please set stat_dict_file"
+            )
+
+    def _target_placeholder(self, attrs, nt, times=None):
+        """A lazy all-NaN target DataArray which only gives DapengScaler coords and units"""
+        target_cols = self.data_cfgs["target_cols"]
+        coords = {"variable": target_cols, "basin": self.basins}
+        if times is not None:
+            coords["time"] = times
+        return xr.DataArray(
+            np.broadcast_to(
+                np.array(np.nan, dtype=self.dtype),
+                (len(target_cols), self.ngrid, nt),
+            ),
+            dims=["variable", "basin", "time"],
+            coords=coords,
+            attrs=attrs,
+        )
+
+    def _scaler_data_source(self):
+        """The data source used by ScalerHub, for example, to read mean precipitation"""
+        return self.data_source
 
     def _trans2nparr(self):
         """To make __getitem__ more efficient,
@@ -268,6 +1156,55 @@ class BaseDataset(Dataset):
         self.x_origin = self.x_origin.transpose("basin", "time", "variable").to_numpy()
         self.y_origin = self.y_origin.transpose("basin", "time", "variable").to_numpy()
 
+    def _keep_origin_only(self):
+        """Keep not normalized x and y (with gaps filled) as both x and x_origin, y and y_origin,
+        and normalize mini-batches of them with DapengScaler's statistics when they are gathered,
+        so that there is only one copy of the time series in memory
+
+        NOTE: gaps are interpolated in the not normalized data, so for variables in log_norm_cols,
+        the filled values are a bit different from those interpolated in the normalized data
+        """
+        if self.data_cfgs["scaler"] != "DapengScaler":
+            raise NotImplementedError(
+                "normalize_on_batch only supports DapengScaler now"
+            )
+        scaler_params = self.data_cfgs["scaler_params"]
+        # the statistics are calculated (or loaded), but the data is not normalized
+        self.target_scaler = DapengScaler(
+            self.y_origin,
+            self.x_origin,
+            self.c_origin,
+            self.data_cfgs,
+            self.is_tra_val_te,
+            prcp_norm_cols=scaler_params["prcp_norm_cols"],
+            gamma_norm_cols=scaler_params["gamma_norm_cols"],
+            pbm_norm=scaler_params["pbm_norm"],
+            data_source=self._scaler_data_source(),
+            scaler_store=self._scaler_store_path(),
+        )
+        x, y = self.x_origin, self.y_origin
+        if self.shared_read is not None:
+            # don't fill gaps in place in the data shared with other datasets
+            x, y = x.copy(), y.copy()
+        x, y, self.c = self._kill_nan(x, y, self.target_scaler.get_data_const())
+        self.x = self.x_origin = x.transpose("basin", "time", "variable").to_numpy()
+        self.y = self.y_origin = y.transpose("basin", "time", "variable").to_numpy()
+        if self.c is not None and self.c.shape[-1] > 0:
+            self.c = self.c.transpose("basin", "variable").to_numpy()
+            self.c_origin = self.c_origin.transpose("basin", "variable").to_numpy()
+        self._set_batch_norm_params()
+
+    def _set_batch_norm_params(self):
+        """per-variable (and per-basin mean precipitation) parameters for _normalize_batch"""
+        self.batch_norm_params = {
+            "x": self.target_scaler.batch_norm_params(
+                self.data_cfgs["relevant_cols"], dtype=self.dtype
+            ),
+            "y": self.target_scaler.batch_norm_params(
+                self.data_cfgs["target_cols"], is_target=True, dtype=self.dtype
+            ),
+        }
+
     def _normalize(self):
         scaler_hub = ScalerHub(
             self.y_origin,
@@ -275,7 +1212,8 @@ class BaseDataset(Dataset):
             self.c_origin,
             data_cfgs=self.data_cfgs,
             is_tra_val_te=self.is_tra_val_te,
-            data_source=self.data_source,
+            data_source=self._scaler_data_source(),
+            scaler_store=self._scaler_store_path(),
         )
         self.target_scaler = scaler_hub.target_scaler
         return scaler_hub.x, scaler_hub.y, scaler_hub.c
@@ -323,7 +1261,7 @@ class BaseDataset(Dataset):
             streamflow_dataset = data_output_ds[[self.streamflow_name]]
             converted_streamflow_dataset = streamflow_unit_conv(
                 streamflow_dataset,
-                self.data_source.read_area(self.t_s_dict["sites_id"]),
+                self._read_area(data_output_ds["basin"].values.tolist()),
                 target_unit=prcp_unit,
             )
             data_output_ds[self.streamflow_name] = converted_streamflow_dataset[
@@ -331,6 +1269,18 @@ class BaseDataset(Dataset):
             ]
         return data_forcing_ds, data_output_ds
 
+    def _read_area(self, basin_ids):
+        """Read areas of basins, which are used to convert units of streamflow,
+        from the side table saved with the scaler statistics if they are there
+        """
+        side_table = BasinSideTable(
+            side_table_file(self.data_cfgs),
+            self.data_source,
+            self.data_cfgs["source_cfgs"],
+            scaler_stat_files(self.data_cfgs)[0],
+        )
+        return side_table.area(basin_ids)
+
     def _read_xyc(self):
         """Read x, y, c data from data source
 
@@ -356,38 +1306,93 @@ class BaseDataset(Dataset):
         end_date : str
             end time
         """
-        data_forcing_ds_ = self.data_source.read_ts_xrdataset(
-            self.t_s_dict["sites_id"],
-            [start_date, end_date],
-            self.data_cfgs["relevant_cols"],
-        )
-        # y
-        data_output_ds_ = self.data_source.read_ts_xrdataset(
-            self.t_s_dict["sites_id"],
-            [start_date, end_date],
-            self.data_cfgs["target_cols"],
+        if self.shared_read is not None:
+            shared_data = self.shared_read.read(self, start_date, end_date)
+            if shared_data is not None:
+                self.x_origin, self.y_origin, self.c_origin = shared_data
+                return
+        self.x_origin, self.y_origin, self.c_origin = self._read_xyc_data(
+            start_date, end_date
         )
-        if isinstance(data_output_ds_, dict) or isinstance(data_forcing_ds_, dict):
-            # this means the data source return a dict with key as time_unit
-            # in this BaseDataset, we only support unified time range for all basins, so we chose the first key
-            # TODO: maybe this could be refactored better
-            data_forcing_ds_ = data_forcing_ds_[list(data_forcing_ds_.keys())[0]]
-            data_output_ds_ = data_output_ds_[list(data_output_ds_.keys())[0]]
-        data_forcing_ds, data_output_ds = self._check_ts_xrds_unit(
-            data_forcing_ds_, data_output_ds_
+
+    def _read_xyc_data(self, start_date, end_date):
+        """Read x, y, c data from data source and transform them to DataArrays
+
+        Parameters
+        ----------
+        start_date : str
+            start time
+        end_date : str
+            end time
+
+        Returns
+        -------
+        tuple[xr.DataArray, xr.DataArray, xr.DataArray]
+            x, y, c data
+        """
+        data_forcing_ds, data_output_ds = self._read_ts_specified_time(
+            self.t_s_dict["sites_id"], start_date, end_date
         )
         # c
-        data_attr_ds = self.data_source.read_attr_xrdataset(
-            self.t_s_dict["sites_id"],
-            self.data_cfgs["constant_cols"],
-            all_number=True,
-        )
-        self.x_origin, self.y_origin, self.c_origin = self._to_dataarray_with_unit(
-            data_forcing_ds, data_output_ds, data_attr_ds
-        )
+        with self._profile_stage("read_attr_xrdataset") as record:
+            data_attr_ds = self.data_source.read_attr_xrdataset(
+                self.t_s_dict["sites_id"],
+                self.data_cfgs["constant_cols"],
+                all_number=True,
+            )
+            if data_attr_ds is not None:
+                record["nbytes"] += int(data_attr_ds.nbytes)
+        # lazily read data is loaded here
+        with self._profile_stage("to_dataarray"):
+            return self._to_dataarray_with_unit(
+                data_forcing_ds, data_output_ds, data_attr_ds
+            )
+
+    def _read_ts_specified_time(self, basin_ids, start_date, end_date):
+        """Read x, y time series of some basins with specified time range
+        and convert units of streamflow if necessary
+
+        Parameters
+        ----------
+        basin_ids : list
+            ids of basins
+        start_date : str
+            start time
+        end_date : str
+            end time
+
+        Returns
+        -------
+        tuple[xr.Dataset, xr.Dataset]
+            x, y data
+        """
+        with self._profile_stage("read_ts_xrdataset") as record:
+            data_forcing_ds_ = self.data_source.read_ts_xrdataset(
+                basin_ids,
+                [start_date, end_date],
+                self.data_cfgs["relevant_cols"],
+            )
+            # y
+            data_output_ds_ = self.data_source.read_ts_xrdataset(
+                basin_ids,
+                [start_date, end_date],
+                self.data_cfgs["target_cols"],
+            )
+            if isinstance(data_output_ds_, dict) or isinstance(data_forcing_ds_, dict):
+                # this means the data source return a dict with key as time_unit
+                # in this BaseDataset, we only support unified time range for all basins, so we chose the first key
+                # TODO: maybe this could be refactored better
+                data_forcing_ds_ = data_forcing_ds_[list(data_forcing_ds_.keys())[0]]
+                data_output_ds_ = data_output_ds_[list(data_output_ds_.keys())[0]]
+            record["nbytes"] += int(data_forcing_ds_.nbytes + data_output_ds_.nbytes)
+        with self._profile_stage("check_ts_xrds_unit"):
+            return self._check_ts_xrds_unit(data_forcing_ds_, data_output_ds_)
 
     def _trans2da_and_setunits(self, ds):
         """Set units for dataarray transfromed from dataset"""
+        # cast to the dataset's dtype before stacking variables to avoid a float64 copy,
+        # then normalization and gap filling keep this dtype
+        ds = ds.astype(self.dtype)
         result = ds.to_array(dim="variable")
         units_dict = {
             var: ds[var].attrs["units"]
@@ -398,63 +1403,123 @@ class BaseDataset(Dataset):
         return result
 
     def _kill_nan(self, x, y, c):
+        """Fill gaps of x, y, c in place and record their fraction of NaN values in nan_report
+
+        nan_report has arrays with shape (basin, variable) for x, y and c,
+        whose variables are in the order of relevant_cols, target_cols and constant_cols
+        """
         data_cfgs = self.data_cfgs
-        y_rm_nan = data_cfgs["target_rm_nan"]
-        x_rm_nan = data_cfgs["relevant_rm_nan"]
-        c_rm_nan = data_cfgs["constant_rm_nan"]
-        if x_rm_nan:
+        max_gap = data_cfgs.get("nan_max_gap")
+        self.nan_report = {}
+        for name, da, rm_nan, fill_nan in [
             # As input, we cannot have NaN values
-            _fill_gaps_da(x, fill_nan="interpolate")
-            warn_if_nan(x)
-        if y_rm_nan:
-            _fill_gaps_da(y, fill_nan="interpolate")
-            warn_if_nan(y)
-        if c_rm_nan:
-            _fill_gaps_da(c, fill_nan="mean")
-            warn_if_nan(c)
-        warn_if_nan(x, nan_mode="all")
-        warn_if_nan(y, nan_mode="all")
-        warn_if_nan(c, nan_mode="all")
+            ("x", x, data_cfgs["relevant_rm_nan"], "interpolate"),
+            ("y", y, data_cfgs["target_rm_nan"], "interpolate"),
+            ("c", c, data_cfgs["constant_rm_nan"], "mean"),
+        ]:
+            if da is not None:
+                self._fill_gaps_and_report(name, da, rm_nan, fill_nan, max_gap)
         return x, y, c
 
+    def _fill_gaps_and_report(self, name, da, rm_nan, fill_nan, max_gap=None):
+        """Fill gaps of a DataArray in place if rm_nan and record its NaN fraction as nan_report[name]"""
+        nan_fraction, nan_left = _fill_gaps_report(
+            da, fill_nan if rm_nan else None, max_gap
+        )
+        self.nan_report[name] = nan_fraction.transpose("basin", "variable").to_numpy()
+        total_nans = int(nan_left.sum())
+        if da.size > 0 and total_nans == da.size:
+            raise ValueError(f"The {name} data contains only NaN values!")
+        if rm_nan and total_nans > 0:
+            warnings.warn(
+                f"The {name} data still contains {total_nans} NaN values after filling gaps"
+            )
+
     def _create_lookup_table(self):
-        lookup = []
-        # list to collect basins ids of basins without a single training sample
-        basin_coordinates = len(self.t_s_dict["sites_id"])
+        """Find all valid (basin, time) samples
+
+        The time index of a sample is the start of its forecast_history window;
+        the data loader loads it with warmup period, so we leave some periods for it:
+        [warmup_len] -> time_start -> [rho] -> [horizon].
+        In training mode, samples whose target values in the horizon are all NaN are dropped.
+        """
+        first, end = self._window_start_range()
+        time_start = np.arange(first.min(), end.max())
+        valid = (time_start >= first[:, None]) & (time_start < end[:, None])
+        if self.is_tra_val_te == "train":
+            valid &= self._windows_with_target(
+                self._target_notnan_cumsum(),
+                np.arange(self.ngrid)[:, None],
+                time_start[None, :],
+            )
+        basin_idx, time_idx = np.nonzero(valid)
+        self.lookup_table = LookupTable(basin_idx, time_start[time_idx])
+
+    def _window_start_range(self):
+        """Range [first, end) of start times (after warmup) of windows in each basin
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            first and end, int64 arrays with shape (basin,)
+        """
+        first = np.full(self.ngrid, self.warmup_length, dtype=np.int64)
+        end = np.full(self.ngrid, self.nt - self.rho - self.horizon + 1, dtype=np.int64)
+        return first, np.maximum(end, first)
+
+    def _target_notnan_cumsum(self):
+        """Cumulative count of non-NaN target values along time with a leading 0,
+        so that the number of non-NaN values in any window is a difference of two entries
+        """
+        notnan_count = self._target_notnan_count()
+        notnan_cumsum = np.zeros(
+            (notnan_count.shape[0], notnan_count.shape[1] + 1), dtype=np.int32
+        )
+        np.cumsum(notnan_count, axis=1, out=notnan_cumsum[:, 1:])
+        return notnan_cumsum
+
+    def _windows_with_target(self, notnan_cumsum, basins, times):
+        """Whether windows starting at times of basins have any non-NaN target value in their horizon"""
         rho = self.rho
-        warmup_length = self.warmup_length
-        horizon = self.horizon
-        max_time_length = self.nt
-        for basin in tqdm(range(basin_coordinates), file=sys.stdout, disable=False):
-            if self.is_tra_val_te != "train":
-                lookup.extend(
-                    (basin, f)
-                    for f in range(warmup_length, max_time_length - rho - horizon + 1)
-                )
-            else:
-                # some dataloader load data with warmup period, so leave some periods for it
-                # [warmup_len] -> time_start -> [rho] -> [horizon]
-                nan_array = np.isnan(self.y[basin, :, :])
-                lookup.extend(
-                    (basin, f)
-                    for f in range(warmup_length, max_time_length - rho - horizon + 1)
-                    if not np.all(nan_array[f + rho : f + rho + horizon])
-                )
-        self.lookup_table = dict(enumerate(lookup))
-        self.num_samples = len(self.lookup_table)
+        return (
+            notnan_cumsum[basins, times + rho + self.horizon]
+            - notnan_cumsum[basins, times + rho]
+        ) > 0
+
+    def _target_notnan_count(self):
+        """Number of non-NaN target variables at each (basin, time)"""
+        return np.count_nonzero(~np.isnan(self.y), axis=-1)
 
 
 class BasinSingleFlowDataset(BaseDataset):
     """one time length output for each grid in a batch"""
 
-    def __init__(self, data_cfgs: dict, is_tra_val_te: str):
-        super(BasinSingleFlowDataset, self).__init__(data_cfgs, is_tra_val_te)
+    supports_window_batches = False
+
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+    ):
+        super(BasinSingleFlowDataset, self).__init__(
+            data_cfgs, is_tra_val_te, shared_read
+        )
 
     def __getitem__(self, index):
         xc, ys = super(BasinSingleFlowDataset, self).__getitem__(index)
         y = ys[-1, :]
         return xc, y
 
+    def _gather_batch(self, indices):
+        # no vectorized gather for this dataset yet, fall back to per-item collation
+        return default_collate([self[i] for i in indices])
+
+    def to_device(self, device):
+        raise NotImplementedError(
+            f"{type(self).__name__} has no vectorized gather, it can't be device-resident"
+        )
+
     def __len__(self):
         return self.num_samples
 
@@ -462,7 +1527,20 @@ class BasinSingleFlowDataset(BaseDataset):
 class DplDataset(BaseDataset):
     """pytorch dataset for Differential parameter learning"""
 
-    def __init__(self, data_cfgs: dict, is_tra_val_te: str):
+    # attributes are already a separate input z of dPL models
+    supports_static_side_channel = False
+    # dPL models need both normalized and not normalized data of different windows
+    supports_normalize_on_batch = False
+
+    uses_train_dataset = True
+
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+        train_dataset: Optional["DplDataset"] = None,
+    ):
         """
         Parameters
         ----------
@@ -470,17 +1548,35 @@ class DplDataset(BaseDataset):
             configs for reading source data
         is_tra_val_te
             train, vaild or test
+        shared_read
+            data of the union period shared by datasets
+        train_dataset
+            the already built dataset of the training period with the same data_cfgs;
+            only used when target_as_input is True and is_tra_val_te is not train
         """
-        super(DplDataset, self).__init__(data_cfgs, is_tra_val_te)
+        self._train_dataset = train_dataset
+        super(DplDataset, self).__init__(data_cfgs, is_tra_val_te, shared_read)
         # we don't use y_un_norm as its name because in the main function we will use "y"
         # For physical hydrological models, we need warmup, hence the target values should exclude data in warmup period
         self.warmup_length = data_cfgs["warmup_length"]
         self.target_as_input = data_cfgs["target_as_input"]
         self.constant_only = data_cfgs["constant_only"]
-        if self.target_as_input and (not self.train_mode):
-            # if the target is used as input and train_mode is False,
-            # we need to get the target data in training period to generate pbm params
-            self.train_dataset = DplDataset(data_cfgs, is_tra_val_te="train")
+
+    @property
+    def train_dataset(self):
+        """If the target is used as input and train_mode is False,
+        we need to get the target data in training period to generate pbm params;
+        the dataset of the training period is the given one or built when it is used at first
+        """
+        if self._train_dataset is None and self.target_as_input and not self.train_mode:
+            self._train_dataset = DplDataset(
+                self.data_cfgs, is_tra_val_te="train", shared_read=self.shared_read
+            )
+        return self._train_dataset
+
+    @train_dataset.setter
+    def train_dataset(self, dataset):
+        self._train_dataset = dataset
 
     def __getitem__(self, item):
         """
@@ -556,6 +1652,49 @@ class DplDataset(BaseDataset):
             z_train,
         ), torch.from_numpy(y_train).float()
 
+    def _gather_batch(self, indices):
+        """Vectorized version of __getitem__ for a whole mini-batch"""
+        seq_first = self.seq_first
+        basins, time_starts = self._batch_basin_time(indices)
+        if self.train_mode:
+            x_norm, y_norm = self.x, self.y
+            x_len = self.warmup_length + self.rho + self.horizon
+            xc_norm_len = y_norm_len = x_len
+            y_len = self.rho + self.horizon
+        else:
+            if self.target_as_input:
+                # when target_as_input is True,
+                # we need to use training data to generate pbm params
+                x_norm, y_norm = self.train_dataset.x, self.train_dataset.y
+            else:
+                x_norm, y_norm = self.x, self.y
+            x_len = self.x_origin.shape[1]
+            xc_norm_len, y_norm_len = x_norm.shape[1], y_norm.shape[1]
+            y_len = self.y_origin.shape[1] - self.warmup_length
+        if self.constant_only and not self.target_as_input:
+            # only use attributes data for DL model
+            z_train = _batch_tensor(self.c[basins])
+        else:
+            xc_norm = self._gather_xc(
+                x_norm, basins, time_starts, xc_norm_len, seq_first
+            )
+            if self.target_as_input:
+                y_norm_ = _gather_windows(
+                    y_norm, basins, time_starts, y_norm_len, seq_first
+                )
+                # the order of xc_norm and y_norm matters, please be careful!
+                xc_norm = _concat((xc_norm, y_norm_))
+            z_train = _batch_tensor(xc_norm, seq_first)
+        x_train = _gather_windows(self.x_origin, basins, time_starts, x_len, seq_first)
+        y_train = _gather_windows(
+            self.y_origin, basins, time_starts + self.warmup_length, y_len, seq_first
+        )
+        # a list as default_collate gives, which model_infer expects
+        return [
+            _batch_tensor(x_train, seq_first),
+            z_train,
+        ], _batch_tensor(y_train, seq_first)
+
     def __len__(self):
         return self.num_samples if self.train_mode else len(self.t_s_dict["sites_id"])
 
@@ -563,14 +1702,19 @@ class DplDataset(BaseDataset):
 class FlexibleDataset(BaseDataset):
     """A dataset whose datasources are from multiple sources according to the configuration"""
 
-    def __init__(self, data_cfgs: dict, is_tra_val_te: str):
-        super(FlexibleDataset, self).__init__(data_cfgs, is_tra_val_te)
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+    ):
+        super(FlexibleDataset, self).__init__(data_cfgs, is_tra_val_te, shared_read)
 
     @property
     def data_source(self):
         source_cfgs = self.data_cfgs["source_cfgs"]
         return {
-            name: data_sources_dict[name](path)
+            name: get_data_source(name, path)
             for name, path in zip(
                 source_cfgs["source_names"], source_cfgs["source_paths"]
             )
@@ -609,28 +1753,26 @@ class FlexibleDataset(BaseDataset):
             x, y, c
         )
 
-    def _normalize(self):
+    def _scaler_data_source(self):
         var_to_source_map = self.data_cfgs["var_to_source_map"]
         for var_name in var_to_source_map:
             source_name = var_to_source_map[var_name]
             data_source_ = self.data_source[source_name]
             break
         # TODO: only support CAMELS for now
-        scaler_hub = ScalerHub(
-            self.y_origin,
-            self.x_origin,
-            self.c_origin,
-            data_cfgs=self.data_cfgs,
-            is_tra_val_te=self.is_tra_val_te,
-            data_source=data_source_.camels,
-        )
-        self.target_scaler = scaler_hub.target_scaler
-        return scaler_hub.x, scaler_hub.y, scaler_hub.c
+        return data_source_.camels
 
 
 class Seq2SeqDataset(BaseDataset):
-    def __init__(self, data_cfgs: dict, is_tra_val_te: str):
-        super(Seq2SeqDataset, self).__init__(data_cfgs, is_tra_val_te)
+    supports_normalize_on_batch = False
+
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+    ):
+        super(Seq2SeqDataset, self).__init__(data_cfgs, is_tra_val_te, shared_read)
 
     def _read_xyc(self):
         """
@@ -684,6 +1826,8 @@ class Seq2SeqDataset(BaseDataset):
         s = self.x[basin, time : time + rho, 1:]
         x = np.concatenate((p[:rho], s), axis=1)
 
+        if self.static_side_channel:
+            return self._item_side_channel(basin, time, x, p[rho:])
         if self.c is None or self.c.shape[-1] == 0:
             xc = x
         else:
@@ -711,10 +1855,67 @@ class Seq2SeqDataset(BaseDataset):
             torch.from_numpy(xh).float(),
         ], torch.from_numpy(y).float()
 
+    def _item_side_channel(self, basin, time, x, xh):
+        """a sample whose attributes are the last input rather than tiled in encoder/decoder inputs"""
+        rho = self.rho
+        horizon = self.horizon
+        prec = self.data_cfgs.get("prec_window", 0)
+        y = torch.from_numpy(
+            self.y[basin, time + rho - prec + 1 : time + rho + horizon + 1, :]
+        ).float()
+        xs = [torch.from_numpy(x).float(), torch.from_numpy(xh).float()]
+        if self.is_tra_val_te == "train":
+            xs.append(y)
+        if self.c is not None and self.c.shape[-1] > 0:
+            xs.append(torch.from_numpy(self.c[basin, :]).float())
+        return xs, y
+
+    def _gather_batch(self, indices):
+        """Vectorized version of __getitem__ for a whole mini-batch"""
+        seq_first = self.seq_first
+        rho = self.rho
+        horizon = self.horizon
+        prec = self.data_cfgs.get("prec_window", 0)
+        # the lookup table is used in all modes for seq2seq
+        basins, times = self._batch_windows(indices)
+        p = _gather_windows(
+            self.x[:, :, :1], basins, times + 1, rho + horizon, seq_first
+        )
+        s = _gather_windows(self.x[:, :, 1:], basins, times, rho, seq_first)
+        p_enc, p_dec = (p[:rho], p[rho:]) if seq_first else (p[:, :rho], p[:, rho:])
+        xc = [p_enc, s]
+        xh = [p_dec]
+        has_c = self.c is not None and self.c.shape[-1] > 0
+        if has_c and not self.static_side_channel:
+            c = self.c[basins]
+            xc.append(_broadcast_const(c, rho, seq_first))
+            xh.append(_broadcast_const(c, horizon, seq_first))
+        xc = _batch_tensor(_concat(xc), seq_first)
+        xh = _batch_tensor(_concat(xh), seq_first)
+        y = _batch_tensor(
+            _gather_windows(
+                self.y, basins, times + rho - prec + 1, horizon + prec, seq_first
+            ),
+            seq_first,
+        )
+        xs = [xc, xh, y] if self.is_tra_val_te == "train" else [xc, xh]
+        if has_c and self.static_side_channel:
+            # attributes are the last input of the model
+            xs.append(_batch_tensor(self.c[basins]))
+        return xs, y
+
 
 class TransformerDataset(Seq2SeqDataset):
-    def __init__(self, data_cfgs: dict, is_tra_val_te: str):
-        super(TransformerDataset, self).__init__(data_cfgs, is_tra_val_te)
+    supports_static_side_channel = False
+    supports_window_batches = False
+
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+    ):
+        super(TransformerDataset, self).__init__(data_cfgs, is_tra_val_te, shared_read)
 
     def __getitem__(self, item: int):
         basin, idx = self.lookup_table[item]
@@ -736,3 +1937,998 @@ class TransformerDataset(Seq2SeqDataset):
             torch.from_numpy(x).float(),
             torch.from_numpy(x_h).float(),
         ], torch.from_numpy(y).float()
+
+    def _gather_batch(self, indices):
+        # no vectorized gather for this dataset yet, fall back to per-item collation
+        return default_collate([self[i] for i in indices])
+
+    def to_device(self, device):
+        raise NotImplementedError(
+            f"{type(self).__name__} has no vectorized gather, it can't be device-resident"
+        )
+
+
+class OutOfCoreDataset(BaseDataset):
+    """A dataset which doesn't hold the whole time series in memory
+
+    Data is read from the data source in chunks of (a block of basins, a block of time steps)
+    when samples need them, normalized with saved statistics of DapengScaler and kept in a
+    bounded LRU cache, so memory is decided by the size of the cache rather than the data.
+    Chunks for upcoming samples could be loaded in a background thread by ``prefetch``,
+    which is called by PrefetchSampler.
+
+    When training without a stat_dict_file (or a dapengscaler_stat.json in test_path),
+    statistics are computed chunk by chunk with StreamingStat, in stat_workers processes.
+    NOTE: p10/p90 of the statistics are computed from a sample of values.
+    With nan_max_gap, each chunk is read with nan_max_gap + 1 more time steps on both sides
+    before its gaps are filled, so gaps crossing chunk boundaries are filled as in BaseDataset,
+    except the extrapolation of gaps at both ends of a series when its first/last two values
+    are farther than that; without nan_max_gap, gaps are only filled inside each chunk
+    and a warning is given
+    """
+
+    # chunks are already normalized when they are loaded
+    supports_normalize_on_batch = False
+    # samples are read from chunks one by one
+    supports_window_batches = False
+    # chunks on disk are indexed by the basins of data_cfgs
+    supports_basin_selection = False
+
+    # default values of data_cfgs["out_of_core_params"]
+    default_params = {
+        "chunk_length": 8760,
+        "chunk_basins": 100,
+        "cache_chunks": 32,
+        "prefetch_batches": 2,
+        "stat_workers": 0,
+    }
+
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+    ):
+        params = {
+            **self.default_params,
+            **(data_cfgs.get("out_of_core_params") or {}),
+        }
+        self.chunk_length = params["chunk_length"]
+        self.chunk_basins = params["chunk_basins"]
+        self.cache_chunks = params["cache_chunks"]
+        self.prefetch_batches = params["prefetch_batches"]
+        self.stat_workers = params["stat_workers"]
+        self.gap_overlap = self._gap_overlap(data_cfgs)
+        self._area = None
+        self._mean_prcp = None
+        # non-NaN target counts of chunks computed together with the statistics, see _chunk_stat
+        self._notnan_counts = None
+        self._init_chunk_cache()
+        super(OutOfCoreDataset, self).__init__(data_cfgs, is_tra_val_te, shared_read)
+
+    @staticmethod
+    def _gap_overlap(data_cfgs):
+        """Time steps read on each side of a chunk for filling its NaN gaps;
+        a gap of at most nan_max_gap steps and the values around it are then all read
+        """
+        if not (data_cfgs["relevant_rm_nan"] or data_cfgs["target_rm_nan"]):
+            return 0
+        max_gap = data_cfgs.get("nan_max_gap")
+        if max_gap is None:
+            warnings.warn(
+                "Without nan_max_gap, NaN gaps of OutOfCoreDataset are filled inside each chunk, "
+                "so gaps crossing chunk boundaries are filled differently from BaseDataset; "
+                "set nan_max_gap to fill them in the same way"
+            )
+            return 0
+        return max_gap + 1
+
+    def __getstate__(self):
+        # locks and threads can't be pickled for DataLoader workers; each worker has its own cache
+        state = super(OutOfCoreDataset, self).__getstate__()
+        for key in [
+            "_lock",
+            "_chunks",
+            "_loading",
+            "_prefetch_queue",
+            "_prefetch_thread",
+        ]:
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        super(OutOfCoreDataset, self).__setstate__(state)
+        self._init_chunk_cache()
+
+    def __getitem__(self, item: int):
+        basin, t_start, t_end = self._sample_window(item)
+        x, y = self._read_window(basin, t_start, t_end)
+        if self.train_mode:
+            y = y[self.warmup_length :]
+        return self._item_with_c(x, basin), torch.from_numpy(y).float()
+
+    def _gather_batch(self, indices):
+        # the data of a batch spreads over chunks, so we collate items one by one
+        return default_collate([self[i] for i in indices])
+
+    def to_device(self, device):
+        raise NotImplementedError(
+            f"{type(self).__name__} doesn't hold its data in memory, it can't be device-resident"
+        )
+
+    def prefetch(self, indices):
+        """Load chunks needed by samples of indices in a background thread
+
+        Parameters
+        ----------
+        indices
+            indices of upcoming samples
+        """
+        keys = []
+        for item in indices:
+            keys.extend(self._sample_chunk_keys(item))
+        if self._prefetch_thread is None:
+            self._prefetch_queue = queue.Queue()
+            self._prefetch_thread = threading.Thread(
+                target=self._prefetch_loop, daemon=True
+            )
+            self._prefetch_thread.start()
+        for key in dict.fromkeys(keys):
+            with self._lock:
+                loaded = key in self._chunks or key in self._loading
+            if not loaded:
+                self._prefetch_queue.put(key)
+
+    def _prefetch_loop(self):
+        while True:
+            key = self._prefetch_queue.get()
+            try:
+                self._get_chunk(key)
+            except Exception as e:
+                # the chunk will be read again (and the error raised) when a sample needs it
+                LOGGER.warning(f"Prefetching chunk {key} failed: {e}")
+
+    def _init_chunk_cache(self):
+        self._chunks = OrderedDict()
+        # events of chunks being read, so that a chunk is only read by one thread
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._prefetch_queue = None
+        self._prefetch_thread = None
+
+    def _load_data_stages(self):
+        if self.data_cfgs["scaler"] != "DapengScaler":
+            raise NotImplementedError(
+                "OutOfCoreDataset only supports DapengScaler, whose statistics could be applied to chunks"
+            )
+        self._times = self.times
+        key = (0, 0)
+        x, y = self._read_chunk(key, self.gap_overlap)
+        data_target = self._target_placeholder(y.attrs, len(self._times), self._times)
+        stat_file = scaler_stat_files(self.data_cfgs)[0]
+        scaler_store = self._scaler_store_path()
+        if (
+            self.is_tra_val_te == "train"
+            and self.data_cfgs["stat_dict_file"] is None
+            and not os.path.isfile(stat_file)
+            and not (
+                scaler_store is not None
+                and load_scaler_store(scaler_store, self.data_cfgs["test_path"])
+            )
+        ):
+            scaler_params = self.data_cfgs["scaler_params"]
+            self.target_scaler = DapengScaler(
+                data_target,
+                None,
+                None,
+                self.data_cfgs,
+                self.is_tra_val_te,
+                prcp_norm_cols=scaler_params["prcp_norm_cols"],
+                gamma_norm_cols=scaler_params["gamma_norm_cols"],
+                pbm_norm=scaler_params["pbm_norm"],
+                data_source=self._scaler_data_source(),
+                stat_dict={},
+            )
+            self.target_scaler.side_table.rebuild()
+            self.target_scaler.stat_dict.update(self._cal_stat_all())
+            with open(stat_file, "w") as fp:
+                json.dump(self.target_scaler.stat_dict, fp)
+            self.target_scaler.side_table.save_with_stat()
+            if scaler_store is not None:
+                save_scaler_store(
+                    scaler_store, [stat_file, side_table_file(self.data_cfgs)]
+                )
+        else:
+            self._prepare_stat_file()
+            self.target_scaler = load_target_scaler(
+                self.data_cfgs,
+                self.is_tra_val_te,
+                data_target=data_target,
+                data_source=self._scaler_data_source(),
+            )
+        self._put_chunk(key, self._normalize_chunk(key, x, y))
+        self.x, self.y = None, None
+        self.c = self._read_c()
+        # NOTE: chunks read later, e.g. for the lookup table and batches,
+        # are still added to the read stages of load_profile
+
+    def _cal_stat_all(self):
+        """Statistics of all variables in the same way as DapengScaler.cal_stat_all,
+        but merged chunk by chunk, so the whole time series is never in memory
+        """
+        scaler = self.target_scaler
+        if np.isin(self.data_cfgs["target_cols"], scaler.prcp_norm_cols).any():
+            # read once here rather than in every worker
+            self._mean_prcp = scaler.mean_prcp
+        keys = [
+            (basin_block, time_block)
+            for basin_block in range(math.ceil(self.ngrid / self.chunk_basins))
+            for time_block in range(math.ceil(len(self._times) / self.chunk_length))
+        ]
+        target_stat, forcing_stat, notnan_counts = cal_stat_chunks(
+            self._chunk_stat, keys, num_workers=self.stat_workers
+        )
+        self._notnan_counts = notnan_counts.counts
+        # same order as cal_stat_all, so later groups win for variables in both
+        stat_dict = {**target_stat.stat_dict(), **forcing_stat.stat_dict()}
+        constant_cols = self.data_cfgs["constant_cols"]
+        c = self._read_c_origin() if constant_cols else None
+        for var in constant_cols:
+            stat_dict[var] = cal_stat(c.sel(variable=var).to_numpy().astype(np.float64))
+        return stat_dict
+
+    def _chunk_stat(self, key):
+        """StreamingStat of targets and inputs of a chunk, and the non-NaN counts of its
+        gap-filled targets for the lookup table, so each chunk is read only once on a cold start
+        """
+        scaler = self.target_scaler
+        x_overlap, y_overlap = self._read_chunk(key, self.gap_overlap)
+        chunk_time = self._chunk_time(key)
+        x = x_overlap.isel(time=chunk_time)
+        y = y_overlap.isel(time=chunk_time)
+        mean_prcp = None
+        if self._mean_prcp is not None:
+            mean_prcp = self._mean_prcp[self._chunk_slices(key)[0]]
+        y = _prcp_norm_vars(y, scaler.prcp_norm_cols, mean_prcp, to_norm=True)
+        target_stat = StreamingStat(
+            self.data_cfgs["target_cols"], gamma_cols=scaler.log_norm_cols, seed=key
+        )
+        forcing_stat = StreamingStat(
+            self.data_cfgs["relevant_cols"],
+            gamma_cols=scaler.gamma_norm_cols,
+            seed=key,
+        )
+        target_stat.update(y.to_numpy())
+        forcing_stat.update(x.to_numpy())
+        # normalization keeps NaN values where they are, so gaps of not normalized targets
+        # are filled just like in _normalize_chunk
+        if self.data_cfgs["target_rm_nan"]:
+            _fill_gaps_da(
+                y_overlap,
+                fill_nan="interpolate",
+                max_gap=self.data_cfgs.get("nan_max_gap"),
+            )
+        y_notnan = ~np.isnan(y_overlap.isel(time=chunk_time).to_numpy())
+        notnan_counts = ChunkCounts({key: np.count_nonzero(y_notnan, axis=-1)})
+        return [target_stat, forcing_stat, notnan_counts]
+
+    def _read_c_origin(self):
+        data_attr_ds = self.data_source.read_attr_xrdataset(
+            self.basins, self.data_cfgs["constant_cols"], all_number=True
+        )
+        return self._trans2da_and_setunits(data_attr_ds)
+
+    def _read_c(self):
+        constant_cols = self.data_cfgs["constant_cols"]
+        if not constant_cols:
+            return np.zeros((self.ngrid, 0), dtype=self.dtype)
+        c = _trans_norm(
+            self._read_c_origin(), constant_cols, self.target_scaler.stat_dict
+        )
+        if self.data_cfgs["constant_rm_nan"]:
+            _fill_gaps_da(c, fill_nan="mean")
+        return c.transpose("basin", "variable").to_numpy()
+
+    def _read_area(self, basin_ids):
+        # areas of all basins are read once rather than for every chunk
+        if self._area is None:
+            self._area = BasinSideTable(
+                side_table_file(self.data_cfgs),
+                self.data_source,
+                self.data_cfgs["source_cfgs"],
+                scaler_stat_files(self.data_cfgs)[0],
+            ).area(self.basins)
+        return self._area.sel(basin=basin_ids)
+
+    def _chunk_slices(self, key):
+        basin_block, time_block = key
+        b_start = basin_block * self.chunk_basins
+        t_start = time_block * self.chunk_length
+        return (
+            slice(b_start, min(b_start + self.chunk_basins, self.ngrid)),
+            slice(t_start, min(t_start + self.chunk_length, len(self._times))),
+        )
+
+    def _read_chunk(self, key, overlap=0):
+        """Read not normalized x, y of a chunk from the data source,
+        with at most overlap more time steps on each side
+        """
+        basin_slice, time_slice = self._chunk_slices(key)
+        times = self._times[
+            max(time_slice.start - overlap, 0) : time_slice.stop + overlap
+        ]
+        date_format = detect_date_format(self.t_s_dict["t_final_range"][0])
+        data_forcing_ds, data_output_ds = self._read_ts_specified_time(
+            self.basins[basin_slice],
+            times[0].strftime(date_format),
+            times[-1].strftime(date_format),
+        )
+        x = self._trans2da_and_setunits(data_forcing_ds).transpose(
+            "basin", "time", "variable"
+        )
+        y = self._trans2da_and_setunits(data_output_ds).transpose(
+            "basin", "time", "variable"
+        )
+        if x.shape[1] != len(times) or y.shape[1] != len(times):
+            raise ValueError(
+                f"The data source returns {x.shape[1]} time steps for a chunk of {len(times)}"
+            )
+        return x, y
+
+    def _normalize_chunk(self, key, x, y):
+        """Normalize a chunk read with gap_overlap in the same way as DapengScaler,
+        fill its NaN gaps and cut the overlap off
+        """
+        scaler = self.target_scaler
+        basin_slice, time_slice = self._chunk_slices(key)
+        x = _trans_norm(
+            x,
+            self.data_cfgs["relevant_cols"],
+            scaler.stat_dict,
+            log_norm_cols=scaler.log_norm_cols,
+        )
+        target_cols = self.data_cfgs["target_cols"]
+        mean_prcp = None
+        if np.isin(target_cols, scaler.prcp_norm_cols).any():
+            if self._mean_prcp is None:
+                self._mean_prcp = scaler.mean_prcp
+            mean_prcp = self._mean_prcp[basin_slice]
+        y = _prcp_norm_vars(y, scaler.prcp_norm_cols, mean_prcp, to_norm=True)
+        y = _trans_norm(
+            y, target_cols, scaler.stat_dict, log_norm_cols=scaler.log_norm_cols
+        )
+        max_gap = self.data_cfgs.get("nan_max_gap")
+        if self.data_cfgs["relevant_rm_nan"]:
+            _fill_gaps_da(x, fill_nan="interpolate", max_gap=max_gap)
+        if self.data_cfgs["target_rm_nan"]:
+            _fill_gaps_da(y, fill_nan="interpolate", max_gap=max_gap)
+        chunk_time = self._chunk_time(key)
+        return (
+            x.isel(time=chunk_time).to_numpy(),
+            y.isel(time=chunk_time).to_numpy(),
+        )
+
+    def _chunk_time(self, key):
+        """Time steps of a chunk in its data read with gap_overlap"""
+        _, time_slice = self._chunk_slices(key)
+        start = time_slice.start - max(time_slice.start - self.gap_overlap, 0)
+        return slice(start, start + time_slice.stop - time_slice.start)
+
+    def _put_chunk(self, key, chunk):
+        with self._lock:
+            self._chunks[key] = chunk
+            self._chunks.move_to_end(key)
+            while len(self._chunks) > self.cache_chunks:
+                self._chunks.popitem(last=False)
+
+    def _get_chunk(self, key):
+        """Get normalized x, y of a chunk from the LRU cache or read it"""
+        while True:
+            with self._lock:
+                if key in self._chunks:
+                    self._chunks.move_to_end(key)
+                    return self._chunks[key]
+                event = self._loading.get(key)
+                if event is None:
+                    event = self._loading[key] = threading.Event()
+                    break
+            # another thread is reading this chunk
+            event.wait()
+        try:
+            chunk = self._normalize_chunk(key, *self._read_chunk(key, self.gap_overlap))
+            self._put_chunk(key, chunk)
+        finally:
+            with self._lock:
+                self._loading.pop(key).set()
+        return chunk
+
+    def _sample_window(self, item):
+        """basin, start and end time index of the data of a sample"""
+        if not self.train_mode:
+            return item, 0, len(self._times)
+        basin, idx = self.lookup_table[item]
+        return (
+            basin,
+            idx - self.warmup_length,
+            idx + self.rho + self.horizon,
+        )
+
+    def _sample_chunk_keys(self, item):
+        return self._window_chunk_keys(*self._sample_window(item))
+
+    def _window_chunk_keys(self, basin, t_start, t_end):
+        basin_block = basin // self.chunk_basins
+        return [
+            (basin_block, time_block)
+            for time_block in range(
+                t_start // self.chunk_length, (t_end - 1) // self.chunk_length + 1
+            )
+        ]
+
+    def _read_window(self, basin, t_start, t_end):
+        i = basin % self.chunk_basins
+        xs, ys = [], []
+        for key in self._window_chunk_keys(basin, t_start, t_end):
+            _, time_slice = self._chunk_slices(key)
+            x, y = self._get_chunk(key)
+            start = max(t_start, time_slice.start) - time_slice.start
+            end = min(t_end, time_slice.stop) - time_slice.start
+            xs.append(x[i, start:end])
+            ys.append(y[i, start:end])
+        return np.concatenate(xs), np.concatenate(ys)
+
+    def _target_notnan_count(self):
+        # counts computed with the statistics are used, otherwise stream over all chunks,
+        # so only the count is held in memory
+        count = np.zeros((self.ngrid, len(self._times)), dtype=np.uint8)
+        n_basin_blocks = math.ceil(self.ngrid / self.chunk_basins)
+        n_time_blocks = math.ceil(len(self._times) / self.chunk_length)
+        notnan_counts, self._notnan_counts = self._notnan_counts, None
+        for basin_block in range(n_basin_blocks):
+            for time_block in range(n_time_blocks):
+                key = (basin_block, time_block)
+                basin_slice, time_slice = self._chunk_slices(key)
+                if notnan_counts is not None:
+                    count[basin_slice, time_slice] = notnan_counts[key]
+                    continue
+                _, y = self._get_chunk(key)
+                count[basin_slice, time_slice] = np.count_nonzero(~np.isnan(y), axis=-1)
+        return count
+
+
+class RaggedDataset(BaseDataset):
+    """A dataset for basins with different time ranges, stored without padding
+
+    t_range_xxx in data_cfgs could be a list of [start, end], one for each basin.
+    x and y of all basins are concatenated along time into one (total_length, variable) array,
+    and the series of basin i is x[offsets[i] : offsets[i + 1]], so basins with short records
+    don't waste memory on NaN; samples are only built inside each basin's own time range.
+
+    NOTE: only DapengScaler is supported now; for valid/test, basins' series have different lengths,
+    so a mini-batch of them can only be collated when their lengths are same
+    """
+
+    supports_normalize_on_batch = False
+    shared_array_names = BaseDataset.shared_array_names + ("offsets",)
+    # basins are concatenated along time, so they can't be selected by the first axis
+    supports_basin_selection = False
+
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+    ):
+        super(RaggedDataset, self).__init__(data_cfgs, is_tra_val_te, shared_read)
+
+    @property
+    def nt(self):
+        """length of the longest time series in all basins"""
+        return int(np.diff(self.offsets).max())
+
+    @property
+    def times(self):
+        """time series of each basin"""
+        time_step = (
+            f"{self.data_cfgs['min_time_interval']}{self.data_cfgs['min_time_unit']}"
+        )
+        return [
+            pd.date_range(
+                start=_parse_date(start_date), end=_parse_date(end_date), freq=time_step
+            )
+            for start_date, end_date in self.basin_t_ranges
+        ]
+
+    def __getitem__(self, item: int):
+        if not self.train_mode:
+            start, end = self.offsets[item], self.offsets[item + 1]
+            basin = item
+            x = self.x[start:end]
+            y = self.y[start:end]
+        else:
+            basin, time = self.lookup_table[item]
+            start = self.offsets[basin] + time
+            x = self.x[start - self.warmup_length : start + self.rho + self.horizon]
+            y = self.y[start : start + self.rho + self.horizon]
+        return self._item_with_c(x, basin), torch.from_numpy(y).float()
+
+    def _gather_batch(self, indices):
+        if not self.train_mode:
+            # series of basins may have different lengths
+            return default_collate([self[i] for i in indices])
+        seq_first = self.seq_first
+        basins, times = self._batch_windows(indices)
+        starts = self.offsets[basins] + times
+        # all series are in one "basin" of the concatenated arrays
+        flat = basins * 0
+        x_len = self.warmup_length + self.rho + self.horizon
+        x = _gather_windows(
+            self.x[None], flat, starts - self.warmup_length, x_len, seq_first
+        )
+        x = self._batch_with_c(x, basins, x_len, seq_first)
+        y = _gather_windows(
+            self.y[None], flat, starts, self.rho + self.horizon, seq_first
+        )
+        return _batch_tensor(x, seq_first), _batch_tensor(y, seq_first)
+
+    def to_device(self, device):
+        if not self.train_mode:
+            raise NotImplementedError(
+                "Series of basins in valid/test have different lengths, they can't be device-resident"
+            )
+        dataset = super(RaggedDataset, self).to_device(device)
+        dataset.offsets = torch.from_numpy(self.offsets).to(device)
+        return dataset
+
+    def _dataset_cache_path(self):
+        # the cache only knows dense arrays now
+        return None
+
+    def _pre_load_data(self):
+        super(RaggedDataset, self)._pre_load_data()
+        if self.data_cfgs["scaler"] != "DapengScaler":
+            raise NotImplementedError(
+                "RaggedDataset only supports DapengScaler now, please choose it"
+            )
+        t_range = self.t_s_dict["t_final_range"]
+        if isinstance(t_range[0], str):
+            t_ranges = [t_range] * self.ngrid
+        elif len(t_range) == 1:
+            t_ranges = [t_range[0]] * self.ngrid
+        elif len(t_range) == self.ngrid:
+            t_ranges = t_range
+        else:
+            raise ValueError(
+                "The number of time ranges should be equal to the number of basins "
+                "if you choose different time ranges for different basins"
+            )
+        self.basin_t_ranges = [tuple(t_range_) for t_range_ in t_ranges]
+
+    def _read_xyc(self):
+        """Read x, y of basins with the same time range together and concatenate them"""
+        groups = {}
+        for i, t_range in enumerate(self.basin_t_ranges):
+            groups.setdefault(t_range, []).append(i)
+        xs, ys = [None] * self.ngrid, [None] * self.ngrid
+        for (start_date, end_date), basin_idx in groups.items():
+            data_forcing_ds, data_output_ds = self._read_ts_specified_time(
+                [self.basins[i] for i in basin_idx], start_date, end_date
+            )
+            x = self._trans2da_and_setunits(data_forcing_ds)
+            y = self._trans2da_and_setunits(data_output_ds)
+            self.target_attrs = y.attrs
+            x = x.transpose("basin", "time", "variable").to_numpy()
+            y = y.transpose("basin", "time", "variable").to_numpy()
+            for j, i in enumerate(basin_idx):
+                xs[i], ys[i] = x[j], y[j]
+        self.offsets = np.concatenate([[0], np.cumsum([len(x) for x in xs])])
+        self.x_origin = np.concatenate(xs)
+        self.y_origin = np.concatenate(ys)
+        data_attr_ds = self.data_source.read_attr_xrdataset(
+            self.basins, self.data_cfgs["constant_cols"], all_number=True
+        )
+        self.c_origin = self._trans2da_and_setunits(data_attr_ds)
+
+    def _normalize(self):
+        scaler_params = self.data_cfgs["scaler_params"]
+        scaler_store = self._scaler_store_path()
+        if (
+            self.is_tra_val_te == "train"
+            and self.data_cfgs["stat_dict_file"] is None
+            and not (
+                scaler_store is not None
+                and load_scaler_store(scaler_store, self.data_cfgs["test_path"])
+            )
+        ):
+            # filled below, as mean_prcp of the scaler is needed for calculating it
+            stat_dict = {}
+        else:
+            self._prepare_stat_file()
+            with open(scaler_stat_files(self.data_cfgs)[0], "r") as fp:
+                stat_dict = json.load(fp)
+        self.target_scaler = DapengScaler(
+            self._target_placeholder(self.target_attrs, self.nt),
+            None,
+            None,
+            self.data_cfgs,
+            self.is_tra_val_te,
+            prcp_norm_cols=scaler_params["prcp_norm_cols"],
+            gamma_norm_cols=scaler_params["gamma_norm_cols"],
+            pbm_norm=scaler_params["pbm_norm"],
+            data_source=self._scaler_data_source(),
+            stat_dict=stat_dict,
+        )
+        if not stat_dict:
+            self.target_scaler.side_table.rebuild()
+            stat_dict.update(self._cal_stat_all())
+            stat_file = scaler_stat_files(self.data_cfgs)[0]
+            with open(stat_file, "w") as fp:
+                json.dump(stat_dict, fp)
+            self.target_scaler.side_table.save_with_stat()
+            if scaler_store is not None:
+                save_scaler_store(
+                    scaler_store, [stat_file, side_table_file(self.data_cfgs)]
+                )
+        scaler = self.target_scaler
+        x = _trans_norm(
+            self._flat_dataarray(self.x_origin, self.data_cfgs["relevant_cols"]),
+            self.data_cfgs["relevant_cols"],
+            stat_dict,
+            log_norm_cols=scaler.log_norm_cols,
+        )
+        y = self._flat_dataarray(
+            self._prcp_norm_targets(self.y_origin), self.data_cfgs["target_cols"]
+        )
+        y = _trans_norm(
+            y,
+            self.data_cfgs["target_cols"],
+            stat_dict,
+            log_norm_cols=scaler.log_norm_cols,
+        )
+        c = _trans_norm(self.c_origin, self.data_cfgs["constant_cols"], stat_dict)
+        return x, y, c
+
+    def _cal_stat_all(self):
+        """Statistics of all variables in the same way as DapengScaler.cal_stat_all"""
+        scaler = self.target_scaler
+        stat_dict = {}
+        y = self._prcp_norm_targets(self.y_origin.astype(np.float64))
+        for i, var in enumerate(self.data_cfgs["target_cols"]):
+            if var in scaler.log_norm_cols:
+                stat_dict[var] = cal_stat_gamma(y[:, i])
+            else:
+                stat_dict[var] = cal_stat(y[:, i])
+        x = self.x_origin.astype(np.float64)
+        for i, var in enumerate(self.data_cfgs["relevant_cols"]):
+            if var in scaler.gamma_norm_cols:
+                stat_dict[var] = cal_stat_gamma(x[:, i])
+            else:
+                stat_dict[var] = cal_stat(x[:, i])
+        for var in self.data_cfgs["constant_cols"]:
+            stat_dict[var] = cal_stat(
+                self.c_origin.sel(variable=var).to_numpy().astype(np.float64)
+            )
+        return stat_dict
+
+    def _prcp_norm_targets(self, y):
+        """Divide targets in prcp_norm_cols by mean precipitation of their basins"""
+        scaler = self.target_scaler
+        prcp_norm_idx = [
+            i
+            for i, var in enumerate(self.data_cfgs["target_cols"])
+            if var in scaler.prcp_norm_cols
+        ]
+        if not prcp_norm_idx:
+            return y
+        y = y.copy()
+        mean_prcp = np.repeat(scaler.mean_prcp[:, 0], np.diff(self.offsets))
+        y[:, prcp_norm_idx] = y[:, prcp_norm_idx] / mean_prcp[:, None]
+        return y
+
+    def _flat_dataarray(self, arr, var_lst):
+        return xr.DataArray(
+            arr, dims=["time", "variable"], coords={"variable": var_lst}
+        )
+
+    def _kill_nan(self, x, y, c):
+        x, y = x.to_numpy(), y.to_numpy()
+        for arr, rm_nan in [
+            (x, self.data_cfgs["relevant_rm_nan"]),
+            (y, self.data_cfgs["target_rm_nan"]),
+        ]:
+            if not rm_nan:
+                continue
+            # interpolate inside each basin's own series
+            for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+                _fill_gaps_da(
+                    xr.DataArray(arr[start:end].T, dims=["variable", "time"]),
+                    fill_nan="interpolate",
+                    max_gap=self.data_cfgs.get("nan_max_gap"),
+                )
+        if self.data_cfgs["constant_rm_nan"]:
+            _fill_gaps_da(c, fill_nan="mean")
+        return x, y, c
+
+    def _trans2nparr(self):
+        self.c = self.c.transpose("basin", "variable").to_numpy()
+        self.c_origin = self.c_origin.transpose("basin", "variable").to_numpy()
+
+    def _create_lookup_table(self):
+        """Samples of each basin only start inside its own time range"""
+        first, end = self._window_start_range()
+        num_windows = end - first
+        basin_idx = np.repeat(np.arange(self.ngrid), num_windows)
+        window_offsets = np.concatenate([[0], np.cumsum(num_windows)[:-1]])
+        time_idx = (
+            np.arange(basin_idx.size)
+            - np.repeat(window_offsets, num_windows)
+            + self.warmup_length
+        )
+        if self.is_tra_val_te == "train":
+            valid = self._windows_with_target(
+                self._target_notnan_cumsum(), basin_idx, time_idx
+            )
+            basin_idx, time_idx = basin_idx[valid], time_idx[valid]
+        self.lookup_table = LookupTable(basin_idx, time_idx)
+
+    def _window_start_range(self):
+        lengths = np.diff(self.offsets)
+        first = np.full(self.ngrid, self.warmup_length, dtype=np.int64)
+        end = lengths - self.rho - self.horizon + 1
+        return first, np.maximum(end, first)
+
+    def _target_notnan_cumsum(self):
+        # targets of all basins are concatenated along time
+        notnan_cumsum = np.zeros(self.offsets[-1] + 1, dtype=np.int64)
+        np.cumsum(np.count_nonzero(~np.isnan(self.y), axis=-1), out=notnan_cumsum[1:])
+        return notnan_cumsum
+
+    def _windows_with_target(self, notnan_cumsum, basins, times):
+        starts = self.offsets[basins] + times
+        return (
+            notnan_cumsum[starts + self.rho + self.horizon]
+            - notnan_cumsum[starts + self.rho]
+        ) > 0
+
+
+class MultiFreqDataset(BaseDataset):
+    """A dataset whose inputs have two frequencies, e.g. daily and hourly, each kept at its own resolution
+
+    The data source should return a dict keyed by time unit from read_ts_xrdataset.
+    Targets and high-frequency inputs are read at f"{min_time_interval}{min_time_unit}",
+    and variables in multi_freq_params["low_freq_cols"] are read at multi_freq_params["low_freq_unit"].
+    For each high-frequency step, low_end records how many low-frequency periods have ended by its end,
+    so the low-frequency window of a sample is the low_freq_history periods before the end of its x window.
+    Each sample is [x_low, x] (plus c if static_side_channel is True) and y.
+
+    NOTE: samples are windows of the lookup table in all modes, just like Seq2SeqDataset;
+    the time of each period is its start; only DapengScaler is supported now
+    """
+
+    supports_normalize_on_batch = False
+    shared_array_names = BaseDataset.shared_array_names + (
+        "x_low",
+        "x_low_origin",
+        "low_end",
+    )
+    basin_array_names = BaseDataset.basin_array_names + ("x_low", "x_low_origin")
+
+    def __init__(
+        self,
+        data_cfgs: dict,
+        is_tra_val_te: str,
+        shared_read: Optional[SharedPeriodRead] = None,
+    ):
+        super(MultiFreqDataset, self).__init__(data_cfgs, is_tra_val_te, shared_read)
+
+    @property
+    def precipitation_name(self):
+        return self.high_freq_cols[0]
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, item: int):
+        basin, time = self.lookup_table[item]
+        y_len = self.rho + self.horizon
+        x = self.x[basin, time - self.warmup_length : time + y_len, :]
+        low_end = self.low_end[time + y_len - 1]
+        x_low = self.x_low[basin, low_end - self.low_freq_history : low_end, :]
+        y = self.y[basin, time : time + y_len, :]
+        xc = self._item_with_c(x, basin)
+        xs = [torch.from_numpy(x_low).float()]
+        xs.extend(xc if isinstance(xc, list) else [xc])
+        return xs, torch.from_numpy(y).float()
+
+    def _gather_batch(self, indices):
+        seq_first = self.seq_first
+        basins, times = self._batch_windows(indices)
+        y_len = self.rho + self.horizon
+        x_len = self.warmup_length + y_len
+        x = _gather_windows(
+            self.x, basins, times - self.warmup_length, x_len, seq_first
+        )
+        xc = self._batch_with_c(x, basins, x_len, seq_first)
+        low_starts = self.low_end[times + y_len - 1] - self.low_freq_history
+        x_low = _gather_windows(
+            self.x_low, basins, low_starts, self.low_freq_history, seq_first
+        )
+        y = _gather_windows(self.y, basins, times, y_len, seq_first)
+        xs = [x_low] + (xc if isinstance(xc, list) else [xc])
+        return _batch_tensor(xs, seq_first), _batch_tensor(y, seq_first)
+
+    def to_device(self, device):
+        dataset = super(MultiFreqDataset, self).to_device(device)
+        dataset.x_low = torch.from_numpy(np.array(self.x_low)).to(device)
+        dataset.low_end = torch.from_numpy(self.low_end).to(device)
+        return dataset
+
+    def _dataset_cache_path(self):
+        # the cache doesn't know low-frequency arrays now
+        return None
+
+    def _pre_load_data(self):
+        super(MultiFreqDataset, self)._pre_load_data()
+        if self.data_cfgs["scaler"] != "DapengScaler":
+            raise NotImplementedError(
+                "MultiFreqDataset only supports DapengScaler now, please choose it"
+            )
+        multi_freq_params = self.data_cfgs["multi_freq_params"]
+        self.low_freq_unit = multi_freq_params["low_freq_unit"]
+        self.low_freq_cols = list(multi_freq_params["low_freq_cols"])
+        self.low_freq_history = multi_freq_params["low_freq_history"]
+        self.high_freq_unit = (
+            f"{self.data_cfgs['min_time_interval']}{self.data_cfgs['min_time_unit']}"
+        )
+        self.high_freq_cols = [
+            var
+            for var in self.data_cfgs["relevant_cols"]
+            if var not in self.low_freq_cols
+        ]
+        if not self.low_freq_cols or not self.high_freq_cols:
+            raise ValueError(
+                "MultiFreqDataset needs both low-frequency and high-frequency variables in relevant_cols"
+            )
+        if pd.to_timedelta(self.low_freq_unit) <= pd.to_timedelta(self.high_freq_unit):
+            raise ValueError(
+                f"low_freq_unit {self.low_freq_unit} should be longer than {self.high_freq_unit}"
+            )
+
+    def _read_xyc(self):
+        """Read x, y at the high frequency, x_low at the low frequency, and c"""
+        data_forcing_ds, data_output_ds = self._check_ts_xrds_unit(
+            self._read_ts_freq(self.high_freq_cols, self.high_freq_unit),
+            self._read_ts_freq(self.data_cfgs["target_cols"], self.high_freq_unit),
+        )
+        data_attr_ds = self.data_source.read_attr_xrdataset(
+            self.basins, self.data_cfgs["constant_cols"], all_number=True
+        )
+        self.x_origin, self.y_origin, self.c_origin = self._to_dataarray_with_unit(
+            data_forcing_ds, data_output_ds, data_attr_ds
+        )
+        self.x_low_origin = self._trans2da_and_setunits(
+            self._read_ts_freq(self.low_freq_cols, self.low_freq_unit)
+        )
+        self.low_end = self._low_end_index(
+            self.x_low_origin.indexes["time"], self.x_origin.indexes["time"]
+        )
+
+    def _read_ts_freq(self, var_lst, time_unit):
+        """time series of var_lst at one frequency in the time range of the dataset"""
+        with self._profile_stage("read_ts_xrdataset") as record:
+            ts = self.data_source.read_ts_xrdataset(
+                self.basins,
+                list(self.t_s_dict["t_final_range"]),
+                var_lst,
+                time_units=[time_unit],
+            )
+            if not isinstance(ts, dict):
+                raise ValueError(
+                    "MultiFreqDataset needs a data source which returns a dict keyed by time unit"
+                )
+            record["nbytes"] += int(ts[time_unit].nbytes)
+        return ts[time_unit]
+
+    def _low_end_index(self, low_times, high_times):
+        """For each high-frequency step, the number of low-frequency periods which end before its end
+
+        Parameters
+        ----------
+        low_times
+            start times of low-frequency periods
+        high_times
+            start times of high-frequency periods
+
+        Returns
+        -------
+        np.ndarray
+            int64 array with the same length as high_times
+        """
+        low_ends = low_times + pd.to_timedelta(self.low_freq_unit)
+        high_ends = high_times + pd.to_timedelta(self.high_freq_unit)
+        return np.searchsorted(low_ends.values, high_ends.values, side="right").astype(
+            np.int64
+        )
+
+    def _normalize(self):
+        # the scaler of high-frequency data only knows high-frequency inputs
+        high_freq_cfgs = {**self.data_cfgs, "relevant_cols": self.high_freq_cols}
+        scaler_params = self.data_cfgs["scaler_params"]
+        stat_file = scaler_stat_files(self.data_cfgs)[0]
+        scaler_store = self._scaler_store_path()
+        if (
+            self.is_tra_val_te == "train"
+            and self.data_cfgs["stat_dict_file"] is None
+            and not (
+                scaler_store is not None
+                and load_scaler_store(scaler_store, self.data_cfgs["test_path"])
+            )
+        ):
+            # filled below with statistics of low-frequency inputs, too, before they are saved
+            stat_dict = {}
+        else:
+            self._prepare_stat_file()
+            with open(stat_file, "r") as fp:
+                stat_dict = json.load(fp)
+        self.target_scaler = DapengScaler(
+            self.y_origin,
+            self.x_origin,
+            self.c_origin,
+            high_freq_cfgs,
+            self.is_tra_val_te,
+            prcp_norm_cols=scaler_params["prcp_norm_cols"],
+            gamma_norm_cols=scaler_params["gamma_norm_cols"],
+            pbm_norm=scaler_params["pbm_norm"],
+            data_source=self._scaler_data_source(),
+            stat_dict=stat_dict,
+        )
+        if not stat_dict:
+            self.target_scaler.side_table.rebuild()
+            stat_dict.update(self.target_scaler.cal_stat_all())
+            for var in self.low_freq_cols:
+                data = self.x_low_origin.sel(variable=var).to_numpy().astype(np.float64)
+                if var in self.target_scaler.gamma_norm_cols:
+                    stat_dict[var] = cal_stat_gamma(data)
+                else:
+                    stat_dict[var] = cal_stat(data)
+            with open(stat_file, "w") as fp:
+                json.dump(stat_dict, fp)
+            self.target_scaler.side_table.save_with_stat()
+            if scaler_store is not None:
+                save_scaler_store(
+                    scaler_store, [stat_file, side_table_file(self.data_cfgs)]
+                )
+        x, y, c = self.target_scaler.load_data()
+        self.x_low = _trans_norm(
+            self.x_low_origin,
+            self.low_freq_cols,
+            stat_dict,
+            log_norm_cols=self.target_scaler.log_norm_cols,
+        )
+        return x, y, c
+
+    def _kill_nan(self, x, y, c):
+        x, y, c = super(MultiFreqDataset, self)._kill_nan(x, y, c)
+        self._fill_gaps_and_report(
+            "x_low",
+            self.x_low,
+            self.data_cfgs["relevant_rm_nan"],
+            "interpolate",
+            self.data_cfgs.get("nan_max_gap"),
+        )
+        return x, y, c
+
+    def _trans2nparr(self):
+        super(MultiFreqDataset, self)._trans2nparr()
+        self.x_low = self.x_low.transpose("basin", "time", "variable").to_numpy()
+        self.x_low_origin = self.x_low_origin.transpose(
+            "basin", "time", "variable"
+        ).to_numpy()
+
+    def _window_start_range(self):
+        """Windows of BaseDataset, except those without a whole low-frequency window"""
+        first, end = super(MultiFreqDataset, self)._window_start_range()
+        # low_end is non-decreasing, so windows ending from this step have enough low-frequency periods
+        first_end = np.searchsorted(self.low_end, self.low_freq_history)
+        first = np.maximum(first, first_end - self.rho - self.horizon + 1)
+        return first, np.maximum(end, first)
@@ -9,7 +9,9 @@ Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
 import collections
+import json
 import os
+import threading
 import numpy as np
 import pandas as pd
 import xarray as xr
@@ -727,3 +729,60 @@ data_sources_dict = {
     "nldas4camels": Nldas4Camels,
     "smap4camels": Smap4Camels,
 }
+
+# data source instances shared in the process, keyed by (name, path, settings)
+_DATA_SOURCE_INSTANCES = {}
+_DATA_SOURCE_LOCK = threading.Lock()
+
+
+def _data_source_key(source_name, source_path, other_settings):
+    return (
+        source_name,
+        str(source_path),
+        json.dumps(other_settings, sort_keys=True, default=str),
+    )
+
+
+def get_data_source(source_name: str, source_path, **other_settings):
+    """Get the data source instance shared in this process
+
+    Constructing a data source may scan directories and parse metadata,
+    so datasets, scalers and resulters share one instance for the same configs.
+
+    Parameters
+    ----------
+    source_name
+        key in data_sources_dict
+    source_path
+        path of the data source
+    other_settings
+        other parameters for initializing the data source
+
+    Returns
+    -------
+    object
+        the data source instance
+    """
+    source_class = data_sources_dict[source_name]
+    key = _data_source_key(source_name, source_path, other_settings)
+    with _DATA_SOURCE_LOCK:
+        instance = _DATA_SOURCE_INSTANCES.get(key)
+        # the class registered for the name may be changed
+        if type(instance) is not source_class:
+            instance = source_class(source_path, **other_settings)
+            _DATA_SOURCE_INSTANCES[key] = instance
+    return instance
+
+
+def clear_data_sources(source_name: str = None):
+    """Drop shared data source instances, e.g. when files of a data source are changed
+
+    Parameters
+    ----------
+    source_name
+        only drop instances of this data source; if None, drop all
+    """
+    with _DATA_SOURCE_LOCK:
+        for key in list(_DATA_SOURCE_INSTANCES):
+            if source_name is None or key[0] == source_name:
+                del _DATA_SOURCE_INSTANCES[key]
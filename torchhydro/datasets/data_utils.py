@@ -8,7 +8,7 @@ FilePath: \torchhydro\torchhydro\datasets\data_utils.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
-from typing import Union
+from typing import Optional, Union
 from collections import OrderedDict
 import numpy as np
 import xarray as xr
@@ -56,6 +56,86 @@ def warn_if_nan(dataarray, max_display=5, nan_mode="any"):
     return True
 
 
+def interpolate_nan(
+    data: np.ndarray,
+    max_gap: Optional[int] = None,
+    nan_mask: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Linearly interpolate NaN gaps of all rows of a 2-d array along its last axis at once
+
+    It has the same results as xarray's interpolate_na(dim="time", fill_value="extrapolate")
+    for series with regular time steps: gaps at both ends are linearly extrapolated
+    with the first/last two values, and series with less than two values are not filled.
+
+    Parameters
+    ----------
+    data
+        array with shape (series, time), filled in place
+    max_gap
+        the maximum number of consecutive NaN values which are filled;
+        longer gaps are kept as NaN; None means no limit
+    nan_mask
+        np.isnan(data) if it is already known; it is updated in place to mark NaN values left
+
+    Returns
+    -------
+    np.ndarray
+        the filled data
+    """
+    if nan_mask is None:
+        nan_mask = np.isnan(data)
+    if not (data.flags.c_contiguous and nan_mask.flags.c_contiguous):
+        values, mask = np.ascontiguousarray(data), np.ascontiguousarray(nan_mask)
+        interpolate_nan(values, max_gap, mask)
+        data[...], nan_mask[...] = values, mask
+        return data
+    # rows are filled in blocks to bound the memory of the index arrays
+    block_size = max(1, 2**22 // max(data.shape[1], 1))
+    for start in range(0, data.shape[0], block_size):
+        block = slice(start, start + block_size)
+        _interpolate_rows(data[block], nan_mask[block], max_gap)
+    return data
+
+
+def _interpolate_rows(values, nan_mask, max_gap=None):
+    """interpolate_nan for C-contiguous rows; values and nan_mask are updated in place
+
+    Only NaN positions are visited: their neighboring values are found in
+    the sorted flat positions of all values
+    """
+    nt = values.shape[1]
+    flat_values, flat_nan = values.reshape(-1), nan_mask.reshape(-1)
+    valid_pos = np.flatnonzero(~flat_nan)
+    nan_pos = np.flatnonzero(flat_nan)
+    rows = nan_pos // nt
+    # values of row i are valid_pos[row_start[i] : row_start[i] + row_count[i]]
+    row_count = nt - nan_mask.sum(axis=1)
+    row_start = np.concatenate(([0], np.cumsum(row_count)[:-1]))
+    # series with less than two values are not filled
+    enough = row_count[rows] >= 2
+    nan_pos, rows = nan_pos[enough], rows[enough]
+    first, last = row_start[rows], row_start[rows] + row_count[rows] - 1
+    # index of the nearest value after each NaN value
+    after = np.searchsorted(valid_pos, nan_pos)
+    lead, trail = after == first, after > last
+    # extrapolate with the first two values before the first one, the last two after the last one
+    left = np.where(lead, first, np.where(trail, last - 1, after - 1))
+    left_pos, right_pos = valid_pos[left], valid_pos[left + 1]
+    if max_gap is not None:
+        # a gap before the first value starts from the beginning of the row,
+        # and a gap after the last value lasts to the end of the row
+        gap_start = np.where(lead, rows * nt - 1, np.where(trail, right_pos, left_pos))
+        gap_end = np.where(lead, left_pos, np.where(trail, rows * nt + nt, right_pos))
+        keep = gap_end - gap_start - 1 <= max_gap
+        nan_pos, left_pos, right_pos = nan_pos[keep], left_pos[keep], right_pos[keep]
+    value_left, value_right = flat_values[left_pos], flat_values[right_pos]
+    flat_values[nan_pos] = value_left + (value_right - value_left) * (
+        (nan_pos - left_pos) / (right_pos - left_pos)
+    )
+    flat_nan[nan_pos] = False
+
+
 def unify_streamflow_unit(ds: xr.Dataset, area=None, inverse=False):
     """Unify the unit of xr_dataset to be mm/day in a basin or inverse
 
@@ -118,6 +198,82 @@ def wrap_t_s_dict(data_cfgs: dict, is_tra_val_te: str) -> OrderedDict:
     return OrderedDict(sites_id=basins_id, t_final_range=t_range_list)
 
 
+def _norm_params(variables, stat_dict: dict, log_norm_cols=None, var_lst=None):
+    """Per-variable parameters of _norm_kernel from statistics in stat_dict
+
+    Parameters
+    ----------
+    variables
+        variables in the order of the variable axis of the data
+    stat_dict
+        statistics of all variables, [p10, p90, mean, std] for each one
+    log_norm_cols
+        variables which use the log(sqrt(x) + 0.1) transform before normalization
+    var_lst
+        if given, only variables in it are normalized, and the others have NaN parameters
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        mean, std and the boolean log-norm mask of the variables
+    """
+    if log_norm_cols is None:
+        log_norm_cols = []
+    nan_stat = [np.nan] * 4
+    stat = np.array(
+        [
+            (stat_dict[var] if var_lst is None or var in var_lst else nan_stat)
+            for var in variables
+        ],
+        dtype=np.float64,
+    ).reshape(-1, 4)
+    return stat[:, 2], stat[:, 3], np.isin(variables, log_norm_cols)
+
+
+def _norm_kernel(data, mean, std, log_norm, to_norm=True):
+    """Normalize or denormalize all variables of data at once, the same as _trans_norm does
+
+    The last axis of data is variables. The transform is vectorized over all variables with
+    per-variable mean and std and a boolean mask of variables using the log(sqrt(x) + 0.1) transform,
+    and only one array is allocated for the output. Floating data keeps its dtype.
+
+    Parameters
+    ----------
+    data
+        np.ndarray whose last axis is variables
+    mean
+        mean of each variable
+    std
+        standard deviation of each variable
+    log_norm
+        True for variables using the log(sqrt(x) + 0.1) transform
+    to_norm
+        if true, normalize; else denormalize
+
+    Returns
+    -------
+    np.ndarray
+        normalized or denormalized data
+    """
+    data = np.asarray(data)
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+    mean = np.asarray(mean).astype(dtype)
+    std = np.asarray(std).astype(dtype)
+    log_norm = np.asarray(log_norm, dtype=bool)
+    if to_norm:
+        out = data.astype(dtype, copy=True)
+        if log_norm.any():
+            out[..., log_norm] = np.log10(np.sqrt(np.abs(out[..., log_norm])) + 0.1)
+        out -= mean
+        out /= std
+    else:
+        out = np.multiply(data, std, dtype=dtype)
+        out += mean
+        if log_norm.any():
+            out[..., log_norm] = (np.power(10, out[..., log_norm]) - 0.1) ** 2
+    return out
+
+
 def _trans_norm(
     x: xr.DataArray,
     var_lst: list,
@@ -163,22 +319,15 @@ def _trans_norm(
         log_norm_cols = []
     if type(var_lst) is str:
         var_lst = [var_lst]
-    out = xr.full_like(x, np.nan)
-    for item in var_lst:
-        stat = stat_dict[item]
-        if to_norm:
-            out.loc[dict(variable=item)] = (
-                (np.log10(np.sqrt(np.abs(x.sel(variable=item))) + 0.1) - stat[2])
-                / stat[3]
-                if item in log_norm_cols
-                else (x.sel(variable=item) - stat[2]) / stat[3]
-            )
-        elif item in log_norm_cols:
-            out.loc[dict(variable=item)] = (
-                np.power(10, x.sel(variable=item) * stat[3] + stat[2]) - 0.1
-            ) ** 2
-        else:
-            out.loc[dict(variable=item)] = x.sel(variable=item) * stat[3] + stat[2]
+    # variables of x not in var_lst are NaN in the output
+    mean, std, log_norm = _norm_params(
+        x["variable"].values, stat_dict, log_norm_cols, var_lst
+    )
+    axis = x.get_axis_num("variable")
+    data = _norm_kernel(
+        np.moveaxis(x.to_numpy(), axis, -1), mean, std, log_norm, to_norm=to_norm
+    )
+    out = x.copy(deep=False, data=np.moveaxis(data, -1, axis))
     if to_norm:
         # after normalization, all units are dimensionless
         out.attrs = {}
@@ -217,6 +366,39 @@ def _prcp_norm(x: np.array, mean_prep: np.array, to_norm: bool) -> np.array:
     return x / tempprep if to_norm else x * tempprep
 
 
+def _prcp_norm_vars(
+    x: xr.DataArray, prcp_norm_cols: list, mean_prcp: np.array, to_norm: bool
+) -> xr.DataArray:
+    """_prcp_norm for all variables of x in prcp_norm_cols at once
+
+    Parameters
+    ----------
+    x
+        data with basin and variable dims
+    prcp_norm_cols
+        variables normalized with mean precipitation
+    mean_prcp
+        basins' mean precipitation with shape (basin, 1); not used if no variable of x is in prcp_norm_cols
+    to_norm
+        if true, normalize; else denormalize
+
+    Returns
+    -------
+    xr.DataArray
+        a new DataArray; its data is shared with x if no variable is in prcp_norm_cols
+    """
+    mask = np.isin(x["variable"].values, prcp_norm_cols)
+    if not mask.any():
+        return x.copy(deep=False)
+    axes = [x.get_axis_num("basin"), x.get_axis_num("variable")]
+    data = x.to_numpy().copy()
+    view = np.moveaxis(data, axes, [0, -1])
+    factor = np.asarray(mean_prcp)[:, 0].reshape((-1,) + (1,) * (view.ndim - 1))
+    # computed in float64 like _prcp_norm and then cast back to the dtype of x
+    view[..., mask] = view[..., mask] / factor if to_norm else view[..., mask] * factor
+    return x.copy(deep=False, data=data)
+
+
 def dor_reservoirs_chosen(gages, usgs_id, dor_chosen) -> list:
     """
     choose basins of small DOR(calculated by NOR_STORAGE/RUNAVE7100)
@@ -8,10 +8,11 @@ FilePath: \torchhydro\torchhydro\datasets\sampler.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
-from collections import defaultdict
+from collections import defaultdict, deque
 import numpy as np
-from torch.utils.data import RandomSampler, Sampler
-from torchhydro.datasets.data_sets import BaseDataset
+import torch.distributed as dist
+from torch.utils.data import BatchSampler, RandomSampler, Sampler
+from torchhydro.datasets.data_sets import BaseDataset, LookupTable
 from typing import Iterator, Optional
 import torch
 
@@ -63,72 +64,534 @@ class KuaiSampler(RandomSampler):
         super(KuaiSampler, self).__init__(dataset, num_samples=num_samples)
 
 
-class BasinBatchSampler(Sampler[int]):
+class RandomWindowSampler(BatchSampler):
+    """Draw mini-batches of random (basin, start time) windows without the lookup table
+
+    Just like the random pick-up in Kuai Fang's paper (https://doi.org/10.1002/2017GL075619),
+    basins and start times are drawn directly from the range of valid start times of each basin,
+    so the lookup table of the training dataset doesn't need to be built at all.
+    Basins are drawn in proportion to their numbers of windows, hence each window has
+    the same chance as it has with a RandomSampler over the lookup table.
+    Each mini-batch is a LookupTable of its windows, which the dataset's __getitems__ gathers at once,
+    so please use it as the batch_sampler of a DataLoader.
+    """
+
+    # give up if windows of a batch are still without any target value after so many redraws
+    max_redraws = 100
+
+    def __init__(
+        self,
+        dataset,
+        batch_size: int,
+        num_batches: Optional[int] = None,
+        reject_nan: bool = True,
+        generator=None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        dataset : BaseDataset
+            the training dataset, whose supports_window_batches is True
+        batch_size : int
+            number of windows in a mini-batch
+        num_batches : Optional[int]
+            number of mini-batches in an epoch; by default, an epoch has as many windows as the dataset has
+        reject_nan : bool
+            if True, windows whose targets in the horizon are all NaN are redrawn,
+            just like they are dropped from the lookup table for training
+        generator : Optional[torch.Generator]
+            generator for the random seed of each epoch
+        """
+        if not getattr(dataset, "supports_window_batches", False):
+            raise NotImplementedError(
+                f"{type(dataset).__name__} can't gather batches of windows drawn by RandomWindowSampler"
+            )
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.drop_last = False
+        self.reject_nan = reject_nan
+        self.generator = generator
+        self.first, end = dataset._window_start_range()
+        self.num_starts = end - self.first
+        total_windows = int(self.num_starts.sum())
+        if total_windows == 0:
+            raise ValueError("There is no window to be drawn from the dataset")
+        self.basin_weights = self.num_starts / total_windows
+        if num_batches is None:
+            num_batches = int(np.ceil(total_windows / batch_size))
+        self.num_batches = num_batches
+        self.notnan_cumsum = dataset._target_notnan_cumsum() if reject_nan else None
+
+    def _draw(self, rng, size):
+        basins = rng.choice(self.basin_weights.size, size=size, p=self.basin_weights)
+        times = self.first[basins] + (
+            rng.random(size) * self.num_starts[basins]
+        ).astype(np.int64)
+        return basins, times
+
+    def _without_target(self, basins, times):
+        return ~self.dataset._windows_with_target(self.notnan_cumsum, basins, times)
+
+    def __iter__(self) -> Iterator[LookupTable]:
+        seed = int(torch.empty((), dtype=torch.int64).random_(generator=self.generator))
+        rng = np.random.default_rng(seed)
+        for _ in range(self.num_batches):
+            basins, times = self._draw(rng, self.batch_size)
+            if self.reject_nan:
+                rejected = self._without_target(basins, times)
+                redraws = 0
+                while rejected.any():
+                    if redraws == self.max_redraws:
+                        raise ValueError(
+                            "Too many windows without any target value are drawn, "
+                            "please check the targets or set reject_nan False"
+                        )
+                    basins[rejected], times[rejected] = self._draw(
+                        rng, int(rejected.sum())
+                    )
+                    rejected = self._without_target(basins, times)
+                    redraws += 1
+            yield LookupTable(basins, times)
+
+    def __len__(self) -> int:
+        return self.num_batches
+
+
+def _samples_by_basin(dataset):
+    """Indices of samples sorted by basin (lookup tables built by datasets are already sorted)
+    and the offsets of each basin's range in them
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        the sorted indices, and offsets with shape (basin + 1,)
+    """
+    basins = np.asarray(dataset.lookup_table.basin)
+    if basins.size != len(dataset):
+        raise ValueError(
+            f"Samples of {type(dataset).__name__} are not the windows of its lookup table now"
+        )
+    order = np.argsort(basins, kind="stable")
+    counts = np.bincount(basins, minlength=dataset.ngrid)
+    return order, np.concatenate([[0], np.cumsum(counts)])
+
+
+class BasinBatchSampler(BatchSampler):
     """
-    A custom sampler for hydrological modeling that iterates over a dataset in
-    a way tailored for batches of hydrological data. It ensures that each batch
-    contains data from a single randomly selected 'basin' out of several basins,
-    with batches constructed to respect the specified batch size and the unique
-    characteristics of hydrological datasets.
-    TODO: made by Xinzhuo Wu, maybe need to be tested more
+    A batch sampler for hydrological modeling in which each mini-batch contains
+    samples of a single basin. Basins are visited in a shuffled order, and all batches
+    of a basin are drawn from its own contiguous range of samples before the next basin.
+
+    If consecutive is True, each batch is a block of consecutive samples (windows) of its basin,
+    and only the order of the blocks is shuffled, so gathering a batch reads one contiguous slab
+    of the basin's series, which is friendly to caches of memmap and out-of-core datasets;
+    otherwise the samples of a basin are shuffled before they are split into batches.
+    Please use it as the batch_sampler of a DataLoader.
 
     Parameters
     ----------
     dataset : BaseDataset
-        The dataset to sample from, expected to have a `data_cfgs` attribute.
-    num_samples : Optional[int], default=None
-        The total number of samples to draw (optional).
+        the dataset to sample from, whose samples are the windows of its lookup table
+    batch_size : Optional[int]
+        size of each mini-batch; by default, data_cfgs["batch_size"] of the dataset;
+        the last batch of a basin may be smaller
+    consecutive : bool
+        if True, each batch is a block of consecutive samples of a basin
+    shuffle : bool
+        if False, basins and their batches are iterated in order, e.g. for inference
     generator : Optional[torch.Generator]
         A PyTorch Generator object for random number generation (optional).
-
-    The sampler divides the dataset by the number of basins, then iterates through
-    each basin's range in shuffled order, ensuring non-overlapping, basin-specific
-    batches suitable for models that predict hydrological outcomes.
     """
 
     def __init__(
         self,
         dataset,
-        num_samples: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        consecutive: bool = False,
+        shuffle: bool = True,
         generator=None,
     ) -> None:
+        if batch_size is None:
+            batch_size = dataset.data_cfgs["batch_size"]
+        if not isinstance(batch_size, int) or batch_size <= 0:
+            raise ValueError(
+                f"batch_size should be a positive integer value, but got batch_size={batch_size}"
+            )
         self.dataset = dataset
-        self._num_samples = num_samples
+        self.batch_size = batch_size
+        self.drop_last = False
+        self.consecutive = consecutive
+        self.shuffle = shuffle
         self.generator = generator
+        # samples sorted by basin and offsets of each basin in them, see _group_by_basin
+        self._order = None
+        self._basin_offsets = None
 
-        if not isinstance(self.num_samples, int) or self.num_samples <= 0:
-            raise ValueError(
-                f"num_samples should be a positive integer value, but got num_samples={self.num_samples}"
-            )
+    def _group_by_basin(self):
+        if self._order is None:
+            self._order, self._basin_offsets = _samples_by_basin(self.dataset)
+        return self._order, self._basin_offsets
 
     @property
     def num_samples(self) -> int:
         return len(self.dataset)
 
-    def __iter__(self) -> Iterator[int]:
-        n = self.dataset.data_cfgs["batch_size"]
-        basin_number = len(self.dataset.data_cfgs["object_ids"])
-        basin_range = len(self.dataset) // basin_number
-        if n > basin_range:
-            raise ValueError(
-                f"batch_size should equal or less than basin_range={basin_range} "
-            )
+    def _basin_batches(self, basin, generator):
+        order, basin_offsets = self._group_by_basin()
+        start, end = basin_offsets[basin], basin_offsets[basin + 1]
+        n = self.batch_size
+        if self.consecutive:
+            blocks = torch.arange(start, end, n)
+            if self.shuffle:
+                blocks = blocks[torch.randperm(len(blocks), generator=generator)]
+            for block in blocks.tolist():
+                yield order[block : min(block + n, end)].tolist()
+            return
+        samples = order[start:end]
+        if self.shuffle:
+            samples = samples[torch.randperm(end - start, generator=generator).numpy()]
+        for i in range(0, end - start, n):
+            yield samples[i : i + n].tolist()
 
+    def __iter__(self) -> Iterator[list]:
         if self.generator is None:
             seed = int(torch.empty((), dtype=torch.int64).random_().item())
             generator = torch.Generator()
             generator.manual_seed(seed)
         else:
             generator = self.generator
+        ngrid = self._group_by_basin()[1].size - 1
+        basins = (
+            torch.randperm(ngrid, generator=generator) if self.shuffle else range(ngrid)
+        )
+        for basin in basins:
+            yield from self._basin_batches(int(basin), generator)
+
+    def __len__(self) -> int:
+        counts = np.diff(self._group_by_basin()[1])
+        return int(np.sum(-(-counts // self.batch_size)))
+
+
+class LossAwareSampler(BatchSampler):
+    """Draw single-basin mini-batches with probabilities proportional to tempered running losses of basins
+
+    Most iterations of a uniform sampler are spent on basins which the model already fits well,
+    so basins are drawn with probability p_b proportional to n_b * loss_b ** temperature,
+    mixed with the uniform probability n_b / N (n_b windows of basin b in all N windows) by uniform_mix
+    to keep every basin in training. Windows of a batch are drawn uniformly from its basin.
+    loss_b is an exponential moving average of the losses of basin b's batches, updated by
+    torch_single_train through update_loss, which is cheap as it is the loss of the batch itself.
+    As a batch has only one basin, multiplying its loss by the importance weight (n_b / N) / p_b
+    (given by pop_batch) keeps the expected loss the same as that of uniform sampling.
+    Probabilities are fixed at the start of each epoch, so weights of batches prefetched by
+    DataLoader workers still match the probabilities they were drawn with.
+    Please use it as the batch_sampler of a DataLoader.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size: int,
+        num_batches: Optional[int] = None,
+        temperature: float = 0.5,
+        smoothing: float = 0.9,
+        uniform_mix: float = 0.1,
+        generator=None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        dataset : BaseDataset
+            the training dataset, whose samples are the windows of its lookup table
+        batch_size : int
+            number of windows in a mini-batch
+        num_batches : Optional[int]
+            number of mini-batches in an epoch; by default, an epoch has as many windows as the dataset has
+        temperature : float
+            exponent of the losses; 0 means uniform sampling and 1 means proportional to the losses
+        smoothing : float
+            weight of the old value in the moving average of a basin's loss
+        uniform_mix : float
+            fraction of the uniform probability mixed into the probability of each basin, in (0, 1]
+        generator : Optional[torch.Generator]
+            generator for the random seed of each epoch
+        """
+        if not 0 < uniform_mix <= 1:
+            raise ValueError(f"uniform_mix should be in (0, 1], but got {uniform_mix}")
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.drop_last = False
+        self.temperature = temperature
+        self.smoothing = smoothing
+        self.uniform_mix = uniform_mix
+        self.generator = generator
+        self.order, basin_offsets = _samples_by_basin(dataset)
+        self.basin_offsets = basin_offsets
+        self.counts = np.diff(basin_offsets)
+        if num_batches is None:
+            num_batches = int(np.ceil(self.counts.sum() / batch_size))
+        self.num_batches = num_batches
+        # running loss of each basin, NaN until a batch of it is trained
+        self.basin_loss = np.full(self.counts.size, np.nan)
+        self.probs = self.probabilities()
+        # (basin, weight) of batches which have been drawn but not trained yet, in order
+        self._pending = deque()
+
+    def probabilities(self) -> np.ndarray:
+        """Probability of drawing a batch of each basin from the current running losses
+
+        Basins never trained have the mean running loss of the others
+        """
+        uniform = self.counts / self.counts.sum()
+        if np.isnan(self.basin_loss).all():
+            return uniform
+        loss = np.where(
+            np.isnan(self.basin_loss), np.nanmean(self.basin_loss), self.basin_loss
+        )
+        score = self.counts * np.maximum(loss, 0.0) ** self.temperature
+        if score.sum() <= 0:
+            return uniform
+        return (1 - self.uniform_mix) * score / score.sum() + self.uniform_mix * uniform
+
+    def importance_weights(self) -> np.ndarray:
+        """Weight of the loss of a batch of each basin in the current epoch, (n_b / N) / p_b"""
+        uniform = self.counts / self.counts.sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.probs > 0, uniform / self.probs, 0.0)
+
+    def pop_batch(self):
+        """basin and importance weight of the next batch to be trained
 
-        # basin_list = torch.randperm(basin_number)
-        # for select_basin in basin_list:
-        #     x = torch.randperm(basin_range)
-        #     for i in range(0, basin_range, n):
-        #         yield from (x[i : i + n] + basin_range * select_basin.item()).tolist()
-        x = torch.randperm(self.num_samples)
-        for i in range(0, self.num_samples, n):
-            yield from (x[i : i + n]).tolist()
+        Returns
+        -------
+        tuple[int, float]
+            basin index and weight of the batch
+        """
+        return self._pending.popleft()
+
+    def update_loss(self, basin: int, loss: float) -> None:
+        """Update the running loss of a basin with the (not weighted) loss of its batch"""
+        old = self.basin_loss[basin]
+        self.basin_loss[basin] = (
+            loss
+            if np.isnan(old)
+            else self.smoothing * old + (1 - self.smoothing) * loss
+        )
+
+    def __iter__(self) -> Iterator[list]:
+        seed = int(torch.empty((), dtype=torch.int64).random_(generator=self.generator))
+        rng = np.random.default_rng(seed)
+        self.probs = self.probabilities()
+        weights = self.importance_weights()
+        self._pending.clear()
+        basins = rng.choice(self.probs.size, size=self.num_batches, p=self.probs)
+        for basin in basins.tolist():
+            start = self.basin_offsets[basin]
+            windows = start + rng.integers(0, self.counts[basin], size=self.batch_size)
+            self._pending.append((basin, float(weights[basin])))
+            yield self.order[windows].tolist()
+
+    def __len__(self) -> int:
+        return self.num_batches
+
+
+class PrefetchSampler(Sampler[int]):
+    """
+    Wrap a sampler and let the dataset prefetch data of upcoming samples,
+    e.g. OutOfCoreDataset loads chunks of the next batches in a background thread
+    while the model is trained with the current ones.
+
+    Parameters
+    ----------
+    sampler : Sampler
+        the sampler to be wrapped
+    dataset : torch.utils.data.Dataset
+        a dataset with a `prefetch(indices)` method
+    lookahead : int
+        how many upcoming samples are prefetched each time
+    """
+
+    def __init__(self, sampler, dataset, lookahead: int) -> None:
+        self.sampler = sampler
+        self.dataset = dataset
+        self.lookahead = max(int(lookahead), 1)
+
+    def set_epoch(self, epoch: int) -> None:
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self) -> Iterator[int]:
+        indices = list(iter(self.sampler))
+        n = self.lookahead
+        for i, idx in enumerate(indices):
+            if i == 0:
+                self.dataset.prefetch(indices[:n])
+            if i % n == 0:
+                # samples of [i, i + n) have been prefetched, so we go on with the next n
+                self.dataset.prefetch(indices[i + n : i + 2 * n])
+            yield idx
+
+    def __len__(self) -> int:
+        return len(self.sampler)
+
+
+class PrefetchBatchSampler(BatchSampler):
+    """
+    Wrap a batch sampler, such as BasinBatchSampler, and let the dataset prefetch data
+    of the samples of upcoming batches, just like PrefetchSampler
+
+    Parameters
+    ----------
+    batch_sampler : BatchSampler
+        the batch sampler to be wrapped
+    dataset : torch.utils.data.Dataset
+        a dataset with a `prefetch(indices)` method
+    lookahead : int
+        about how many upcoming samples are prefetched each time
+    """
+
+    def __init__(self, batch_sampler, dataset, lookahead: int) -> None:
+        self.batch_sampler = batch_sampler
+        self.dataset = dataset
+        self.batch_size = batch_sampler.batch_size
+        self.drop_last = batch_sampler.drop_last
+        # number of upcoming batches prefetched each time
+        self.lookahead = max(int(lookahead) // self.batch_size, 1)
+
+    def set_epoch(self, epoch: int) -> None:
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+
+    def _prefetch(self, batches):
+        self.dataset.prefetch([idx for batch in batches for idx in batch])
+
+    def __iter__(self) -> Iterator[list]:
+        batches = list(iter(self.batch_sampler))
+        n = self.lookahead
+        for i, batch in enumerate(batches):
+            if i == 0:
+                self._prefetch(batches[:n])
+            if i % n == 0:
+                self._prefetch(batches[i + n : i + 2 * n])
+            yield batch
+
+    def __len__(self) -> int:
+        return len(self.batch_sampler)
+
+
+def balance_basins(counts, num_groups: int) -> list:
+    """Divide basins into disjoint groups whose total numbers of samples are balanced
+
+    Basins are assigned greedily from the largest to the group with the fewest samples so far.
+
+    Parameters
+    ----------
+    counts
+        number of samples of each basin
+    num_groups
+        number of groups
+
+    Returns
+    -------
+    list
+        sorted basin indices of each group
+    """
+    counts = np.asarray(counts)
+    if num_groups > np.count_nonzero(counts):
+        raise ValueError(
+            f"Only {np.count_nonzero(counts)} basins have samples, "
+            f"they can't be divided into {num_groups} groups"
+        )
+    groups = [[] for _ in range(num_groups)]
+    loads = np.zeros(num_groups, dtype=np.int64)
+    for basin in np.argsort(-counts, kind="stable"):
+        if counts[basin] == 0:
+            break
+        group = int(np.argmin(loads))
+        groups[group].append(int(basin))
+        loads[group] += counts[basin]
+    return [np.sort(np.array(group, dtype=np.int64)) for group in groups]
+
+
+class BasinDistributedSampler(Sampler[int]):
+    """A sampler for distributed training which gives each rank a disjoint set of basins
+
+    Basins are divided among ranks so that their numbers of samples are balanced, see balance_basins,
+    and each rank shuffles the samples of its own basins in every epoch (call set_epoch before it).
+    As DDP needs the same number of iterations on all ranks, a rank with fewer samples
+    repeats some of them to reach the largest rank.
+    If shard_dataset is True, the dataset keeps only arrays of the rank's basins (see BaseDataset.select_basins),
+    so each process holds about 1/num_replicas of the data and its caches only see its own basins.
+    The dataset is still built with all basins before, so it does not lower the peak memory of a rank.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        shard_dataset: bool = False,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        dataset : BaseDataset
+            the training dataset
+        num_replicas : Optional[int]
+            number of processes; by default, the world size of the current process group
+        rank : Optional[int]
+            rank of this process; by default, the rank in the current process group
+        shuffle : bool
+            if True, samples of the rank's basins are shuffled in each epoch
+        seed : int
+            random seed which must be the same on all ranks
+        shard_dataset : bool
+            if True, the dataset keeps only the rank's basins
+        """
+        if num_replicas is None or rank is None:
+            if not dist.is_available() or not dist.is_initialized():
+                raise RuntimeError(
+                    "num_replicas and rank are needed when the process group is not initialized"
+                )
+            num_replicas = (
+                dist.get_world_size() if num_replicas is None else num_replicas
+            )
+            rank = dist.get_rank() if rank is None else rank
+        if rank >= num_replicas or rank < 0:
+            raise ValueError(
+                f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]"
+            )
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        lookup_basins = np.asarray(dataset.lookup_table.basin)
+        counts = np.bincount(lookup_basins, minlength=dataset.ngrid)
+        groups = balance_basins(counts, num_replicas)
+        self.basin_indices = groups[rank]
+        # all ranks iterate as many samples as the largest one
+        self.num_samples = int(max(counts[group].sum() for group in groups))
+        if shard_dataset:
+            dataset.select_basins(self.basin_indices)
+            self.indices = np.arange(len(dataset))
+        else:
+            self.indices = np.flatnonzero(np.isin(lookup_basins, self.basin_indices))
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[int]:
+        indices = self.indices
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = indices[torch.randperm(len(indices), generator=g).numpy()]
+        # repeat the samples cyclically if this rank has fewer of them
+        yield from np.resize(indices, self.num_samples).tolist()
 
     def __len__(self) -> int:
         return self.num_samples
@@ -208,6 +671,7 @@ def fl_sample_region(dataset: BaseDataset):
 data_sampler_dict = {
     "KuaiSampler": KuaiSampler,
     "BasinBatchSampler": BasinBatchSampler,
-    # TODO: DistributedSampler need more test
-    # "DistSampler": DistributedSampler,
+    "RandomWindowSampler": RandomWindowSampler,
+    "LossAwareSampler": LossAwareSampler,
+    "DistSampler": BasinDistributedSampler,
 }
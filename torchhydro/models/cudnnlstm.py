@@ -18,6 +18,7 @@ import torch.nn.functional as F
 
 from torchhydro.models.ann import SimpleAnn
 from torchhydro.models.dropout import DropMask, create_mask
+from torchhydro.models.model_utils import linear_with_static
 
 
 class LstmCellTied(nn.Module):
@@ -141,7 +142,7 @@ class CpuLstmModel(nn.Module):
         self.linearOut = torch.nn.Linear(n_hidden_states, n_output_features)
         self.gpu = -1
 
-    def forward(self, x, do_drop_mc=False):
+    def forward(self, x, do_drop_mc=False, *, c=None):
         # x0 = F.relu(self.linearIn(x))
         # outLSTM, (hn, cn) = self.lstm(x0, do_drop_mc=do_drop_mc)
         # out = self.linearOut(outLSTM)
@@ -155,7 +156,10 @@ class CpuLstmModel(nn.Module):
         for t in range(nt):
             xt = x[t, :, :]
             xt = torch.where(torch.isnan(xt), torch.full_like(xt, 0), xt)
-            x0 = F.relu(self.linearIn(xt))
+            # c is the static attributes (grid, attribute) if they are not in x
+            x0 = F.relu(
+                linear_with_static(self.linearIn, xt.unsqueeze(0), c).squeeze(0)
+            )
             ht, ct = self.lstm(x0, hidden=(ht, ct), do_reset_mask=reset_mask)
             yt = self.linearOut(ht)
             reset_mask = False
@@ -353,8 +357,11 @@ class CudnnLstmModel(nn.Module):
         )
         self.linearOut = torch.nn.Linear(self.hidden_size, self.ny)
 
-    def forward(self, x, do_drop_mc=False, dropout_false=False, return_h_c=False):
-        x0 = F.relu(self.linearIn(x))
+    def forward(
+        self, x, do_drop_mc=False, dropout_false=False, return_h_c=False, *, c=None
+    ):
+        # c is the static attributes (batch, attribute) if they are not in x
+        x0 = F.relu(linear_with_static(self.linearIn, x, c))
         out_lstm, (hn, cn) = self.lstm(
             x0, do_drop_mc=do_drop_mc, dropout_false=dropout_false
         )
@@ -18,7 +18,7 @@ from torchhydro.models.cudnnlstm import (
     CpuLstmModel,
 )
 
-from torchhydro.models.simple_lstm import SimpleLSTMForecast
+from torchhydro.models.simple_lstm import MultiFreqLSTM, SimpleLSTMForecast
 from torchhydro.models.seq2seq import (
     GeneralSeq2Seq,
     DataEnhancedModel,
@@ -59,6 +59,7 @@ pytorch_model_dict = {
     "DplAttrXaj": DplAnnXaj,
     "SPPLSTM": SPP_LSTM_Model,
     "SimpleLSTMForecast": SimpleLSTMForecast,
+    "MultiFreqLSTM": MultiFreqLSTM,
     "SPPLSTM2": SPP_LSTM_Model_2,
     "Seq2Seq": GeneralSeq2Seq,
     "DataEnhanced": DataEnhancedModel,
@@ -33,3 +33,36 @@ def get_the_device(device_num: Union[list, int]):
     if device_num not in [[-1], -1, ["-1"]]:
         warnings.warn("You don't have GPU, so have to choose cpu for models")
     return torch.device("cpu")
+
+
+def linear_with_static(linear, x, c=None, time_dim=0):
+    """
+    Apply a linear layer to x with static attributes c concatenated along its last dim,
+    without tiling c along the time dim
+
+    The columns of the weight for c are applied once for each sample and broadcast
+    to all time steps, so the result is same as linear(cat([x, tiled c], -1)),
+    and a model has same parameters whether or not its attributes come from a side channel.
+
+    Parameters
+    ----------
+    linear : torch.nn.Linear
+        the linear layer whose in_features is the number of variables of x plus c
+    x : torch.Tensor
+        dynamic inputs with shape (time, batch, variable) or (batch, time, variable)
+    c : torch.Tensor, optional
+        static attributes with shape (batch, attribute); if None, x has all inputs
+    time_dim : int
+        0 if x is sequence-first, 1 if x is batch-first
+
+    Returns
+    -------
+    torch.Tensor
+        output of the linear layer
+    """
+    if c is None:
+        return linear(x)
+    n_dynamic = x.shape[-1]
+    out = torch.nn.functional.linear(x, linear.weight[:, :n_dynamic], linear.bias)
+    static = torch.nn.functional.linear(c, linear.weight[:, n_dynamic:])
+    return out + static.unsqueeze(time_dim)
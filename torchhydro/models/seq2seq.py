@@ -11,6 +11,7 @@ Copyright (c) 2021-2024 Wenyu Ouyang. All rights reserved.
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torchhydro.models.model_utils import linear_with_static
 import math
 import random
 
@@ -69,9 +70,9 @@ class Encoder(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.fc = nn.Linear(hidden_dim, output_dim)
 
-    def forward(self, x):
-        # a nonlinear layer to transform the input
-        x0 = self.pre_fc(x)
+    def forward(self, x, c=None):
+        # a nonlinear layer to transform the input (with static attributes c if they are not in x)
+        x0 = linear_with_static(self.pre_fc, x, c, time_dim=1)
         x1 = self.pre_relu(x0)
         # the LSTM layer
         outputs_, (hidden, cell) = self.lstm(x1)
@@ -92,8 +93,8 @@ class Decoder(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.fc_out = nn.Linear(hidden_dim, output_dim)
 
-    def forward(self, input, hidden, cell):
-        x0 = self.pre_fc(input)
+    def forward(self, input, hidden, cell, c=None):
+        x0 = linear_with_static(self.pre_fc, input, c, time_dim=1)
         x1 = self.pre_relu(x0)
         output_, (hidden_, cell_) = self.lstm(x1, (hidden, cell))
         output_dr = self.dropout(output_)
@@ -157,7 +158,8 @@ class GeneralSeq2Seq(nn.Module):
         )
         self.transfer = StateTransferNetwork(hidden_dim=hidden_size)
 
-    def forward(self, *src):
+    def forward(self, *src, c=None):
+        # c is the static attributes (batch, attribute) if they are not tiled in other inputs
         if len(src) == 3:
             encoder_input, decoder_input, trgs = src
         else:
@@ -171,7 +173,7 @@ class GeneralSeq2Seq(nn.Module):
                 ),
                 float("nan"),
             ).to(device)
-        encoder_outputs, hidden_, cell_ = self.encoder(encoder_input)
+        encoder_outputs, hidden_, cell_ = self.encoder(encoder_input, c)
         hidden, cell = self.transfer(hidden_, cell_)
         outputs = []
         current_input = encoder_outputs[:, -1, :].unsqueeze(1)
@@ -179,7 +181,7 @@ class GeneralSeq2Seq(nn.Module):
         for t in range(self.trg_len):
             p = decoder_input[:, t, :].unsqueeze(1)
             current_input = torch.cat((current_input, p), dim=2)
-            output, hidden, cell = self.decoder(current_input, hidden, cell)
+            output, hidden, cell = self.decoder(current_input, hidden, cell, c)
             outputs.append(output.squeeze(1))
             trg = trgs[:, (self.prec_window + t), :].unsqueeze(1)
             valid_mask = ~torch.isnan(trg)
@@ -15,6 +15,8 @@ from torch.nn import functional as F
 from torch import Tensor as T
 from torch.nn import Parameter as P
 
+from torchhydro.models.model_utils import linear_with_static
+
 
 class SimpleLSTM(nn.Module):
     def __init__(self, input_size, output_size, hidden_size, dr=0.0):
@@ -28,8 +30,9 @@ class SimpleLSTM(nn.Module):
         )
         self.linearOut = nn.Linear(hidden_size, output_size)
 
-    def forward(self, x):
-        x0 = F.relu(self.linearIn(x))
+    def forward(self, x, c=None):
+        # c is the static attributes (batch, attribute) if they are not in x
+        x0 = F.relu(linear_with_static(self.linearIn, x, c))
         out_lstm, (hn, cn) = self.lstm(x0)
         return self.linearOut(out_lstm)
 
@@ -41,13 +44,52 @@ class SimpleLSTMForecast(SimpleLSTM):
         )
         self.forecast_length = forecast_length
 
-    def forward(self, x):
+    def forward(self, x, c=None):
         # 调用父类的forward方法获取完整的输出
-        full_output = super(SimpleLSTMForecast, self).forward(x)
+        full_output = super(SimpleLSTMForecast, self).forward(x, c)
 
         return full_output[-self.forecast_length :, :, :]
 
 
+class MultiFreqLSTM(nn.Module):
+    """An LSTM for inputs of two frequencies, such as samples of MultiFreqDataset
+
+    The low-frequency inputs are encoded by their own LSTM, and its last hidden state
+    is given to each step of the high-frequency LSTM together with the high-frequency inputs.
+    """
+
+    def __init__(
+        self,
+        low_input_size,
+        high_input_size,
+        output_size,
+        hidden_size,
+        low_hidden_size=None,
+        dr=0.0,
+    ):
+        super(MultiFreqLSTM, self).__init__()
+        if low_hidden_size is None:
+            low_hidden_size = hidden_size
+        self.low_lstm = nn.LSTM(low_input_size, low_hidden_size, 1)
+        self.linearIn = nn.Linear(low_hidden_size + high_input_size, hidden_size)
+        self.lstm = nn.LSTM(
+            hidden_size,
+            hidden_size,
+            1,
+            dropout=dr,
+        )
+        self.linearOut = nn.Linear(hidden_size, output_size)
+
+    def forward(self, x_low, x, c=None):
+        # x_low: (low_time, batch, variable); x: (time, batch, variable)
+        _, (h_low, _) = self.low_lstm(x_low)
+        low = h_low[-1].unsqueeze(0).expand(x.shape[0], -1, -1)
+        # low-frequency states come first, so that c is still the last columns of linearIn
+        x0 = F.relu(linear_with_static(self.linearIn, th.cat((low, x), dim=-1), c))
+        out_lstm, (hn, cn) = self.lstm(x0)
+        return self.linearOut(out_lstm)
+
+
 class SlowLSTM(nn.Module):
     """
     A pedagogic implementation of Hochreiter & Schmidhuber:
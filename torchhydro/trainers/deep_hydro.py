@@ -9,6 +9,8 @@ Copyright (c) 2024-2024 Wenyu Ouyang. All rights reserved.
 """
 
 import copy
+import inspect
+import json
 import os
 from abc import ABC, abstractmethod
 from collections import defaultdict
@@ -22,13 +24,20 @@ import torch.distributed as dist
 import torch.nn as nn
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.optim.lr_scheduler import *
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
 from tqdm import tqdm
 
 from torchhydro.configs.config import update_nested_dict
 from torchhydro.datasets.data_dict import datasets_dict
-from torchhydro.datasets.data_sets import BaseDataset
+from torchhydro.datasets.data_sets import (
+    BaseDataset,
+    DeviceBatchLoader,
+    SharedPeriodRead,
+    get_collate_fn,
+)
 from torchhydro.datasets.sampler import (
+    PrefetchBatchSampler,
+    PrefetchSampler,
     fl_sample_basin,
     fl_sample_region,
     data_sampler_dict,
@@ -144,14 +153,55 @@ class DeepHydro(DeepHydroInterface):
         self.device_num = cfgs["training_cfgs"]["device"]
         self.device = get_the_device(self.device_num)
         self.pre_model = pre_model
+        self._check_static_side_channel()
         self.model = self.load_model()
+        # with share_period_read, datasets of train/valid/test slice their data from one
+        # reading of the union period
+        self.shared_read = (
+            SharedPeriodRead(cfgs["data_cfgs"])
+            if cfgs["data_cfgs"].get("share_period_read", False)
+            else None
+        )
         if cfgs["training_cfgs"]["train_mode"]:
             self.traindataset = self.make_dataset("train")
             if cfgs["data_cfgs"]["t_range_valid"] is not None:
                 self.validdataset = self.make_dataset("valid")
-        self.testdataset: BaseDataset = self.make_dataset("test")
+        # the test dataset is built when it is used at first
+        self._testdataset = None
         print(f"Torch is using {str(self.device)}")
 
+    def _check_static_side_channel(self):
+        """With data_cfgs["static_side_channel"], the model must take the static attributes
+        as its keyword argument c, see model_infer; check it before any data is read
+        """
+        if not self.cfgs["data_cfgs"].get("static_side_channel", False):
+            return
+        model_name = self.cfgs["model_cfgs"]["model_name"]
+        model_class = (
+            type(self.pre_model)
+            if self.pre_model is not None
+            else pytorch_model_dict.get(model_name)
+        )
+        if model_class is None:
+            # an unknown model is reported by load_model
+            return
+        if "c" not in inspect.signature(model_class.forward).parameters:
+            raise NotImplementedError(
+                f"static_side_channel is not supported by {model_name}, whose forward has no argument c; "
+                "please turn it off or use a model such as KuaiLSTM, CpuLSTM, SimpleLSTMForecast or Seq2Seq"
+            )
+
+    @property
+    def testdataset(self) -> BaseDataset:
+        """dataset of the test period, which is built lazily"""
+        if self._testdataset is None:
+            self._testdataset = self.make_dataset("test")
+        return self._testdataset
+
+    @testdataset.setter
+    def testdataset(self, dataset):
+        self._testdataset = dataset
+
     def load_model(self, mode="train"):
         """
         Load a time series forecast model in pytorch_model_dict in model_dict_function.py
@@ -221,11 +271,38 @@ class DeepHydro(DeepHydroInterface):
         dataset_name = data_cfgs["dataset"]
 
         if dataset_name in list(datasets_dict.keys()):
-            dataset = datasets_dict[dataset_name](data_cfgs, is_tra_val_te)
+            dataset_class = datasets_dict[dataset_name]
+            if issubclass(dataset_class, BaseDataset):
+                kwargs = {"shared_read": self.shared_read}
+                if (
+                    dataset_class.uses_train_dataset
+                    and is_tra_val_te != "train"
+                    and hasattr(self, "traindataset")
+                ):
+                    # borrow data of the training period rather than building it again
+                    kwargs["train_dataset"] = self.traindataset
+                dataset = dataset_class(data_cfgs, is_tra_val_te, **kwargs)
+            else:
+                dataset = dataset_class(data_cfgs, is_tra_val_te)
         else:
             raise NotImplementedError(
                 f"Error the dataset {str(dataset_name)} was not found in the dataset dict. Please add it."
             )
+        # gather mini-batches in the memory layout that the model finally uses
+        dataset.seq_first = (
+            self.cfgs["training_cfgs"]["which_first_tensor"] == "sequence"
+        )
+        load_profile = getattr(dataset, "load_profile", None)
+        if load_profile is not None:
+            # saved in a subdirectory of test_path, so that slow startup of runs could be
+            # compared while json files in test_path are still only results and params
+            profile_dir = os.path.join(data_cfgs["test_path"], "profiles")
+            os.makedirs(profile_dir, exist_ok=True)
+            profile_file = os.path.join(
+                profile_dir, f"{is_tra_val_te}_load_profile.json"
+            )
+            with open(profile_file, "w") as fp:
+                json.dump(load_profile, fp, indent=4)
         return dataset
 
     def model_train(self) -> None:
@@ -323,20 +400,22 @@ class DeepHydro(DeepHydroInterface):
     def _1epoch_valid(
         self, training_cfgs, criterion, validation_data_loader, valid_logs
     ):
-        valid_obss_np, valid_preds_np, valid_loss = compute_validation(
+        # outputs are kept on the device and denormalized there for metrics
+        valid_obss, valid_preds, valid_loss = compute_validation(
             self.model,
             criterion,
             validation_data_loader,
             device=self.device,
             which_first_tensor=training_cfgs["which_first_tensor"],
+            to_numpy=False,
         )
         valid_logs["valid_loss"] = valid_loss
         if self.cfgs["evaluation_cfgs"]["calc_metrics"]:
             target_col = self.cfgs["data_cfgs"]["target_cols"]
             valid_metrics = evaluate_validation(
                 validation_data_loader,
-                valid_preds_np,
-                valid_obss_np,
+                valid_preds,
+                valid_obss,
                 self.cfgs["evaluation_cfgs"],
                 target_col,
             )
@@ -370,6 +449,9 @@ class DeepHydro(DeepHydroInterface):
         device = get_the_device(self.cfgs["training_cfgs"]["device"])
         test_dataloader = self._get_dataloader(training_cfgs, data_cfgs, mode="infer")
         seq_first = training_cfgs["which_first_tensor"] == "sequence"
+        static_side_channel = getattr(
+            test_dataloader.dataset, "static_side_channel", False
+        )
         self.model.eval()
         # here the batch is just an index of lookup table, so any batch size could be chosen
         test_preds = []
@@ -379,7 +461,9 @@ class DeepHydro(DeepHydroInterface):
                 # here the a batch doesn't mean a basin; it is only an index in lookup table
                 # for NtoN mode, only basin is index in lookup table, so the batch is same as basin
                 # for Nto1 mode, batch is only an index
-                ys, pred = model_infer(seq_first, device, self.model, xs, ys)
+                ys, pred = model_infer(
+                    seq_first, device, self.model, xs, ys, static_side_channel
+                )
                 test_preds.append(pred.cpu().numpy())
                 obss.append(ys.cpu().numpy())
             pred = reduce(lambda x, y: np.vstack((x, y)), test_preds)
@@ -458,6 +542,7 @@ class DeepHydro(DeepHydroInterface):
                     drop_last=False,
                     timeout=0,
                     worker_init_fn=None,
+                    collate_fn=get_collate_fn(self.testdataset),
                 )
             test_num_samples = self.testdataset.num_samples
             return DataLoader(
@@ -466,6 +551,7 @@ class DeepHydro(DeepHydroInterface):
                 shuffle=False,
                 drop_last=False,
                 timeout=0,
+                collate_fn=get_collate_fn(self.testdataset),
             )
         worker_num = 0
         pin_memory = False
@@ -476,15 +562,64 @@ class DeepHydro(DeepHydroInterface):
             pin_memory = training_cfgs["pin_memory"]
             print(f"Pin memory set to {str(pin_memory)}")
         sampler = self._get_sampler(data_cfgs, self.traindataset)
-        data_loader = DataLoader(
-            self.traindataset,
-            batch_size=training_cfgs["batch_size"],
-            shuffle=(sampler is None),
-            sampler=sampler,
-            num_workers=worker_num,
-            pin_memory=pin_memory,
-            timeout=0,
-        )
+        if hasattr(self.traindataset, "prefetch"):
+            # let the dataset load data of the next batches in the background
+            lookahead = training_cfgs["batch_size"] * self.traindataset.prefetch_batches
+            if isinstance(sampler, BatchSampler):
+                sampler = PrefetchBatchSampler(sampler, self.traindataset, lookahead)
+            else:
+                sampler = PrefetchSampler(
+                    (
+                        sampler
+                        if sampler is not None
+                        else RandomSampler(self.traindataset)
+                    ),
+                    self.traindataset,
+                    lookahead=lookahead,
+                )
+        if training_cfgs.get("device_dataset", False):
+            # hold the whole datasets on device and gather batches with index tensors
+            data_loader = DeviceBatchLoader(
+                self.traindataset,
+                training_cfgs["batch_size"],
+                self.device,
+                sampler=sampler,
+            )
+            validation_data_loader = None
+            if data_cfgs["t_range_valid"] is not None:
+                validation_data_loader = DeviceBatchLoader(
+                    self.validdataset,
+                    training_cfgs["batch_size"],
+                    self.device,
+                    shuffle=False,
+                )
+            return data_loader, validation_data_loader
+        if worker_num > 0 and training_cfgs.get("share_memory", False):
+            # workers map the arrays in shared memory rather than copying them
+            self.traindataset.share_memory()
+            if data_cfgs["t_range_valid"] is not None:
+                self.validdataset.share_memory()
+        if isinstance(sampler, BatchSampler):
+            # the sampler gives whole mini-batches
+            data_loader = DataLoader(
+                self.traindataset,
+                batch_sampler=sampler,
+                num_workers=worker_num,
+                pin_memory=pin_memory,
+                timeout=0,
+                collate_fn=get_collate_fn(self.traindataset),
+            )
+        else:
+            data_loader = DataLoader(
+                self.traindataset,
+                batch_size=training_cfgs["batch_size"],
+                shuffle=(sampler is None),
+                sampler=sampler,
+                num_workers=worker_num,
+                pin_memory=pin_memory,
+                timeout=0,
+                collate_fn=get_collate_fn(self.traindataset),
+            )
         if data_cfgs["t_range_valid"] is not None:
             validation_data_loader = DataLoader(
                 self.validdataset,
@@ -493,6 +628,7 @@ class DeepHydro(DeepHydroInterface):
                 num_workers=worker_num,
                 pin_memory=pin_memory,
                 timeout=0,
+                collate_fn=get_collate_fn(self.validdataset),
             )
             return data_loader, validation_data_loader
 
@@ -510,9 +646,9 @@ class DeepHydro(DeepHydroInterface):
             - "forecast_history": int, number of past time steps to consider.
             - "warmup_length": int, length of the warmup period.
             - "forecast_length": int, number of future time steps to predict.
-            - "sampler": dict, containing:
-            - "name": str, name of the sampler to use.
-            - "sampler_hyperparam": dict, optional hyperparameters for the sampler.
+            - "sampler": str, name of the sampler to use.
+            - "sampler_hyperparam": dict, optional hyperparameters for the sampler,
+              e.g. {"consecutive": True} for BasinBatchSampler.
         train_dataset : Dataset
             The training dataset object which contains the data to be sampled. Expected attributes are:
             - ngrid: int, number of grids in the dataset.
@@ -549,6 +685,13 @@ class DeepHydro(DeepHydroInterface):
                 "ngrid": ngrid,
                 "nt": nt,
             }
+        elif sampler_name in [
+            "RandomWindowSampler",
+            "BasinBatchSampler",
+            "LossAwareSampler",
+        ]:
+            sampler_hyperparam["batch_size"] = batch_size
+        sampler_hyperparam |= data_cfgs.get("sampler_hyperparam", {})
         return sampler_class(train_dataset, **sampler_hyperparam)
 
 
@@ -834,9 +977,13 @@ class MultiTaskHydro(DeepHydro):
 
 class DistributedDeepHydro(MultiTaskHydro):
     # TODO: not finished yet
-    def __init__(self, world_size, cfgs: Dict):
+    def __init__(self, world_size, cfgs: Dict, rank: int = 0):
+        # each rank keeps only its own basins of the training data (see BasinDistributedSampler),
+        # while a shared reading of the union period would hold data of all basins for the whole run
+        cfgs = {**cfgs, "data_cfgs": {**cfgs["data_cfgs"], "share_period_read": False}}
         super().__init__(cfgs, cfgs["model_cfgs"]["weight_path"])
         self.world_size = world_size
+        self.rank = rank
 
     def setup(self, rank):
         os.environ["MASTER_ADDR"] = self.cfgs["training_cfgs"]["master_addr"]
@@ -872,6 +1019,19 @@ class DistributedDeepHydro(MultiTaskHydro):
         else:
             return pytorch_model_dict[model_name](**model_cfgs["model_hyperparam"])
 
+    def _get_sampler(self, data_cfgs, train_dataset):
+        if data_cfgs["sampler"] != "DistSampler":
+            return super()._get_sampler(data_cfgs, train_dataset)
+        # each rank keeps only its own basins after the sampler is built, so the memory held
+        # during training drops with world size; the peak is not lower, as the full training
+        # dataset is still built before (its statistics and balanced basins need all basins)
+        return data_sampler_dict["DistSampler"](
+            train_dataset,
+            num_replicas=self.world_size,
+            rank=self.rank,
+            shard_dataset=True,
+        )
+
     def model_train(self):
         model = self.load_model().to(self.device)
         self.model = DDP(model, device_ids=[self.rank])
@@ -893,7 +1053,8 @@ class DistributedDeepHydro(MultiTaskHydro):
         )
         logger = TrainLogger(model_filepath, self.cfgs, opt)
         for epoch in range(start_epoch, max_epochs + 1):
-            data_loader.sampler.set_epoch(epoch)
+            if hasattr(data_loader.sampler, "set_epoch"):
+                data_loader.sampler.set_epoch(epoch)
             with logger.log_epoch_train(epoch) as train_logs:
                 total_loss, n_iter_ep = torch_single_train(
                     self.model,
@@ -937,8 +1098,7 @@ class DistributedDeepHydro(MultiTaskHydro):
 
 
 def train_worker(rank, world_size, cfgs):
-    trainer = DistributedDeepHydro(world_size, cfgs)
-    trainer.rank = rank
+    trainer = DistributedDeepHydro(world_size, cfgs, rank)
     trainer.run()
 
 
@@ -15,7 +15,10 @@ from hydroutils.hydro_stat import stat_error
 from hydrodatasource.utils.utils import streamflow_unit_conv
 
 from torchhydro.configs.model_config import MODEL_PARAM_TEST_WAY
-from torchhydro.datasets.data_sources import data_sources_dict
+from torchhydro.datasets.data_cache import scaler_stat_files, side_table_file
+from torchhydro.datasets.data_scalers import BasinSideTable
+from torchhydro.datasets.data_sets import get_collate_fn
+from torchhydro.datasets.data_sources import get_data_source
 from torchhydro.trainers.train_logger import save_model_params_log
 from torchhydro.explainers.shap import (
     deep_explain_model_heatmap,
@@ -189,10 +192,16 @@ class Resulter:
         source_name = data_cfgs["source_cfgs"]["source_name"]
         source_path = data_cfgs["source_cfgs"]["source_path"]
         other_settings = data_cfgs["source_cfgs"].get("other_settings", {})
-        data_source = data_sources_dict[source_name](source_path, **other_settings)
+        data_source = get_data_source(source_name, source_path, **other_settings)
         basin_id = data_cfgs["object_ids"]
         # NOTE: all datasource should have read_area method
-        basin_area = data_source.read_area(basin_id)
+        # areas saved with the scaler statistics are used if they are there
+        basin_area = BasinSideTable(
+            side_table_file(data_cfgs),
+            data_source,
+            data_cfgs["source_cfgs"],
+            scaler_stat_files(data_cfgs)[0],
+        ).area(basin_id)
         target_unit = "m^3/s"
         # NOTE: the name of var flow should be streamflow
         var_flow = "streamflow"
@@ -253,6 +262,7 @@ class Resulter:
             drop_last=False,
             timeout=0,
             worker_init_fn=None,
+            collate_fn=get_collate_fn(deephydro.testdataset),
         )
         deephydro.model.eval()
         # here the batch is just an index of lookup table, so any batch size could be chosen
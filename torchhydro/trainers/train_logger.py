@@ -48,6 +48,8 @@ class TrainLogger:
         self.tb = SummaryWriter(self.training_save_dir)
         self.session_params = []
         self.train_time = []
+        # wall-clock seconds of training in each epoch
+        self.train_seconds = []
         # log loss for each epoch
         self.epoch_loss = []
         # reload previous logs if continue_train is True and weight_path is not None
@@ -65,6 +67,7 @@ class TrainLogger:
                 if log["epoch"] < start_epoch:
                     self.session_params.append(log)
                     self.train_time.append(log["train_time"])
+                    self.train_seconds.append(log.get("train_seconds", np.nan))
                     self.epoch_loss.append(float(log["train_loss"]))
 
     def save_session_param(
@@ -85,6 +88,7 @@ class TrainLogger:
                 "iter_num": n_iter_ep,
             }
         epoch_params["train_time"] = self.train_time[epoch - 1]
+        epoch_params["train_seconds"] = self.train_seconds[epoch - 1]
         self.session_params.append(epoch_params)
 
     @contextmanager
@@ -105,6 +109,7 @@ class TrainLogger:
         self.tb.add_scalar("Loss", total_loss, epoch)
         # self.plot_hist_img(model, epoch)
         self.train_time.append(log_str)
+        self.train_seconds.append(elapsed_time)
         self.epoch_loss.append(total_loss)
 
     @contextmanager
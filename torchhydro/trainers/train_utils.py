@@ -34,7 +34,7 @@ from hydroutils.hydro_file import (
 from torchhydro.models.crits import GaussianLoss
 
 
-def model_infer(seq_first, device, model, xs, ys):
+def model_infer(seq_first, device, model, xs, ys, static_side_channel=False):
     """_summary_
 
     Parameters
@@ -49,6 +49,9 @@ def model_infer(seq_first, device, model, xs, ys):
         xs is always batch first
     ys : tensor
         observed data
+    static_side_channel : bool
+        if True, the last one of xs is the static attributes (batch, attribute),
+        which is given to the model as its keyword argument c
 
     Returns
     -------
@@ -78,7 +81,11 @@ def model_infer(seq_first, device, model, xs, ys):
         if seq_first and ys.ndim == 3
         else ys.to(device)
     )
-    output = model(*xs)
+    if static_side_channel:
+        *xs, c = xs
+        output = model(*xs, c=c)
+    else:
+        output = model(*xs)
     if type(output) is tuple:
         # Convention: y_p must be the first output of model
         output = output[0]
@@ -144,6 +151,32 @@ def denormalize4eval(eval_dataloader, output, labels, rolling=False):
     return preds_xr, obss_xr
 
 
+def denormalize_tensor4eval(eval_dataloader, output, labels):
+    """
+    denormalize4eval with vectorized torch ops on the device of output,
+    for metrics of every validation epoch; no xarray object is built
+
+    Parameters
+    ----------
+    eval_dataloader
+        dataloader for validation, whose target scaler has inverse_transform_batch
+    output : torch.Tensor
+        batch-first model output; the i-th sample is the whole series of the i-th basin
+    labels : torch.Tensor
+        batch-first observed data
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        predicted data and observed data with shape (basin, time, variable)
+    """
+    target_scaler = eval_dataloader.dataset.target_scaler
+    basins = torch.arange(output.shape[0], device=output.device)
+    preds = target_scaler.inverse_transform_batch(output, basins)
+    obss = target_scaler.inverse_transform_batch(labels, basins)
+    return preds.cpu().numpy(), obss.cpu().numpy()
+
+
 class EarlyStopper(object):
     def __init__(
         self,
@@ -227,9 +260,10 @@ def evaluate_validation(
     Parameters
     ----------
     output
-        model output
+        model output, np.ndarray or torch.Tensor; tensors are denormalized
+        on their device when the target scaler supports it
     labels
-        model target
+        model target, the same type as output
     evaluation_cfgs
         evaluation configs
     target_col
@@ -246,8 +280,13 @@ def evaluate_validation(
     eval_log = {}
     batch_size = validation_data_loader.batch_size
     evaluation_metrics = evaluation_cfgs["metrics"]
+    target_scaler = validation_data_loader.dataset.target_scaler
+    if isinstance(output, torch.Tensor) and (
+        evaluation_cfgs["rolling"]
+        or not hasattr(target_scaler, "inverse_transform_batch")
+    ):
+        output, labels = output.cpu().numpy(), labels.cpu().numpy()
     if evaluation_cfgs["rolling"]:
-        target_scaler = validation_data_loader.dataset.target_scaler
         target_data = target_scaler.data_target
         basin_num = len(target_data.basin)
         horizon = target_scaler.data_cfgs["forecast_length"]
@@ -282,10 +321,17 @@ def evaluate_validation(
             )
 
     else:
-        preds_xr, obss_xr = denormalize4eval(validation_data_loader, output, labels)
+        if isinstance(output, torch.Tensor):
+            preds, obss = denormalize_tensor4eval(
+                validation_data_loader, output, labels
+            )
+        else:
+            preds_xr, obss_xr = denormalize4eval(validation_data_loader, output, labels)
+            preds = np.stack([preds_xr[col].to_numpy() for col in target_col], axis=-1)
+            obss = np.stack([obss_xr[col].to_numpy() for col in target_col], axis=-1)
         for i, col in enumerate(target_col):
-            obs = obss_xr[col].to_numpy()
-            pred = preds_xr[col].to_numpy()
+            obs = obss[..., i]
+            pred = preds[..., i]
             eval_log = calculate_and_record_metrics(
                 obs,
                 pred,
@@ -368,6 +414,25 @@ def compute_loss(
     return criterion(output, labels.float())
 
 
+def _loss_aware_sampler(data_loader):
+    """The sampler of data_loader which weights losses of its batches and learns from them,
+    such as LossAwareSampler; None if there is no such sampler
+
+    Wrappers which only prefetch data, e.g. PrefetchBatchSampler, are looked through
+    """
+    for sampler in [
+        getattr(data_loader, "batch_sampler", None),
+        getattr(data_loader, "sampler", None),
+    ]:
+        while sampler is not None and not hasattr(sampler, "update_loss"):
+            sampler = getattr(
+                sampler, "batch_sampler", getattr(sampler, "sampler", None)
+            )
+        if sampler is not None:
+            return sampler
+    return None
+
+
 def torch_single_train(
     model,
     opt: optim.Optimizer,
@@ -408,16 +473,26 @@ def torch_single_train(
     running_loss = 0.0
     which_first_tensor = kwargs["which_first_tensor"]
     seq_first = which_first_tensor != "batch"
+    loss_sampler = _loss_aware_sampler(data_loader)
+    static_side_channel = getattr(data_loader.dataset, "static_side_channel", False)
     pbar = tqdm(data_loader)
 
     for _, (src, trg) in enumerate(pbar):
-        trg, output = model_infer(seq_first, device, model, src, trg)
+        trg, output = model_infer(
+            seq_first, device, model, src, trg, static_side_channel
+        )
 
         loss = compute_loss(trg, output, criterion, **kwargs)
+        if loss_sampler is not None:
+            basin, weight = loss_sampler.pop_batch()
         if loss > 100:
             print("Warning: high loss detected")
         if torch.isnan(loss):
             continue
+        if loss_sampler is not None:
+            # the sampler learns from the loss, and the weight keeps the loss unbiased
+            loss_sampler.update_loss(basin, loss.item())
+            loss = loss * weight
         loss.backward()  # Backpropagate to compute the current gradient
         opt.step()  # Update network parameters based on gradients
         model.zero_grad()  # clear gradient
@@ -459,15 +534,19 @@ def compute_validation(
     Returns
     -------
     tuple
-        validation observations (numpy array), predictions (numpy array) and the loss of validation
+        validation observations (numpy array), predictions (numpy array) and the loss of validation;
+        observations and predictions are torch.Tensor on device if kwargs["to_numpy"] is False
     """
     model.eval()
     seq_first = kwargs["which_first_tensor"] != "batch"
+    static_side_channel = getattr(data_loader.dataset, "static_side_channel", False)
     obs = []
     preds = []
     with torch.no_grad():
         for src, trg in data_loader:
-            trg, output = model_infer(seq_first, device, model, src, trg)
+            trg, output = model_infer(
+                seq_first, device, model, src, trg, static_side_channel
+            )
             obs.append(trg)
             preds.append(output)
         # first dim is batch
@@ -475,6 +554,8 @@ def compute_validation(
         pred_final = torch.cat(preds, dim=0)
 
         valid_loss = compute_loss(obs_final, pred_final, criterion)
+    if not kwargs.get("to_numpy", True):
+        return obs_final, pred_final, valid_loss
     y_obs = obs_final.detach().cpu().numpy()
     y_pred = pred_final.detach().cpu().numpy()
     return y_obs, y_pred, valid_loss
@@ -646,6 +727,46 @@ def read_torchhydro_log_json_file(cfg_dir):
     return unserialize_json(cfg_file)
 
 
+def time_to_metric_target(
+    cfg_dir, target, metric="NSE", target_col=None, stat="median"
+):
+    """Wall-clock training time until a validation metric reaches a target,
+    e.g. to compare how fast samplers train a model to a given NSE
+
+    Parameters
+    ----------
+    cfg_dir
+        the directory of the training log json file, i.e. test_path
+    target
+        the target value of the metric, which is reached when the metric >= target
+    metric
+        name of the metric in evaluation_cfgs["metrics"], by default NSE
+    target_col
+        the target variable; by default, the first one of target_cols
+    stat
+        "median" or "mean" of the metric over basins
+
+    Returns
+    -------
+    tuple[int, float] or None
+        the first epoch reaching the target and the training seconds summed up to it;
+        None if the target is never reached
+    """
+    logs = read_torchhydro_log_json_file(cfg_dir)
+    if target_col is None:
+        target_col = logs["data_cfgs"]["target_cols"][0]
+    stat_func = {"median": np.nanmedian, "mean": np.nanmean}[stat]
+    seconds = 0.0
+    for log in logs["run"]:
+        seconds += float(log["train_seconds"])
+        if "validation_metric" not in log:
+            continue
+        value = stat_func(log["validation_metric"][f"{metric} of {target_col}"])
+        if value >= target:
+            return log["epoch"], seconds
+    return None
+
+
 def get_latest_pbm_param_file(param_dir):
     """Get the latest parameter file of physics-based models in the current directory.
 